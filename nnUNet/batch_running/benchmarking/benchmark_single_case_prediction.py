@@ -0,0 +1,50 @@
+import argparse
+from copy import deepcopy
+from time import time
+
+import numpy as np
+import torch
+
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+
+
+def benchmark_single_case_prediction(predictor: nnUNetPredictor, image: np.ndarray, properties: dict,
+                                     num_repeats: int = 5) -> dict:
+    """
+    Compares the latency of predict_single_npy_array (batchgenerators DataLoader based) with
+    predict_single_npy_array_fast for one image that is predicted num_repeats times in a row. The first call of each
+    variant is reported separately because it includes warmup (cudnn benchmark, thread pool creation, etc).
+    Also verifies that both variants return the same segmentation.
+    """
+    results = {}
+    segmentations = {}
+    for name, fn in (('predict_single_npy_array', predictor.predict_single_npy_array),
+                     ('predict_single_npy_array_fast', predictor.predict_single_npy_array_fast)):
+        times = []
+        for _ in range(num_repeats + 1):
+            start = time()
+            segmentations[name] = fn(image, deepcopy(properties), None, None, False)
+            times.append(time() - start)
+        results[name] = {'first_call': times[0], 'mean': float(np.mean(times[1:])), 'min': float(np.min(times[1:]))}
+    results['identical_output'] = bool(np.all(segmentations['predict_single_npy_array'] ==
+                                              segmentations['predict_single_npy_array_fast']))
+    return results
+
+
+if __name__ == '__main__':
+    from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', type=str, required=True, help='trained model folder')
+    parser.add_argument('-i', nargs='+', type=str, required=True, help='image file(s) of one case')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, ), help='folds. Default: 0')
+    parser.add_argument('-n', type=int, required=False, default=5, help='number of repeats. Default: 5')
+    parser.add_argument('-device', type=str, required=False, default='cuda', help='Default: cuda')
+    args = parser.parse_args()
+
+    predictor = nnUNetPredictor(device=torch.device(args.device), allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(args.m, [i if i == 'all' else int(i) for i in args.f])
+    rw = determine_reader_writer_from_dataset_json(predictor.dataset_json, args.i[0])()
+    img, props = rw.read_images(args.i)
+    for k, v in benchmark_single_case_prediction(predictor, img, props, args.n).items():
+        print(k, v)
@@ -1,19 +1,37 @@
-import multiprocessing
 import os
-from time import sleep
 from typing import List, Type, Union
 
 import numpy as np
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p
-from tqdm import tqdm
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p, \
+    load_pickle, write_pickle, subfiles
 
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
 from nnunetv2.paths import nnUNet_raw, nnUNet_preprocessed
 from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
+from nnunetv2.utilities.hashing import hash_files_with_cache, hash_json_serializable, file_stat_signature
+from nnunetv2.utilities.memory_budgeted_executor import MemoryBudgetedExecutor, estimate_case_memory
+from nnunetv2.utilities.task_executor import run_tasks
 from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
 
+# per-case results of analyze_case, in nnUNet_preprocessed/DATASET next to dataset_fingerprint.json
+FINGERPRINT_CACHE_FOLDER = 'fingerprint_cache'
+
+
+def _hash_case_files(files: List[str], previous_files: Union[dict, None] = None) -> dict:
+    file_hashes = hash_files_with_cache(files, previous_files)
+    return {'case_hash': hash_json_serializable([file_hashes[f]['hash'] for f in files]), 'files': file_hashes}
+
+
+def _analyze_and_hash_case(image_files: List[str], segmentation_file: str,
+                           reader_writer_class: Type[BaseReaderWriter], num_samples: int = 10000):
+    # hashing right after analyze_case read the files: they are in the page cache, and the work is spread over the
+    # workers instead of being done upfront in the main process
+    result = DatasetFingerprintExtractor.analyze_case(image_files, segmentation_file, reader_writer_class,
+                                                      num_samples)
+    return result, _hash_case_files(list(image_files) + [segmentation_file])
+
 
 class DatasetFingerprintExtractor(object):
     def __init__(self, dataset_name_or_id: Union[str, int], num_processes: int = 8, verbose: bool = False):
@@ -111,6 +129,47 @@ class DatasetFingerprintExtractor(object):
         return shape_after_crop, spacing, foreground_intensities_per_channel, foreground_intensity_stats_per_channel, \
                relative_size_after_cropping
 
+    def _load_cached_results(self, cache_folder: str, num_samples: int) -> dict:
+        """
+        Returns the cached analyze_case results that are still valid. A cached result is valid if the content of the
+        files of the case did not change and if it holds at least num_samples foreground intensities per channel.
+        Surplus samples are cut off. The samples are drawn independently with replacement, so the first num_samples
+        of them are just as good as a new draw (for single channel images they are even identical to one).
+
+        Files with unchanged size and mtime are not read. Only cases that have a cache record but whose files were
+        touched are hashed here (in self.num_processes workers) to see whether the content changed. Cases without a
+        record are not hashed at all, that happens in the worker that analyzes them (_analyze_and_hash_case)
+        """
+        cached_results = {}
+        to_verify = []
+        for k in self.dataset.keys():
+            cache_file = join(cache_folder, k + '.pkl')
+            if not isfile(cache_file):
+                continue
+            record = load_pickle(cache_file)
+            if record['num_samples'] < num_samples:
+                continue
+            files = list(self.dataset[k]['images']) + [self.dataset[k]['label']]
+            if all([f in record['files'].keys() and record['files'][f]['stat'] == file_stat_signature(f)
+                    for f in files]):
+                cached_results[k] = record
+            else:
+                to_verify.append((k, files, record))
+        if len(to_verify) > 0:
+            hashes = run_tasks(_hash_case_files, [(files, record['files']) for _, files, record in to_verify],
+                               self.num_processes, desc='Hashing modified files', disable_progress_bar=self.verbose)
+            for (k, _, record), h in zip(to_verify, hashes):
+                if h['case_hash'] == record['case_hash']:
+                    # same content, new stat. Record that so that the files are not read again next time
+                    record = {**record, 'files': h['files']}
+                    write_pickle(record, join(cache_folder, k + '.pkl'))
+                    cached_results[k] = record
+        ret = {}
+        for k, record in cached_results.items():
+            r = record['result']
+            ret[k] = (r[0], r[1], [i[:num_samples] for i in r[2]], r[3], r[4])
+        return ret
+
     def run(self, overwrite_existing: bool = False) -> dict:
         # we do not save the properties file in self.input_folder because that folder might be read-only. We can only
         # reliably write in nnUNet_preprocessed and nnUNet_results, so nnUNet_preprocessed it is
@@ -127,38 +186,42 @@ class DatasetFingerprintExtractor(object):
             num_foreground_samples_per_case = int(self.num_foreground_voxels_for_intensitystats //
                                                   len(self.dataset))
 
-            r = []
-            with multiprocessing.get_context("spawn").Pool(self.num_processes) as p:
-                for k in self.dataset.keys():
-                    r.append(p.starmap_async(DatasetFingerprintExtractor.analyze_case,
-                                             ((self.dataset[k]['images'], self.dataset[k]['label'], reader_writer_class,
-                                               num_foreground_samples_per_case),)))
-                remaining = list(range(len(self.dataset)))
-                # p is pretty nifti. If we kill workers they just respawn but don't do any work.
-                # So we need to store the original pool of workers.
-                workers = [j for j in p._pool]
-                with tqdm(desc=None, total=len(self.dataset), disable=self.verbose) as pbar:
-                    while len(remaining) > 0:
-                        all_alive = all([j.is_alive() for j in workers])
-                        if not all_alive:
-                            raise RuntimeError('Some background worker is 6 feet under. Yuck. \n'
-                                               'OK jokes aside.\n'
-                                               'One of your background processes is missing. This could be because of '
-                                               'an error (look for an error message) or because it was killed '
-                                               'by your OS due to running out of RAM. If you don\'t see '
-                                               'an error message, out of RAM is likely the problem. In that case '
-                                               'reducing the number of workers might help')
-                        done = [i for i in remaining if r[i].ready()]
-                        for _ in done:
-                            pbar.update()
-                        remaining = [i for i in remaining if i not in done]
-                        sleep(0.1)
+            # per-case results of earlier runs are reused if the files of the case did not change, so only new and
+            # modified cases need to be analyzed
+            cache_folder = join(preprocessed_output_folder, FINGERPRINT_CACHE_FOLDER)
+            maybe_mkdir_p(cache_folder)
+            cached_results = self._load_cached_results(cache_folder, num_foreground_samples_per_case)
+            to_analyze = [k for k in self.dataset.keys() if k not in cached_results.keys()]
+            if self.verbose or len(cached_results) > 0:
+                print(f'Fingerprint: {len(cached_results)} cases taken from cache, {len(to_analyze)} to analyze')
+
+            # cases are started as long as their estimated memory requirement fits into the RAM budget, see
+            # MemoryBudgetedExecutor. No estimate (None) if the reader/writer cannot read just the header
+            rw = reader_writer_class()
+            estimates = []
+            for k in to_analyze:
+                geometry = rw.read_images_geometry(self.dataset[k]['images'])
+                estimates.append(None if geometry is None else estimate_case_memory(geometry[0][1:], geometry[0][0]))
+            new_results = MemoryBudgetedExecutor(self.num_processes, verbose=self.verbose).run(
+                _analyze_and_hash_case,
+                [(self.dataset[k]['images'], self.dataset[k]['label'], reader_writer_class,
+                  num_foreground_samples_per_case) for k in to_analyze],
+                estimates)
+            for k, (r, h) in zip(to_analyze, new_results):
+                write_pickle({'case_hash': h['case_hash'], 'files': h['files'],
+                              'num_samples': num_foreground_samples_per_case, 'result': r},
+                             join(cache_folder, k + '.pkl'))
+                cached_results[k] = r
+            # cases that are no longer part of the dataset
+            for f in subfiles(cache_folder, suffix='.pkl', join=False):
+                if f[:-4] not in self.dataset.keys():
+                    os.remove(join(cache_folder, f))
+            results = [cached_results[k] for k in self.dataset.keys()]
 
             # results = ptqdm(DatasetFingerprintExtractor.analyze_case,
             #                 (training_images_per_case, training_labels_per_case),
             #                 processes=self.num_processes, zipped=True, reader_writer_class=reader_writer_class,
             #                 num_samples=num_foreground_samples_per_case, disable=self.verbose)
-            results = [i.get()[0] for i in r]
 
             shapes_after_crop = [r[0] for r in results]
             spacings = [r[1] for r in results]
@@ -0,0 +1,73 @@
+from typing import List, Union
+
+import numpy as np
+
+
+class ForegroundIntensitySketch(object):
+    def __init__(self, num_channels: int, capacity_per_channel: int = int(10e7), seed: int = 1234):
+        """
+        Bounded sample of foreground intensities per channel that can be merged across cases and workers. This is the
+        same kind of sample the default DatasetFingerprintExtractor builds (num_samples per case, drawn with
+        replacement so that every case is represented equally), but it never holds more than capacity_per_channel
+        values. If merging exceeds the capacity, the sample is thinned uniformly, which keeps the equal weighting of
+        cases intact.
+
+        Statistics are computed exactly like DatasetFingerprintExtractor.run does it.
+        """
+        self.num_channels = num_channels
+        self.capacity_per_channel = capacity_per_channel
+        self.seed = seed
+        self.samples = [np.zeros(0, dtype=np.float32) for _ in range(num_channels)]
+        self.num_cases = 0
+
+    @staticmethod
+    def from_samples(samples_per_channel: List[np.ndarray], seed: int = 1234,
+                     capacity_per_channel: int = int(10e7)) -> 'ForegroundIntensitySketch':
+        """
+        Sketch of a single case. samples_per_channel are the num_samples foreground intensities drawn (with
+        replacement) from the case, as DatasetFingerprintExtractor.collect_foreground_intensities does
+        """
+        sketch = ForegroundIntensitySketch(len(samples_per_channel), capacity_per_channel, seed)
+        sketch.samples = [np.asarray(i, dtype=np.float32) for i in samples_per_channel]
+        sketch.num_cases = 1
+        return sketch
+
+    def merge(self, other: 'ForegroundIntensitySketch') -> 'ForegroundIntensitySketch':
+        assert other.num_channels == self.num_channels, 'cannot merge sketches with different numbers of channels'
+        for c in range(self.num_channels):
+            merged = np.concatenate((self.samples[c], other.samples[c]))
+            if len(merged) > self.capacity_per_channel:
+                rng = np.random.default_rng(self.seed + self.num_cases)
+                merged = merged[np.sort(rng.choice(len(merged), self.capacity_per_channel, replace=False))]
+            self.samples[c] = merged
+        self.num_cases += other.num_cases
+        return self
+
+    @staticmethod
+    def merge_all(sketches: List['ForegroundIntensitySketch']) -> Union['ForegroundIntensitySketch', None]:
+        if len(sketches) == 0:
+            return None
+        merged = ForegroundIntensitySketch(sketches[0].num_channels, sketches[0].capacity_per_channel,
+                                           sketches[0].seed)
+        for s in sketches:
+            merged.merge(s)
+        return merged
+
+    def get_intensity_statistics(self) -> dict:
+        """
+        foreground_intensity_properties_per_channel as found in dataset_fingerprint.json
+        """
+        intensity_statistics_per_channel = {}
+        percentiles = np.array((0.5, 50.0, 99.5))
+        for i in range(self.num_channels):
+            percentile_00_5, median, percentile_99_5 = np.percentile(self.samples[i], percentiles)
+            intensity_statistics_per_channel[i] = {
+                'mean': float(np.mean(self.samples[i])),
+                'median': float(median),
+                'std': float(np.std(self.samples[i])),
+                'min': float(np.min(self.samples[i])),
+                'max': float(np.max(self.samples[i])),
+                'percentile_99_5': float(percentile_99_5),
+                'percentile_00_5': float(percentile_00_5),
+            }
+        return intensity_statistics_per_channel
@@ -0,0 +1,192 @@
+import os
+from typing import Iterable, List, Tuple, Type, Union
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, save_json, isfile, maybe_mkdir_p
+
+from nnunetv2.experiment_planning.dataset_fingerprint.fingerprint_extractor import DatasetFingerprintExtractor
+from nnunetv2.experiment_planning.dataset_fingerprint.intensity_sketch import ForegroundIntensitySketch
+from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from nnunetv2.imageio.reader_writer_registry import determine_reader_writer_from_dataset_json
+from nnunetv2.paths import nnUNet_preprocessed
+from nnunetv2.utilities.memory_budgeted_executor import MemoryBudgetedExecutor, estimate_case_memory
+
+# images are read in slabs of about this many voxels (per channel)
+SLAB_NUM_VOXELS = 2 ** 22
+
+
+def sample_foreground_from_slabs(image_slabs: Iterable[np.ndarray], seg_slabs: Iterable[np.ndarray],
+                                 spatial_shape: Union[Tuple[int, ...], List[int]], num_samples: int,
+                                 seed: int = 1234) -> Tuple[Tuple[int, ...], List[np.ndarray]]:
+    """
+    Looks at a case one slab (see BaseReaderWriter.read_images_slabs) at a time and returns the shape of the nonzero
+    bounding box (what crop_to_nonzero crops to) and num_samples intensities per channel, drawn uniformly with
+    replacement from the foreground voxels within that box. Like collect_foreground_intensities, just without having
+    the case in memory.
+
+    The bounding box is only known at the end, but voxels outside of it are zero in all channels. So we keep a
+    running sample of the foreground voxels that are nonzero in any channel (these are always inside the box) and
+    only remember the positions of foreground voxels that are zero everywhere. The running sample is num_samples
+    independent reservoirs of size 1: the voxels of a new slab replace each entry with probability
+    (foreground voxels in slab) / (foreground voxels seen so far)
+    """
+    rng = np.random.default_rng(seed)
+    projections = [np.zeros(s, dtype=bool) for s in spatial_shape]
+    samples = None
+    num_nonzero_foreground = 0
+    zero_foreground = []
+    num_channels = None
+    x = 0
+    for images, seg in zip(image_slabs, seg_slabs):
+        assert not np.any(np.isnan(seg)), "Segmentation contains NaN values. grrrr.... :-("
+        assert not np.any(np.isnan(images)), "Images contains NaN values. grrrr.... :-("
+        num_channels = images.shape[0]
+        nonzero = images[0] != 0
+        for c in range(1, num_channels):
+            nonzero |= images[c] != 0
+        for d in range(len(spatial_shape)):
+            projection = np.any(nonzero, axis=tuple(i for i in range(nonzero.ndim) if i != d))
+            if d == 0:
+                projections[0][x:x + len(projection)] = projection
+            else:
+                projections[d] |= projection
+
+        foreground = seg[0] > 0
+        nonzero_foreground = foreground & nonzero
+        n = int(np.sum(nonzero_foreground))
+        if n > 0:
+            if samples is None:
+                samples = np.zeros((num_channels, num_samples), dtype=np.float32)
+            num_nonzero_foreground += n
+            replace = rng.choice(num_samples, rng.binomial(num_samples, n / num_nonzero_foreground), replace=False)
+            values = images[:, nonzero_foreground]
+            samples[:, replace] = values[:, rng.integers(0, n, len(replace))]
+        # flat indices into the full case
+        zero_foreground.append(np.flatnonzero(foreground & ~nonzero) + x * int(np.prod(spatial_shape[1:])))
+        x += nonzero.shape[0]
+    assert x == spatial_shape[0], f'expected {spatial_shape[0]} slices along the first axis, got {x}'
+
+    bbox = []
+    for p in projections:
+        nonzero_idx = np.flatnonzero(p)
+        bbox.append([int(nonzero_idx[0]), int(nonzero_idx[-1]) + 1] if len(nonzero_idx) > 0 else [0, len(p)])
+    zero_foreground = np.unravel_index(np.concatenate(zero_foreground), spatial_shape)
+    num_zero_foreground = int(np.sum(np.all([(i >= lb) & (i < ub) for i, (lb, ub) in zip(zero_foreground, bbox)],
+                                            axis=0)))
+
+    num_foreground = num_nonzero_foreground + num_zero_foreground
+    if num_foreground == 0:
+        return tuple([ub - lb for lb, ub in bbox]), [np.zeros(0, dtype=np.float32) for _ in range(num_channels)]
+    # each draw hits a zero foreground voxel with probability num_zero_foreground / num_foreground
+    from_nonzero = rng.random(num_samples) < num_nonzero_foreground / num_foreground
+    return tuple([ub - lb for lb, ub in bbox]), \
+        [np.where(from_nonzero, samples[c], 0).astype(np.float32) if samples is not None else
+         np.zeros(num_samples, dtype=np.float32) for c in range(num_channels)]
+
+
+class StreamingDatasetFingerprintExtractor(DatasetFingerprintExtractor):
+    def __init__(self, dataset_name_or_id: Union[str, int], num_processes: int = 8, verbose: bool = False):
+        """
+        Faster fingerprint extraction for large datasets (select with -fpe StreamingDatasetFingerprintExtractor):
+        - spacings are read from the image headers only
+        - images are only read to collect foreground intensities and the size after cropping. They are read in slabs
+          (BaseReaderWriter.read_images_slabs, streamed from disk for NIfTI files), so cases are never held in memory
+          in their entirety. Only the bounding box of the nonzero region is needed, so no hole filling. No per-case
+          percentiles are computed (the default extractor computes them and then throws them away)
+        - foreground intensities of all cases are collected in a bounded, mergeable sample
+          (ForegroundIntensitySketch)
+        - at most max_cases_for_intensities cases (evenly spread over the dataset) are read at all. For the remaining
+          cases the shape after cropping is derived from the header shape and the median per-axis cropping ratio of the
+          loaded cases
+
+        If the reader/writer cannot read the image geometry from the header, all cases have to be read. If no more than
+        max_cases_for_intensities cases are in the dataset, spacings and shapes are identical to the ones of
+        DatasetFingerprintExtractor and the intensity statistics only differ by sampling noise.
+        """
+        super().__init__(dataset_name_or_id, num_processes, verbose)
+        self.max_cases_for_intensities = 200
+
+    @staticmethod
+    def analyze_case_streaming(image_files: List[str], segmentation_file: str,
+                               reader_writer_class: Type[BaseReaderWriter], num_samples: int = 10000):
+        """
+        returns shape after cropping, the foreground intensity sketch and the geometry (shape, spacing) of the case
+        """
+        rw = reader_writer_class()
+        geometry = rw.read_images_geometry(image_files)
+        if geometry is None:
+            # we need the spacing, and that is only available from read_images
+            images, properties = rw.read_images(image_files)
+            segmentation, _ = rw.read_seg(segmentation_file)
+            geometry = (images.shape, list(properties['spacing']))
+            image_slabs, seg_slabs = [images], [segmentation]
+        else:
+            num_slices = max(1, SLAB_NUM_VOXELS // int(np.prod(geometry[0][2:])))
+            image_slabs = rw.read_images_slabs(image_files, num_slices)
+            seg_slabs = rw.read_seg_slabs(segmentation_file, num_slices)
+        shape_after_crop, samples = sample_foreground_from_slabs(image_slabs, seg_slabs, geometry[0][1:], num_samples)
+        return shape_after_crop, ForegroundIntensitySketch.from_samples(samples), geometry
+
+    def run(self, overwrite_existing: bool = False) -> dict:
+        preprocessed_output_folder = join(nnUNet_preprocessed, self.dataset_name)
+        maybe_mkdir_p(preprocessed_output_folder)
+        properties_file = join(preprocessed_output_folder, 'dataset_fingerprint.json')
+
+        if isfile(properties_file) and not overwrite_existing:
+            return load_json(properties_file)
+
+        identifiers = list(self.dataset.keys())
+        reader_writer_class = determine_reader_writer_from_dataset_json(self.dataset_json,
+                                                                        self.dataset[identifiers[0]]['images'][0])
+        rw = reader_writer_class()
+        # shape is (c, x, y, z). None if the reader/writer cannot read just the header
+        geometries = [rw.read_images_geometry(self.dataset[k]['images']) for k in identifiers]
+
+        if len(identifiers) <= self.max_cases_for_intensities:
+            loaded = list(range(len(identifiers)))
+        else:
+            loaded = np.unique(np.round(np.linspace(0, len(identifiers) - 1,
+                                                    self.max_cases_for_intensities)).astype(int)).tolist()
+        # cases without geometry must be read to get their spacing
+        loaded = sorted(set(loaded) | set([i for i, g in enumerate(geometries) if g is None]))
+        num_foreground_samples_per_case = int(self.num_foreground_voxels_for_intensitystats // len(loaded))
+
+        # the (streamed) analysis holds about one slab at a time, so estimate_case_memory (which assumes the entire
+        # case is read) is conservative
+        results = MemoryBudgetedExecutor(self.num_processes, verbose=self.verbose).run(
+            StreamingDatasetFingerprintExtractor.analyze_case_streaming,
+            [(self.dataset[identifiers[i]]['images'], self.dataset[identifiers[i]]['label'], reader_writer_class,
+              num_foreground_samples_per_case) for i in loaded],
+            [None if geometries[i] is None else estimate_case_memory(geometries[i][0][1:], geometries[i][0][0])
+             for i in loaded])
+
+        shapes_after_crop = [None] * len(identifiers)
+        for i, r in zip(loaded, results):
+            shapes_after_crop[i] = r[0]
+            geometries[i] = r[2]
+        spacings = [g[1] for g in geometries]
+        crop_ratios = np.array([np.array(shapes_after_crop[i]) / np.array(geometries[i][0][1:]) for i in loaded])
+        if len(loaded) < len(identifiers):
+            median_crop_ratio_per_axis = np.median(crop_ratios, 0)
+            for i in range(len(identifiers)):
+                if shapes_after_crop[i] is None:
+                    shapes_after_crop[i] = tuple([max(1, int(round(s * r))) for s, r in
+                                                  zip(geometries[i][0][1:], median_crop_ratio_per_axis)])
+
+        relative_sizes_after_cropping = [np.prod(shapes_after_crop[i]) / np.prod(geometries[i][0][1:])
+                                         for i in loaded]
+        sketch = ForegroundIntensitySketch.merge_all([r[1] for r in results])
+        fingerprint = {
+            "spacings": spacings,
+            "shapes_after_crop": shapes_after_crop,
+            'foreground_intensity_properties_per_channel': sketch.get_intensity_statistics(),
+            "median_relative_size_after_cropping": np.median(relative_sizes_after_cropping, 0)
+        }
+
+        try:
+            save_json(fingerprint, properties_file)
+        except Exception as e:
+            if isfile(properties_file):
+                os.remove(properties_file)
+            raise e
+        return fingerprint
@@ -101,7 +101,8 @@ def preprocess_dataset(dataset_id: int,
                        plans_identifier: str = 'nnUNetPlans',
                        configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                        num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-                       verbose: bool = False) -> None:
+                       verbose: bool = False,
+                       incremental: bool = False) -> None:
     if not isinstance(num_processes, list):
         num_processes = list(num_processes)
     if len(num_processes) == 1:
@@ -126,7 +127,7 @@ def preprocess_dataset(dataset_id: int,
             continue
         configuration_manager = plans_manager.get_configuration(c)
         preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n)
+        preprocessor.run(dataset_id, c, plans_identifier, num_processes=n, incremental=incremental)
 
     # copy the gt to a folder in the nnUNet_preprocessed so that we can do validation even if the raw data is no
     # longer there (useful for compute cluster where only the preprocessed data is available)
@@ -145,6 +146,7 @@ def preprocess(dataset_ids: List[int],
                plans_identifier: str = 'nnUNetPlans',
                configurations: Union[Tuple[str], List[str]] = ('2d', '3d_fullres', '3d_lowres'),
                num_processes: Union[int, Tuple[int, ...], List[int]] = (8, 4, 8),
-               verbose: bool = False):
+               verbose: bool = False,
+               incremental: bool = False):
     for d in dataset_ids:
-        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose)
+        preprocess_dataset(d, plans_identifier, configurations, num_processes, verbose, incremental)
@@ -10,7 +10,10 @@ def extract_fingerprint_entry():
                              "planning and preprocessing for these datasets. Can of course also be just one dataset")
     parser.add_argument('-fpe', type=str, required=False, default='DatasetFingerprintExtractor',
                         help='[OPTIONAL] Name of the Dataset Fingerprint Extractor class that should be used. Default is '
-                             '\'DatasetFingerprintExtractor\'.')
+                             '\'DatasetFingerprintExtractor\'. For large datasets, '
+                             '\'StreamingDatasetFingerprintExtractor\' reads spacings from the image headers and '
+                             'streams the images into a bounded intensity sample (much faster, same result up to '
+                             'sampling noise for up to 200 cases).')
     parser.add_argument('-np', type=int, default=default_num_processes, required=False,
                         help=f'[OPTIONAL] Number of processes used for fingerprint extraction. '
                              f'Default: {default_num_processes}')
@@ -94,13 +97,18 @@ def preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progress bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='[OPTIONAL] Only preprocess cases that are new or changed since the last run and remove '
+                             'the output of cases that are no longer in the dataset. Everything is reprocessed '
+                             'anyway if the plans or the labels in dataset.json changed.')
     args, unrecognized_args = parser.parse_known_args()
     if args.np is None:
         default_np = {"2d": 8, "3d_fullres": 4, "3d_lowres": 8}
         np = [default_np[c] if c in default_np.keys() else 4 for c in args.c]
     else:
         np = args.np
-    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose)
+    preprocess(args.d, args.plans_name, configurations=args.c, num_processes=np, verbose=args.verbose,
+               incremental=args.incremental)
 
 
 def plan_and_preprocess_entry():
@@ -111,7 +119,10 @@ def plan_and_preprocess_entry():
                              "planning and preprocessing for these datasets. Can of course also be just one dataset")
     parser.add_argument('-fpe', type=str, required=False, default='DatasetFingerprintExtractor',
                         help='[OPTIONAL] Name of the Dataset Fingerprint Extractor class that should be used. Default is '
-                             '\'DatasetFingerprintExtractor\'.')
+                             '\'DatasetFingerprintExtractor\'. For large datasets, '
+                             '\'StreamingDatasetFingerprintExtractor\' reads spacings from the image headers and '
+                             'streams the images into a bounded intensity sample (much faster, same result up to '
+                             'sampling noise for up to 200 cases).')
     parser.add_argument('-npfp', type=int, default=8, required=False,
                         help='[OPTIONAL] Number of processes used for fingerprint extraction. Default: 8')
     parser.add_argument("--verify_dataset_integrity", required=False, default=False, action="store_true",
@@ -173,6 +184,10 @@ def plan_and_preprocess_entry():
     parser.add_argument('--verbose', required=False, action='store_true',
                         help='Set this to print a lot of stuff. Useful for debugging. Will disable progress bar! '
                              'Recommended for cluster environments')
+    parser.add_argument('--incremental', required=False, action='store_true',
+                        help='[OPTIONAL] Only preprocess cases that are new or changed since the last run and remove '
+                             'the output of cases that are no longer in the dataset. Everything is reprocessed '
+                             'anyway if the plans or the labels in dataset.json changed.')
     args = parser.parse_args()
 
     # fingerprint extraction
@@ -193,7 +208,7 @@ def plan_and_preprocess_entry():
     # preprocessing
     if not args.no_pp:
         print('Preprocessing...')
-        preprocess(args.d, plans_identifier, args.c, np, args.verbose)
+        preprocess(args.d, plans_identifier, args.c, np, args.verbose, args.incremental)
 
 
 if __name__ == '__main__':
@@ -14,7 +14,7 @@
 #    limitations under the License.
 
 from abc import ABC, abstractmethod
-from typing import Tuple, Union, List
+from typing import Tuple, Union, List, Iterator
 import numpy as np
 
 
@@ -68,6 +68,36 @@ class BaseReaderWriter(ABC):
         """
         pass
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Union[Tuple[Tuple[int, ...], List[float]], None]:
+        """
+        Returns the shape (c, x, y, z) and the spacing that read_images would return for these files. Used to plan
+        work (memory estimates etc) without loading the images. Reader/writers that can read just the header should
+        overwrite this. The default implementation returns None (= geometry is not available without reading the
+        images), callers must then fall back to something that does not need it.
+        """
+        return None
+
+    def read_images_slabs(self, image_fnames: Union[List[str], Tuple[str, ...]], num_slices: int) -> \
+            Iterator[np.ndarray]:
+        """
+        Yields the array read_images would return in consecutive slabs of at most num_slices along the first spatial
+        axis, shape (c, n, y, z). For code that looks at every voxel once and does not need the entire case in memory
+        (fingerprint extraction). Reader/writers that can read parts of a file should overwrite this, the default
+        implementation reads the images and yields views.
+        """
+        images, _ = self.read_images(image_fnames)
+        for i in range(0, images.shape[1], num_slices):
+            yield images[:, i:i + num_slices]
+
+    def read_seg_slabs(self, seg_fname: str, num_slices: int) -> Iterator[np.ndarray]:
+        """
+        Same as read_images_slabs, for read_seg
+        """
+        seg, _ = self.read_seg(seg_fname)
+        for i in range(0, seg.shape[1], num_slices):
+            yield seg[:, i:i + num_slices]
+
     @abstractmethod
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         """
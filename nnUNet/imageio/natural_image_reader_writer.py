@@ -16,6 +16,7 @@
 from typing import Tuple, Union, List
 import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
+from PIL import Image
 from skimage import io
 
 
@@ -58,6 +59,17 @@ class NaturalImage2DIO(BaseReaderWriter):
             raise RuntimeError()
         return np.vstack(images, dtype=np.float32, casting='unsafe'), {'spacing': (999, 1, 1)}
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Tuple[Tuple[int, ...], List[float]]:
+        # Image.open only reads the header. Palette images are expanded to RGB(A) by io.imread
+        num_channels = 0
+        for f in image_fnames:
+            with Image.open(f) as img:
+                bands = img.palette.mode if img.mode == 'P' else img.getbands()
+                num_channels += len(bands) if len(bands) in (3, 4) else 1
+                width, height = img.size
+        return (num_channels, 1, height, width), [999., 1., 1.]
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
@@ -13,7 +13,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 import warnings
-from typing import Tuple, Union, List
+from typing import Tuple, Union, List, Iterator
 import numpy as np
 from nibabel.orientations import io_orientation, axcodes2ornt, ornt_transform
 
@@ -23,6 +23,26 @@ import nibabel
 from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
 
 
+def read_nifti_slabs(image_fnames: Union[List[str], Tuple[str, ...]], num_slices: int) -> \
+        Union[Iterator[np.ndarray], None]:
+    """
+    Slabs of 3d NIfTI images in the axis order of NibabelIO and SimpleITKIO (see BaseReaderWriter.read_images_slabs).
+    The array proxy only reads the part of the file that is requested. The files are kept open, so compressed files
+    are decompressed once, front to back, instead of from the start for every slab. None if not all images are 3d
+    with the same shape
+    """
+    nib_images = [nibabel.load(f, keep_file_open=True) for f in image_fnames]
+    if not all([i.ndim == 3 for i in nib_images]) or not BaseReaderWriter._check_all_same([i.shape for i in nib_images]):
+        return None
+
+    def _slabs():
+        # nnU-Net's first spatial axis is nibabel's last one
+        for z in range(0, nib_images[0].shape[2], num_slices):
+            yield np.vstack([np.asarray(i.dataobj[:, :, z:z + num_slices], dtype=np.float32).transpose((2, 1, 0))[None]
+                             for i in nib_images])
+    return _slabs()
+
+
 class NibabelIO(BaseReaderWriter):
     """
     Nibabel loads the images in a different order than sitk. We convert the axes to the sitk order to be
@@ -88,6 +108,22 @@ class NibabelIO(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Tuple[Tuple[int, ...], List[float]]:
+        # nibabel.load only reads the header, the data is loaded on access
+        nib_image = nibabel.load(image_fnames[0])
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        return (len(image_fnames), *nib_image.shape[::-1]), [float(i) for i in nib_image.header.get_zooms()[::-1]]
+
+    def read_images_slabs(self, image_fnames: Union[List[str], Tuple[str, ...]], num_slices: int) -> \
+            Iterator[np.ndarray]:
+        slabs = read_nifti_slabs(image_fnames, num_slices)
+        assert slabs is not None, 'only 3d images of the same shape are supported by NibabelIO'
+        return slabs
+
+    def read_seg_slabs(self, seg_fname: str, num_slices: int) -> Iterator[np.ndarray]:
+        return self.read_images_slabs((seg_fname,), num_slices)
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname,))
 
@@ -170,6 +206,18 @@ class NibabelIOWithReorient(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Tuple[Tuple[int, ...], List[float]]:
+        # nibabel.load only reads the header. as_reoriented permutes the axes as given by io_orientation (flips don't
+        # change shape and spacing), so we can apply that permutation to the header shape and zooms
+        nib_image = nibabel.load(image_fnames[0])
+        assert nib_image.ndim == 3, 'only 3d images are supported by NibabelIO'
+        shape, zooms = [0] * 3, [0.] * 3
+        for in_axis, (out_axis, _) in enumerate(io_orientation(nib_image.affine)):
+            shape[int(out_axis)] = nib_image.shape[in_axis]
+            zooms[int(out_axis)] = float(nib_image.header.get_zooms()[in_axis])
+        return (len(image_fnames), *shape[::-1]), zooms[::-1]
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname,))
 
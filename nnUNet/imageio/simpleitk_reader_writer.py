@@ -13,7 +13,7 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
-from typing import Tuple, Union, List
+from typing import Tuple, Union, List, Iterator
 import numpy as np
 from nnunetv2.imageio.base_reader_writer import BaseReaderWriter
 import SimpleITK as sitk
@@ -111,6 +111,43 @@ class SimpleITKIO(BaseReaderWriter):
         }
         return np.vstack(images, dtype=np.float32, casting='unsafe'), dict
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Tuple[Tuple[int, ...], List[float]]:
+        # header only, see read_images for how axes and spacing are ordered
+        num_channels = 0
+        shape = spacing = None
+        for f in image_fnames:
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(f)
+            reader.ReadImageInformation()
+            size, spacing_itk = reader.GetSize(), reader.GetSpacing()
+            if len(size) == 2:
+                num_channels += 1
+                shape, spacing = (1, *size[::-1]), (max(spacing_itk) * 999, *spacing_itk[::-1])
+            elif len(size) == 3:
+                num_channels += 1
+                shape, spacing = size[::-1], spacing_itk[::-1]
+            elif len(size) == 4:
+                num_channels += size[3]
+                shape, spacing = size[::-1][1:], spacing_itk[::-1][1:]
+            else:
+                raise RuntimeError(f"Unexpected number of dimensions: {len(size)} in file {f}")
+        return (num_channels, *shape), [float(i) for i in np.abs(spacing)]
+
+    def read_images_slabs(self, image_fnames: Union[List[str], Tuple[str, ...]], num_slices: int) -> \
+            Iterator[np.ndarray]:
+        # ITK can extract regions, but for compressed files it decompresses from the start for every slab. For NIfTI
+        # nibabel reads the same voxel array (SimpleITK does not reorient the data) sequentially
+        if all([f.endswith(('.nii', '.nii.gz')) for f in image_fnames]):
+            from nnunetv2.imageio.nibabel_reader_writer import read_nifti_slabs
+            slabs = read_nifti_slabs(image_fnames, num_slices)
+            if slabs is not None:
+                return slabs
+        return super().read_images_slabs(image_fnames, num_slices)
+
+    def read_seg_slabs(self, seg_fname: str, num_slices: int) -> Iterator[np.ndarray]:
+        return self.read_images_slabs((seg_fname,), num_slices)
+
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
 
@@ -68,6 +68,18 @@ class Tiff3DIO(BaseReaderWriter):
 
         return np.vstack(images, dtype=np.float32, casting='unsafe'), {'spacing': spacing}
 
+    def read_images_geometry(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> \
+            Tuple[Tuple[int, ...], List[float]]:
+        # TiffFile only parses the tags, the pixel data is not read
+        with tifffile.TiffFile(image_fnames[0]) as tif:
+            shape = tif.series[0].shape
+        if len(shape) != 3:
+            raise RuntimeError(f"Only 3D images are supported! File: {image_fnames[0]}")
+        ending = '.' + image_fnames[0].split('.')[-1]
+        expected_aux_file = image_fnames[0][:-(len(ending) + 5)] + '.json'
+        spacing = load_json(expected_aux_file)['spacing'] if isfile(expected_aux_file) else (1, 1, 1)
+        return (len(image_fnames), *shape), [float(i) for i in spacing]
+
     def write_seg(self, seg: np.ndarray, output_fname: str, properties: dict) -> None:
         # not ideal but I really have no clue how to set spacing/resolution information properly in tif files haha
         tifffile.imwrite(output_fname, data=seg.astype(np.uint8, copy=False), compression='zlib')
@@ -1,7 +1,5 @@
 import argparse
-import multiprocessing
 import os
-from time import sleep
 from typing import Union
 
 import numpy as np
@@ -13,9 +11,9 @@ from nnunetv2.configuration import default_num_processes
 from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian
-from nnunetv2.utilities.file_path_utilities import check_workers_alive_and_busy
 from nnunetv2.utilities.helpers import empty_cache
 from nnunetv2.utilities.plans_handling.plans_handler import ConfigurationManager, PlansManager
+from nnunetv2.utilities.task_executor import TaskExecutor
 
 
 def export_prediction_from_logits_singleFiles(
@@ -73,9 +71,10 @@ class JHUPredictor(nnUNetPredictor):
         We replace export_prediction_from_logits with export_prediction_from_logits_singleFiles to comply with JHU
         benchmark output format expectations
         """
-        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
+        # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+        # npy files: at most 2 predictions wait for a free export worker
+        with TaskExecutor(num_processes_segmentation_export, max_pending=num_processes_segmentation_export + 2,
+                          disable_progress_bar=True) as export_executor:
             for preprocessed in data_iterator:
                 data = preprocessed['data']
                 if isinstance(data, str):
@@ -93,12 +92,7 @@ class JHUPredictor(nnUNetPredictor):
 
                 properties = preprocessed['data_properties']
 
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                export_executor.wait_for_capacity()
 
                 prediction = self.predict_logits_from_preprocessed_data(data).cpu()
 
@@ -107,13 +101,9 @@ class JHUPredictor(nnUNetPredictor):
                     # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
                     #                               self.dataset_json, ofile, save_probabilities)
                     print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits_singleFiles,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
+                    export_executor.submit(export_prediction_from_logits_singleFiles,
+                                           prediction, properties, self.configuration_manager, self.plans_manager,
+                                           self.dataset_json, ofile, save_probabilities)
                 else:
                     # convert_predicted_logits_to_segmentation_with_correct_shape(
                     #             prediction, self.plans_manager,
@@ -122,20 +112,16 @@ class JHUPredictor(nnUNetPredictor):
                     #              save_probabilities)
 
                     print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
+                    export_executor.submit(convert_predicted_logits_to_segmentation_with_correct_shape,
+                                           prediction, self.plans_manager,
+                                           self.configuration_manager, self.label_manager,
+                                           properties,
+                                           save_probabilities)
                 if ofile is not None:
                     print(f'done with {os.path.basename(ofile)}')
                 else:
                     print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+            ret = export_executor.get_results()
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -3,7 +3,7 @@ import queue
 from torch.multiprocessing import Event, Process, Queue, Manager
 
 from time import sleep
-from typing import Union, List
+from typing import Union, List, Callable
 
 import numpy as np
 import torch
@@ -14,34 +14,40 @@ from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
-def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
-                                       list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                       output_filenames_truncated: Union[None, List[str]],
-                                       plans_manager: PlansManager,
-                                       dataset_json: dict,
-                                       configuration_manager: ConfigurationManager,
-                                       target_queue: Queue,
-                                       done_event: Event,
-                                       abort_event: Event,
-                                       verbose: bool = False):
-    try:
-        label_manager = plans_manager.get_label_manager(dataset_json)
-        preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
-        for idx in range(len(list_of_lists)):
-            data, seg, data_properties = preprocessor.run_case(list_of_lists[idx],
-                                                               list_of_segs_from_prev_stage_files[
-                                                                   idx] if list_of_segs_from_prev_stage_files is not None else None,
-                                                               plans_manager,
-                                                               configuration_manager,
-                                                               dataset_json)
-            if list_of_segs_from_prev_stage_files is not None and list_of_segs_from_prev_stage_files[idx] is not None:
-                seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
-                data = np.vstack((data, seg_onehot))
+class CasePreprocessorFromFiles(object):
+    def __init__(self, plans_manager: PlansManager, dataset_json: dict, configuration_manager: ConfigurationManager,
+                 verbose: bool = False):
+        """
+        Picklable callable that turns (files, seg_from_prev_stage_file, output_filename_truncated) into the item
+        yielded by preprocessing_iterator. The preprocessor is only instantiated once we are in the worker
+        """
+        self.plans_manager, self.dataset_json, self.configuration_manager, self.verbose = \
+            plans_manager, dataset_json, configuration_manager, verbose
+        self.preprocessor = None
+        self.label_manager = None
+
+    def __call__(self, files: List[str], seg_prev_stage_file: Union[None, str], ofile: Union[None, str]) -> dict:
+        if self.preprocessor is None:
+            self.preprocessor = self.configuration_manager.preprocessor_class(verbose=self.verbose)
+            self.label_manager = self.plans_manager.get_label_manager(self.dataset_json)
+        data, seg, data_properties = self.preprocessor.run_case(files, seg_prev_stage_file, self.plans_manager,
+                                                                self.configuration_manager, self.dataset_json)
+        if seg_prev_stage_file is not None:
+            seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
+            data = np.vstack((data, seg_onehot))
 
-            data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+        data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+        return {'data': data, 'data_properties': data_properties, 'ofile': ofile}
 
-            item = {'data': data, 'data_properties': data_properties,
-                    'ofile': output_filenames_truncated[idx] if output_filenames_truncated is not None else None}
+
+def preprocess_cases_save_to_queue(preprocess_case: Callable,
+                                   cases: List[tuple],
+                                   target_queue: Queue,
+                                   done_event: Event,
+                                   abort_event: Event):
+    try:
+        for case in cases:
+            item = preprocess_case(*case)
             success = False
             while not success:
                 try:
@@ -58,18 +64,25 @@ def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
         raise e
 
 
-def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
-                                     list_of_segs_from_prev_stage_files: Union[None, List[str]],
-                                     output_filenames_truncated: Union[None, List[str]],
-                                     plans_manager: PlansManager,
-                                     dataset_json: dict,
-                                     configuration_manager: ConfigurationManager,
-                                     num_processes: int,
-                                     pin_memory: bool = False,
-                                     verbose: bool = False):
+def _pin_memory(item: dict):
+    for v in item.values():
+        if isinstance(v, torch.Tensor):
+            v.pin_memory()
+        elif isinstance(v, (list, tuple)):
+            [i.pin_memory() for i in v if isinstance(i, torch.Tensor)]
+
+
+def preprocessing_iterator(preprocess_case: Callable,
+                           cases: List[tuple],
+                           num_processes: int,
+                           pin_memory: bool = False):
+    """
+    Runs preprocess_case(*case) for all cases in num_processes background workers and yields the resulting items in
+    the order of cases. preprocess_case must be picklable (workers are spawned) and return a dict
+    """
     context = multiprocessing.get_context('spawn')
     manager = Manager()
-    num_processes = min(len(list_of_lists), num_processes)
+    num_processes = min(len(cases), num_processes)
     assert num_processes >= 1
     processes = []
     done_events = []
@@ -77,48 +90,79 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
     abort_event = manager.Event()
     for i in range(num_processes):
         event = manager.Event()
-        queue = Manager().Queue(maxsize=1)
-        pr = context.Process(target=preprocess_fromfiles_save_to_queue,
-                     args=(
-                         list_of_lists[i::num_processes],
-                         list_of_segs_from_prev_stage_files[
-                         i::num_processes] if list_of_segs_from_prev_stage_files is not None else None,
-                         output_filenames_truncated[
-                         i::num_processes] if output_filenames_truncated is not None else None,
-                         plans_manager,
-                         dataset_json,
-                         configuration_manager,
-                         queue,
-                         event,
-                         abort_event,
-                         verbose
-                     ), daemon=True)
+        q = manager.Queue(maxsize=1)
+        pr = context.Process(target=preprocess_cases_save_to_queue,
+                             args=(preprocess_case, cases[i::num_processes], q, event, abort_event),
+                             daemon=True)
         pr.start()
-        target_queues.append(queue)
+        target_queues.append(q)
         done_events.append(event)
         processes.append(pr)
 
     worker_ctr = 0
-    while (not done_events[worker_ctr].is_set()) or (not target_queues[worker_ctr].empty()):
-        # import IPython;IPython.embed()
-        if not target_queues[worker_ctr].empty():
-            item = target_queues[worker_ctr].get()
-            worker_ctr = (worker_ctr + 1) % num_processes
-        else:
+    while True:
+        try:
+            # block on the worker whose turn it is. The timeout only exists so that we notice dead workers
+            item = target_queues[worker_ctr].get(timeout=1)
+        except queue.Empty:
+            # workers set their done event only after their last item was put into the queue
+            if done_events[worker_ctr].is_set() and target_queues[worker_ctr].empty():
+                break
             all_ok = all(
                 [i.is_alive() or j.is_set() for i, j in zip(processes, done_events)]) and not abort_event.is_set()
             if not all_ok:
                 raise RuntimeError('Background workers died. Look for the error message further up! If there is '
                                    'none then your RAM was full and the worker was killed by the OS. Use fewer '
                                    'workers or get more RAM in that case!')
-            sleep(0.01)
             continue
+        worker_ctr = (worker_ctr + 1) % num_processes
         if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
+            _pin_memory(item)
         yield item
     [p.join() for p in processes]
 
 
+def _cases_fromfiles(list_of_lists: List[List[str]],
+                     list_of_segs_from_prev_stage_files: Union[None, List[str]],
+                     output_filenames_truncated: Union[None, List[str]]) -> List[tuple]:
+    if list_of_segs_from_prev_stage_files is None:
+        list_of_segs_from_prev_stage_files = [None] * len(list_of_lists)
+    if output_filenames_truncated is None:
+        output_filenames_truncated = [None] * len(list_of_lists)
+    return list(zip(list_of_lists, list_of_segs_from_prev_stage_files, output_filenames_truncated))
+
+
+def preprocess_fromfiles_save_to_queue(list_of_lists: List[List[str]],
+                                       list_of_segs_from_prev_stage_files: Union[None, List[str]],
+                                       output_filenames_truncated: Union[None, List[str]],
+                                       plans_manager: PlansManager,
+                                       dataset_json: dict,
+                                       configuration_manager: ConfigurationManager,
+                                       target_queue: Queue,
+                                       done_event: Event,
+                                       abort_event: Event,
+                                       verbose: bool = False):
+    cases = _cases_fromfiles(list_of_lists, list_of_segs_from_prev_stage_files, output_filenames_truncated)
+    preprocess_cases_save_to_queue(CasePreprocessorFromFiles(plans_manager, dataset_json, configuration_manager,
+                                                             verbose),
+                                   cases, target_queue, done_event, abort_event)
+
+
+def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
+                                     list_of_segs_from_prev_stage_files: Union[None, List[str]],
+                                     output_filenames_truncated: Union[None, List[str]],
+                                     plans_manager: PlansManager,
+                                     dataset_json: dict,
+                                     configuration_manager: ConfigurationManager,
+                                     num_processes: int,
+                                     pin_memory: bool = False,
+                                     verbose: bool = False):
+    return preprocessing_iterator(
+        CasePreprocessorFromFiles(plans_manager, dataset_json, configuration_manager, verbose),
+        _cases_fromfiles(list_of_lists, list_of_segs_from_prev_stage_files, output_filenames_truncated),
+        num_processes, pin_memory)
+
+
 class PreprocessAdapter(DataLoader):
     def __init__(self, list_of_lists: List[List[str]],
                  list_of_segs_from_prev_stage_files: Union[None, List[str]],
@@ -1,6 +1,6 @@
 import os
 from copy import deepcopy
-from typing import Union, List
+from typing import Union, List, Optional
 
 import numpy as np
 import torch
@@ -8,17 +8,95 @@ from acvl_utils.cropping_and_padding.bounding_boxes import bounding_box_to_slice
 from batchgenerators.utilities.file_and_folder_operations import load_json, isfile, save_pickle
 
 from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.probability_store import get_probability_store
 from nnunetv2.utilities.label_handling.label_handling import LabelManager
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
 
 
+def convert_predicted_logits_to_segmentation_chunked(predicted_logits: Union[torch.Tensor, np.ndarray],
+                                                     plans_manager: PlansManager,
+                                                     configuration_manager: ConfigurationManager,
+                                                     label_manager: LabelManager,
+                                                     properties_dict: dict,
+                                                     num_classes_per_chunk: int = 4,
+                                                     num_threads_torch: int = default_num_processes) -> np.ndarray:
+    """
+    Memory saving variant of convert_predicted_logits_to_segmentation_with_correct_shape (without
+    return_probabilities). Instead of resampling all C logit channels at once we resample num_classes_per_chunk
+    channels at a time and keep a running max/argmax. Peak memory is therefore num_classes_per_chunk x volume instead
+    of C x volume (+ softmax copy). Softmax is skipped because it does not change the argmax.
+
+    Resampling operates on each channel independently and ties are resolved in favor of the lower class index (just
+    like argmax), so the segmentation is identical to the one of the default path. The only theoretical exception are
+    logits that differ by less than float32 precision after exp() (softmax would map them to the same value). This
+    does not happen with the fp16 logits produced by nnUNetPredictor.
+
+    Not applicable to region based training (sigmoid + thresholds per region, not an argmax).
+    """
+    assert not label_manager.has_regions, 'chunked export is not implemented for region based training'
+    old_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads_torch)
+
+    spacing_transposed = [properties_dict['spacing'][i] for i in plans_manager.transpose_forward]
+    current_spacing = configuration_manager.spacing if \
+        len(configuration_manager.spacing) == \
+        len(properties_dict['shape_after_cropping_and_before_resampling']) else \
+        [spacing_transposed[0], *configuration_manager.spacing]
+
+    segmentation = None
+    running_max = None
+    for c_start in range(0, predicted_logits.shape[0], num_classes_per_chunk):
+        chunk = configuration_manager.resampling_fn_probabilities(
+            predicted_logits[c_start:c_start + num_classes_per_chunk],
+            properties_dict['shape_after_cropping_and_before_resampling'],
+            current_spacing,
+            spacing_transposed)
+        if isinstance(chunk, torch.Tensor):
+            chunk = chunk.cpu().numpy()
+        chunk_argmax = chunk.argmax(0)
+        chunk_max = np.take_along_axis(chunk, chunk_argmax[None], 0)[0]
+        del chunk
+        if segmentation is None:
+            segmentation = chunk_argmax.astype(np.uint8 if len(label_manager.foreground_labels) < 255 else np.uint16)
+            running_max = chunk_max
+        else:
+            # strictly greater: on ties the lower class index wins, same as argmax
+            better = chunk_max > running_max
+            running_max[better] = chunk_max[better]
+            segmentation[better] = chunk_argmax[better] + c_start
+            del better
+        del chunk_max, chunk_argmax
+    del running_max
+
+    # put segmentation in bbox (revert cropping)
+    segmentation_reverted_cropping = np.zeros(properties_dict['shape_before_cropping'], dtype=segmentation.dtype)
+    slicer = bounding_box_to_slice(properties_dict['bbox_used_for_cropping'])
+    segmentation_reverted_cropping[slicer] = segmentation
+    del segmentation
+
+    # revert transpose
+    segmentation_reverted_cropping = segmentation_reverted_cropping.transpose(plans_manager.transpose_backward)
+    torch.set_num_threads(old_threads)
+    return segmentation_reverted_cropping
+
+
 def convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits: Union[torch.Tensor, np.ndarray],
                                                                 plans_manager: PlansManager,
                                                                 configuration_manager: ConfigurationManager,
                                                                 label_manager: LabelManager,
                                                                 properties_dict: dict,
                                                                 return_probabilities: bool = False,
-                                                                num_threads_torch: int = default_num_processes):
+                                                                num_threads_torch: int = default_num_processes,
+                                                                num_classes_per_chunk: Optional[int] = None):
+    """
+    num_classes_per_chunk: if set (and neither probabilities are requested nor regions are used) the logits are
+    resampled in chunks of this many classes, see convert_predicted_logits_to_segmentation_chunked
+    """
+    if num_classes_per_chunk is not None and not return_probabilities and not label_manager.has_regions:
+        return convert_predicted_logits_to_segmentation_chunked(predicted_logits, plans_manager,
+                                                                configuration_manager, label_manager,
+                                                                properties_dict, num_classes_per_chunk,
+                                                                num_threads_torch)
     old_threads = torch.get_num_threads()
     torch.set_num_threads(num_threads_torch)
 
@@ -73,7 +151,13 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
                                   configuration_manager: ConfigurationManager,
                                   plans_manager: PlansManager,
                                   dataset_json_dict_or_file: Union[dict, str], output_file_truncated: str,
-                                  save_probabilities: bool = False):
+                                  save_probabilities: bool = False,
+                                  num_classes_per_chunk: Optional[int] = None,
+                                  probabilities_format: str = 'npz'):
+    """
+    probabilities_format: how to store the probabilities if save_probabilities is set, see
+    nnunetv2.inference.probability_store.get_probability_store. Default 'npz' (the original format)
+    """
     # if isinstance(predicted_array_or_file, str):
     #     tmp = deepcopy(predicted_array_or_file)
     #     if predicted_array_or_file.endswith('.npy'):
@@ -88,14 +172,14 @@ def export_prediction_from_logits(predicted_array_or_file: Union[np.ndarray, tor
     label_manager = plans_manager.get_label_manager(dataset_json_dict_or_file)
     ret = convert_predicted_logits_to_segmentation_with_correct_shape(
         predicted_array_or_file, plans_manager, configuration_manager, label_manager, properties_dict,
-        return_probabilities=save_probabilities
+        return_probabilities=save_probabilities, num_classes_per_chunk=num_classes_per_chunk
     )
     del predicted_array_or_file
 
     # save
     if save_probabilities:
         segmentation_final, probabilities_final = ret
-        np.savez_compressed(output_file_truncated + '.npz', probabilities=probabilities_final)
+        get_probability_store(probabilities_format).save(probabilities_final, output_file_truncated)
         save_pickle(properties_dict, output_file_truncated + '.pkl')
         del probabilities_final, ret
     else:
@@ -0,0 +1,275 @@
+import multiprocessing
+import os
+from copy import deepcopy
+from typing import List, Union, Tuple, Optional
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p, isdir, save_json, save_pickle
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.data_iterators import preprocessing_iterator
+from nnunetv2.inference.export_prediction import convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.probability_store import get_probability_store
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import empty_cache
+from nnunetv2.utilities.label_handling.label_handling import LabelManager
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.task_executor import TaskExecutor
+
+
+class CasePreprocessorMultipleConfigurations(object):
+    def __init__(self, plans_managers: List[PlansManager], dataset_jsons: List[dict],
+                 configuration_managers: List[ConfigurationManager], verbose: bool = False):
+        """
+        Picklable callable for preprocessing_iterator. Reads each case once and then preprocesses it for every
+        configuration. The returned item has 'data' and 'data_properties' as lists (one entry per configuration)
+        """
+        self.plans_managers, self.dataset_jsons, self.configuration_managers, self.verbose = \
+            plans_managers, dataset_jsons, configuration_managers, verbose
+        self.preprocessors = None
+
+    def __call__(self, files: List[str], ofile: str) -> dict:
+        if self.preprocessors is None:
+            self.preprocessors = [c.preprocessor_class(verbose=self.verbose) for c in self.configuration_managers]
+        image, image_properties = self.plans_managers[0].image_reader_writer_class().read_images(files)
+        data = []
+        properties = []
+        for p, pm, dj, cm in zip(self.preprocessors, self.plans_managers, self.dataset_jsons,
+                                 self.configuration_managers):
+            # run_case_npy copies the image but writes into the properties, so each configuration gets its own
+            props = deepcopy(image_properties)
+            d, _ = p.run_case_npy(image, None, props, pm, cm, dj)
+            data.append(torch.from_numpy(d).to(dtype=torch.float32, memory_format=torch.contiguous_format))
+            properties.append(props)
+        return {'data': data, 'data_properties': properties, 'ofile': ofile}
+
+
+def export_ensemble_prediction_from_logits(list_of_logits: List[torch.Tensor],
+                                           list_of_properties: List[dict],
+                                           configuration_managers: List[ConfigurationManager],
+                                           plans_managers: List[PlansManager],
+                                           label_manager: LabelManager,
+                                           dataset_json: dict,
+                                           output_file_truncated: str,
+                                           weights: List[float],
+                                           save_probabilities: bool = False,
+                                           probabilities_format: str = 'npz'):
+    """
+    Resamples the logits of each configuration to the original image geometry, converts them to probabilities and
+    computes their weighted average. Only one configuration is held at original resolution at any time (plus the
+    running average). The segmentation is derived from the averaged probabilities, exactly as nnUNetv2_ensemble does
+    with the exported probability files.
+    """
+    avg = None
+    for i in range(len(list_of_logits)):
+        _, probabilities = convert_predicted_logits_to_segmentation_with_correct_shape(
+            list_of_logits[i], plans_managers[i], configuration_managers[i], label_manager, list_of_properties[i],
+            return_probabilities=True)
+        list_of_logits[i] = None
+        if avg is None:
+            avg = probabilities.astype(np.float32, copy=False) * weights[i]
+        else:
+            avg += probabilities * weights[i]
+        del probabilities
+    avg /= sum(weights)
+
+    segmentation = label_manager.convert_probabilities_to_segmentation(avg)
+    if isinstance(segmentation, torch.Tensor):
+        segmentation = segmentation.cpu().numpy()
+
+    if save_probabilities:
+        get_probability_store(probabilities_format).save(avg, output_file_truncated)
+        save_pickle(list_of_properties[0], output_file_truncated + '.pkl')
+    del avg
+
+    # the geometry of the original image is identical in all properties (same input image)
+    rw = plans_managers[0].image_reader_writer_class()
+    rw.write_seg(segmentation, output_file_truncated + dataset_json['file_ending'], list_of_properties[0])
+
+
+class nnUNetEnsemblePredictor(object):
+    def __init__(self, predictors: List[nnUNetPredictor], weights: Optional[List[float]] = None):
+        """
+        Ensembles several trained models (typically different configurations such as 2d and 3d_fullres) in memory.
+        Each case is read once, preprocessed for every configuration, predicted by every model and the resampled
+        probabilities are averaged before a single segmentation is written. Compared to predicting each
+        configuration with --save_probabilities and running nnUNetv2_ensemble this skips writing and reloading the
+        probabilities of every configuration.
+
+        All predictors must already be initialized and must predict the same labels. Cascaded configurations are
+        not supported (they need the segmentations of their previous stage as input).
+
+        weights: optional weight per predictor. Default: plain average (like nnUNetv2_ensemble)
+        """
+        assert len(predictors) > 0, 'need at least one predictor'
+        for p in predictors:
+            assert p.configuration_manager is not None, 'All predictors must be initialized'
+            if p.configuration_manager.previous_stage_name is not None:
+                raise RuntimeError(f'nnUNetEnsemblePredictor does not support cascaded configurations (got a '
+                                   f'configuration with previous stage '
+                                   f'{p.configuration_manager.previous_stage_name}).')
+            assert p.dataset_json['labels'] == predictors[0].dataset_json['labels'], \
+                'All models must have been trained on the same labels'
+            assert p.dataset_json['file_ending'] == predictors[0].dataset_json['file_ending'], \
+                'All models must use the same file ending'
+        if weights is None:
+            weights = [1] * len(predictors)
+        assert len(weights) == len(predictors), 'need exactly one weight per predictor'
+        self.predictors = predictors
+        self.weights = weights
+        self.dataset_json = predictors[0].dataset_json
+        self.label_manager = predictors[0].label_manager
+
+    @classmethod
+    def from_trained_model_folders(cls, list_of_model_training_output_dirs: List[str],
+                                   use_folds: Union[Tuple[Union[int, str]], None] = None,
+                                   checkpoint_name: str = 'checkpoint_final.pth',
+                                   weights: Optional[List[float]] = None,
+                                   **predictor_kwargs):
+        """
+        predictor_kwargs are passed to each nnUNetPredictor (tile_step_size, use_mirroring, device, ...)
+        """
+        predictors = []
+        for m in list_of_model_training_output_dirs:
+            predictor = nnUNetPredictor(**predictor_kwargs)
+            predictor.initialize_from_trained_model_folder(m, use_folds, checkpoint_name)
+            predictors.append(predictor)
+        return cls(predictors, weights)
+
+    def predict_from_files(self,
+                           list_of_lists_or_source_folder: Union[str, List[List[str]]],
+                           output_folder: str,
+                           save_probabilities: bool = False,
+                           overwrite: bool = True,
+                           num_processes_preprocessing: int = default_num_processes,
+                           num_processes_segmentation_export: int = default_num_processes,
+                           num_parts: int = 1,
+                           part_id: int = 0):
+        main_predictor = self.predictors[0]
+        maybe_mkdir_p(output_folder)
+        save_json(self.dataset_json, join(output_folder, 'dataset.json'), sort_keys=False)
+        save_json(main_predictor.plans_manager.plans, join(output_folder, 'plans.json'), sort_keys=False)
+
+        # the probability file format of the first predictor is used for the output
+        list_of_lists, output_filename_truncated, _ = main_predictor._manage_input_and_output_lists(
+            list_of_lists_or_source_folder, output_folder, None, overwrite, part_id, num_parts, save_probabilities)
+        if len(list_of_lists) == 0:
+            return
+
+        data_iterator = preprocessing_iterator(
+            CasePreprocessorMultipleConfigurations([p.plans_manager for p in self.predictors],
+                                                   [p.dataset_json for p in self.predictors],
+                                                   [p.configuration_manager for p in self.predictors],
+                                                   main_predictor.verbose_preprocessing),
+            list(zip(list_of_lists, output_filename_truncated)),
+            num_processes_preprocessing, main_predictor.device.type == 'cuda')
+        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export)
+
+    def predict_from_data_iterator(self, data_iterator, save_probabilities: bool = False,
+                                   num_processes_segmentation_export: int = default_num_processes):
+        """
+        each element returned by data_iterator must be a dict with 'data' and 'data_properties' (lists with one
+        entry per predictor) and 'ofile'
+        """
+        main_predictor = self.predictors[0]
+        # let's not get into a runaway situation where the GPU predicts so fast that the export can't keep up
+        with TaskExecutor(num_processes_segmentation_export, max_pending=num_processes_segmentation_export + 2,
+                          disable_progress_bar=True) as export_executor:
+            for preprocessed in data_iterator:
+                ofile = preprocessed['ofile']
+                print(f'\nPredicting {os.path.basename(ofile)}:')
+
+                export_executor.wait_for_capacity()
+
+                predictions = []
+                for p, data in zip(self.predictors, preprocessed['data']):
+                    predictions.append(p.predict_logits_from_preprocessed_data(data).cpu())
+
+                print('sending off prediction to background worker for resampling, averaging and export')
+                export_executor.submit(export_ensemble_prediction_from_logits,
+                                       predictions, preprocessed['data_properties'],
+                                       [p.configuration_manager for p in self.predictors],
+                                       [p.plans_manager for p in self.predictors],
+                                       self.label_manager, self.dataset_json, ofile, self.weights, save_probabilities,
+                                       main_predictor.probabilities_format)
+                print(f'done with {os.path.basename(ofile)}')
+            export_executor.get_results()
+
+        compute_gaussian.cache_clear()
+        empty_cache(main_predictor.device)
+
+
+def predict_ensemble_entry_point():
+    import argparse
+    parser = argparse.ArgumentParser(description='Predicts with several trained models (for example different '
+                                                 'configurations of the same dataset) and ensembles them in memory. '
+                                                 'Equivalent to running nnUNetv2_predict with --save_probabilities '
+                                                 'for each model followed by nnUNetv2_ensemble, but without writing '
+                                                 'and reloading the probabilities.')
+    parser.add_argument('-i', type=str, required=True,
+                        help='input folder. Remember to use the correct channel numberings for your files (_0000 etc). '
+                             'File endings must be the same as the training dataset!')
+    parser.add_argument('-o', type=str, required=True,
+                        help='Output folder. If it does not exist it will be created.')
+    parser.add_argument('-m', nargs='+', type=str, required=True,
+                        help='Folders in which the trained models are. Each must have subfolders fold_X for the '
+                             'different folds you trained')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained models that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-w', nargs='+', type=float, required=False, default=None,
+                        help='[OPTIONAL] One weight per model in -m. Default: equal weights')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('--verbose', action='store_true')
+    parser.add_argument('--save_probabilities', action='store_true',
+                        help='Set this to export the averaged class probabilities')
+    parser.add_argument('-probabilities_format', type=str, required=False, default='npz',
+                        help='[OPTIONAL] File format for --save_probabilities. See nnUNetv2_predict -h')
+    parser.add_argument('--continue_prediction', action='store_true',
+                        help='Continue an aborted previous prediction (will not overwrite existing files)')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Each process preprocesses a case for all '
+                             'models, so RAM usage per process is higher than with nnUNetv2_predict. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for resampling, averaging and export. Default: 3')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    if not isdir(args.o):
+        maybe_mkdir_p(args.o)
+
+    assert args.device in ['cpu', 'cuda', 'mps'], \
+        f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
+    if args.device == 'cpu':
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    ensemble_predictor = nnUNetEnsemblePredictor.from_trained_model_folders(
+        args.m, args.f, args.chk, args.w,
+        tile_step_size=args.step_size, use_gaussian=True, use_mirroring=not args.disable_tta,
+        perform_everything_on_device=True, device=device, verbose=args.verbose, verbose_preprocessing=args.verbose,
+        probabilities_format=args.probabilities_format)
+    ensemble_predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
+                                          overwrite=not args.continue_prediction,
+                                          num_processes_preprocessing=args.npp,
+                                          num_processes_segmentation_export=args.nps)
+
+
+if __name__ == '__main__':
+    predict_ensemble_entry_point()
@@ -1,9 +1,8 @@
 import inspect
 import itertools
-import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from time import sleep
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
@@ -23,14 +22,17 @@ from nnunetv2.inference.data_iterators import PreprocessAdapterFromNpy, preproce
     preprocessing_iterator_fromnpy
 from nnunetv2.inference.export_prediction import export_prediction_from_logits, \
     convert_predicted_logits_to_segmentation_with_correct_shape
+from nnunetv2.inference.probability_store import get_probability_store
 from nnunetv2.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
-from nnunetv2.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+from nnunetv2.utilities.file_path_utilities import get_output_folder
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
 from nnunetv2.utilities.helpers import empty_cache, dummy_context
 from nnunetv2.utilities.json_export import recursive_fix_for_json_export
-from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels
+from nnunetv2.utilities.label_handling.label_handling import determine_num_input_channels, \
+    convert_labelmap_to_one_hot
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.task_executor import TaskExecutor
 from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
@@ -43,7 +45,17 @@ class nnUNetPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 export_num_classes_per_chunk: Optional[int] = None,
+                 probabilities_format: str = 'npz'):
+        """
+        export_num_classes_per_chunk: if set, the export resamples the logits this many classes at a time and keeps a
+        running argmax instead of resampling all classes at once. Same segmentations, much lower peak RAM for datasets
+        with many classes. Only used when no probabilities are exported and no regions are used.
+
+        probabilities_format: file format used when probabilities are saved. See
+        nnunetv2.inference.probability_store.get_probability_store
+        """
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -61,6 +73,14 @@ class nnUNetPredictor(object):
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        self.export_num_classes_per_chunk = export_num_classes_per_chunk
+        # fail early on typos
+        get_probability_store(probabilities_format)
+        self.probabilities_format = probabilities_format
+
+        # used by predict_single_npy_array_fast. Created on first use and then reused across calls
+        self._single_case_preprocessor = None
+        self._single_case_export_executor = None
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -116,6 +136,7 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._single_case_preprocessor = None
         if ('nnUNet_compile' in os.environ.keys()) and (os.environ['nnUNet_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('Using torch.compile')
@@ -136,6 +157,7 @@ class nnUNetPredictor(object):
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._single_case_preprocessor = None
         allow_compile = True
         allow_compile = allow_compile and ('nnUNet_compile' in os.environ.keys()) and (
                     os.environ['nnUNet_compile'].lower() in ('true', '1', 't'))
@@ -185,7 +207,8 @@ class nnUNetPredictor(object):
         if not overwrite and output_filename_truncated is not None:
             tmp = [isfile(i + self.dataset_json['file_ending']) for i in output_filename_truncated]
             if save_probabilities:
-                tmp2 = [isfile(i + '.npz') for i in output_filename_truncated]
+                probabilities_file_ending = get_probability_store(self.probabilities_format).file_ending
+                tmp2 = [isfile(i + probabilities_file_ending) for i in output_filename_truncated]
                 tmp = [i and j for i, j in zip(tmp, tmp2)]
             not_existing_indices = [i for i, j in enumerate(tmp) if not j]
 
@@ -345,9 +368,10 @@ class nnUNetPredictor(object):
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
         """
-        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-            worker_list = [i for i in export_pool._pool]
-            r = []
+        # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+        # npy files: at most 2 predictions wait for a free export worker
+        with TaskExecutor(num_processes_segmentation_export, max_pending=num_processes_segmentation_export + 2,
+                          disable_progress_bar=True) as export_executor:
             for preprocessed in data_iterator:
                 data = preprocessed['data']
                 if isinstance(data, str):
@@ -365,12 +389,7 @@ class nnUNetPredictor(object):
 
                 properties = preprocessed['data_properties']
 
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
+                export_executor.wait_for_capacity()
 
                 prediction = self.predict_logits_from_preprocessed_data(data).cpu()
 
@@ -379,13 +398,10 @@ class nnUNetPredictor(object):
                     # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
                     #                               self.dataset_json, ofile, save_probabilities)
                     print('sending off prediction to background worker for resampling and export')
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((prediction, properties, self.configuration_manager, self.plans_manager,
-                              self.dataset_json, ofile, save_probabilities),)
-                        )
-                    )
+                    export_executor.submit(export_prediction_from_logits,
+                                           prediction, properties, self.configuration_manager, self.plans_manager,
+                                           self.dataset_json, ofile, save_probabilities,
+                                           self.export_num_classes_per_chunk, self.probabilities_format)
                 else:
                     # convert_predicted_logits_to_segmentation_with_correct_shape(
                     #             prediction, self.plans_manager,
@@ -394,20 +410,19 @@ class nnUNetPredictor(object):
                     #              save_probabilities)
 
                     print('sending off prediction to background worker for resampling')
-                    r.append(
-                        export_pool.starmap_async(
-                            convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                (prediction, self.plans_manager,
-                                 self.configuration_manager, self.label_manager,
-                                 properties,
-                                 save_probabilities),)
-                        )
-                    )
+                    export_executor.submit(convert_predicted_logits_to_segmentation_with_correct_shape,
+                                           prediction, self.plans_manager,
+                                           self.configuration_manager, self.label_manager,
+                                           properties,
+                                           save_probabilities, default_num_processes,
+                                           self.export_num_classes_per_chunk)
                 if ofile is not None:
                     print(f'done with {os.path.basename(ofile)}')
                 else:
                     print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+            ret = export_executor.get_results()
+            if self.verbose:
+                print(f'export: {export_executor.timing_summary()}')
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
@@ -424,6 +439,7 @@ class nnUNetPredictor(object):
                                  save_or_return_probabilities: bool = False):
         """
         WARNING: SLOW. ONLY USE THIS IF YOU CANNOT GIVE NNUNET MULTIPLE IMAGES AT ONCE FOR SOME REASON.
+        If you have to predict one image at a time (interactive tools etc), use predict_single_npy_array_fast instead.
 
 
         input_image: Make sure to load the image in the way nnU-Net expects! nnU-Net is trained on a certain axis
@@ -452,19 +468,83 @@ class nnUNetPredictor(object):
         if output_file_truncated is not None:
             export_prediction_from_logits(predicted_logits, dct['data_properties'], self.configuration_manager,
                                           self.plans_manager, self.dataset_json, output_file_truncated,
-                                          save_or_return_probabilities)
+                                          save_or_return_probabilities, self.export_num_classes_per_chunk,
+                                          self.probabilities_format)
         else:
             ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
                                                                               self.configuration_manager,
                                                                               self.label_manager,
                                                                               dct['data_properties'],
                                                                               return_probabilities=
-                                                                              save_or_return_probabilities)
+                                                                              save_or_return_probabilities,
+                                                                              num_classes_per_chunk=
+                                                                              self.export_num_classes_per_chunk)
             if save_or_return_probabilities:
                 return ret[0], ret[1]
             else:
                 return ret
 
+    def predict_single_npy_array_fast(self, input_image: np.ndarray, image_properties: dict,
+                                      segmentation_previous_stage: np.ndarray = None,
+                                      output_file_truncated: str = None,
+                                      save_or_return_probabilities: bool = False):
+        """
+        Returns:
+        - output_file_truncated is None: same as predict_single_npy_array (the segmentation, or segmentation and
+          probabilities if save_or_return_probabilities)
+        - output_file_truncated given: a concurrent.futures.Future, NOT None like predict_single_npy_array. The export
+          runs in a background thread (reused across calls), call .result() on the future if you need to wait for the
+          file to be written (it also re-raises export errors). Preprocessing and prediction of the next image overlap
+          with the export of the previous one that way.
+
+        Same inputs as predict_single_npy_array, but without the batchgenerators DataLoader detour: preprocessing runs
+        directly in this process (the preprocessor instance is reused between calls), followed by the sliding window
+        prediction and resampling/export. Use this if you predict one image at a time, for example from an interactive
+        tool, where the per call overhead matters more than throughput.
+        """
+        if self._single_case_preprocessor is None:
+            self._single_case_preprocessor = self.configuration_manager.preprocessor_class(
+                verbose=self.verbose_preprocessing)
+        if self.verbose:
+            print('preprocessing')
+        data, seg = self._single_case_preprocessor.run_case_npy(input_image, segmentation_previous_stage,
+                                                                image_properties, self.plans_manager,
+                                                                self.configuration_manager, self.dataset_json)
+        if segmentation_previous_stage is not None:
+            seg_onehot = convert_labelmap_to_one_hot(seg[0], self.label_manager.foreground_labels, data.dtype)
+            data = np.vstack((data, seg_onehot))
+        data = torch.from_numpy(data).to(dtype=torch.float32, memory_format=torch.contiguous_format)
+
+        if self.verbose:
+            print('predicting')
+        predicted_logits = self.predict_logits_from_preprocessed_data(data).cpu()
+        del data
+
+        if output_file_truncated is not None:
+            if self.verbose:
+                print('sending off prediction to export thread')
+            if self._single_case_export_executor is None:
+                self._single_case_export_executor = ThreadPoolExecutor(max_workers=1)
+            return self._single_case_export_executor.submit(
+                export_prediction_from_logits, predicted_logits, image_properties, self.configuration_manager,
+                self.plans_manager, self.dataset_json, output_file_truncated, save_or_return_probabilities,
+                self.export_num_classes_per_chunk, self.probabilities_format)
+
+        if self.verbose:
+            print('resampling to original shape')
+        ret = convert_predicted_logits_to_segmentation_with_correct_shape(predicted_logits, self.plans_manager,
+                                                                          self.configuration_manager,
+                                                                          self.label_manager,
+                                                                          image_properties,
+                                                                          return_probabilities=
+                                                                          save_or_return_probabilities,
+                                                                          num_classes_per_chunk=
+                                                                          self.export_num_classes_per_chunk)
+        if save_or_return_probabilities:
+            return ret[0], ret[1]
+        else:
+            return ret
+
     def predict_logits_from_preprocessed_data(self, data: torch.Tensor) -> torch.Tensor:
         """
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
@@ -707,6 +787,14 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-export_class_chunk_size', type=int, required=False, default=None,
+                        help='[OPTIONAL] Resample the predicted logits in chunks of this many classes during export '
+                             'and keep a running argmax. Same segmentations, much lower RAM usage for datasets with '
+                             'many classes. Ignored with --save_probabilities and for region based models.')
+    parser.add_argument('-probabilities_format', type=str, required=False, default='npz',
+                        help='[OPTIONAL] File format for --save_probabilities. npz (default, slow, compressed), npy '
+                             '(uncompressed, memory mappable) or blosc2 (fast multithreaded compression, requires '
+                             'the blosc2 package). Append _fp16 to store half precision, e.g. npy_fp16.')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -743,7 +831,9 @@ def predict_entry_point_modelfolder():
                                 device=device,
                                 verbose=args.verbose,
                                 allow_tqdm=not args.disable_progress_bar,
-                                verbose_preprocessing=args.verbose)
+                                verbose_preprocessing=args.verbose,
+                                export_num_classes_per_chunk=args.export_class_chunk_size,
+                                probabilities_format=args.probabilities_format)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
@@ -816,6 +906,14 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
+    parser.add_argument('-export_class_chunk_size', type=int, required=False, default=None,
+                        help='[OPTIONAL] Resample the predicted logits in chunks of this many classes during export '
+                             'and keep a running argmax. Same segmentations, much lower RAM usage for datasets with '
+                             'many classes. Ignored with --save_probabilities and for region based models.')
+    parser.add_argument('-probabilities_format', type=str, required=False, default='npz',
+                        help='[OPTIONAL] File format for --save_probabilities. npz (default, slow, compressed), npy '
+                             '(uncompressed, memory mappable) or blosc2 (fast multithreaded compression, requires '
+                             'the blosc2 package). Append _fp16 to store half precision, e.g. npy_fp16.')
 
     print(
         "\n#######################################################################\nPlease cite the following paper "
@@ -857,7 +955,9 @@ def predict_entry_point():
                                 device=device,
                                 verbose=args.verbose,
                                 verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
+                                allow_tqdm=not args.disable_progress_bar,
+                                export_num_classes_per_chunk=args.export_class_chunk_size,
+                                probabilities_format=args.probabilities_format)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
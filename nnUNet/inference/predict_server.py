@@ -0,0 +1,587 @@
+import http.client
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import threading
+import traceback
+import uuid
+from concurrent.futures import ProcessPoolExecutor, Future
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+from typing import List, Union, Optional
+
+import numpy as np
+import torch
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p
+
+from nnunetv2.configuration import default_num_processes
+from nnunetv2.inference.export_prediction import export_prediction_from_logits
+from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
+from nnunetv2.inference.sliding_window_prediction import compute_gaussian
+from nnunetv2.utilities.helpers import empty_cache
+from nnunetv2.utilities.label_handling.label_handling import convert_labelmap_to_one_hot
+from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.task_executor import WORKER_DIED_MESSAGE
+
+# these are set once per preprocessing worker by _init_preprocessing_worker so that we don't have to send the plans
+# with every single request
+_worker_plans_manager = None
+_worker_configuration_manager = None
+_worker_dataset_json = None
+_worker_preprocessor = None
+
+
+def _init_preprocessing_worker(plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                               dataset_json: dict, verbose: bool = False):
+    global _worker_plans_manager, _worker_configuration_manager, _worker_dataset_json, _worker_preprocessor
+    _worker_plans_manager = plans_manager
+    _worker_configuration_manager = configuration_manager
+    _worker_dataset_json = dataset_json
+    _worker_preprocessor = configuration_manager.preprocessor_class(verbose=verbose)
+
+
+def _preprocess_case_in_worker(input_files: List[str], seg_from_prev_stage_file: Union[str, None]):
+    start = time()
+    data, seg, data_properties = _worker_preprocessor.run_case(input_files, seg_from_prev_stage_file,
+                                                               _worker_plans_manager, _worker_configuration_manager,
+                                                               _worker_dataset_json)
+    if seg_from_prev_stage_file is not None:
+        label_manager = _worker_plans_manager.get_label_manager(_worker_dataset_json)
+        seg_onehot = convert_labelmap_to_one_hot(seg[0], label_manager.foreground_labels, data.dtype)
+        data = np.vstack((data, seg_onehot))
+    return data.astype(np.float32, copy=False), data_properties, time() - start
+
+
+def _export_in_worker(prediction, properties, configuration_manager, plans_manager, dataset_json,
+                      output_file_truncated, save_probabilities, num_classes_per_chunk=None,
+                      probabilities_format='npz'):
+    start = time()
+    export_prediction_from_logits(prediction, properties, configuration_manager, plans_manager, dataset_json,
+                                  output_file_truncated, save_probabilities, num_classes_per_chunk,
+                                  probabilities_format)
+    return time() - start
+
+
+class PredictionJob(object):
+    def __init__(self, input_files: List[str], output_file_truncated: str, save_probabilities: bool = False,
+                 seg_from_prev_stage_file: Optional[str] = None):
+        self.job_id = uuid.uuid4().hex
+        self.input_files = input_files
+        self.output_file_truncated = output_file_truncated
+        self.save_probabilities = save_probabilities
+        self.seg_from_prev_stage_file = seg_from_prev_stage_file
+        self.status = 'queued'
+        self.error = None
+        self.timings = {'submitted': time()}
+        self.done_event = threading.Event()
+
+    def finish(self, error: Optional[str] = None):
+        self.status = 'failed' if error is not None else 'done'
+        self.error = error
+        self.timings['finished'] = time()
+        self.done_event.set()
+
+    def to_dict(self) -> dict:
+        timings = {k: v for k, v in self.timings.items() if k not in ('submitted', 'finished')}
+        if 'finished' in self.timings:
+            timings['total'] = self.timings['finished'] - self.timings['submitted']
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'error': self.error,
+            'output_file_truncated': self.output_file_truncated,
+            'timings': timings
+        }
+
+
+class StageTimer(object):
+    """
+    Thread safe bookkeeping of how long the individual stages (queue, preprocessing, prediction, export) take
+    """
+    def __init__(self, stages=('queue', 'preprocessing', 'prediction', 'export', 'total')):
+        self._lock = threading.Lock()
+        self._stats = {s: {'count': 0, 'total': 0., 'max': 0., 'last': None} for s in stages}
+
+    def add(self, stage: str, duration: float):
+        with self._lock:
+            s = self._stats[stage]
+            s['count'] += 1
+            s['total'] += duration
+            s['max'] = max(s['max'], duration)
+            s['last'] = duration
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {k: {'count': v['count'],
+                        'mean': v['total'] / v['count'] if v['count'] > 0 else None,
+                        'max': v['max'],
+                        'last': v['last']} for k, v in self._stats.items()}
+
+
+class nnUNetPredictionServer(object):
+    def __init__(self, predictor: nnUNetPredictor,
+                 num_processes_preprocessing: int = default_num_processes,
+                 num_processes_segmentation_export: int = default_num_processes,
+                 max_batch_size: int = 4,
+                 max_num_job_records: int = 1000,
+                 max_pending_exports: Optional[int] = None):
+        """
+        Keeps an initialized nnUNetPredictor (network on device, all fold parameters in RAM) as well as the
+        preprocessing and export worker pools alive between requests. Jobs are queued and the scheduler thread takes
+        up to max_batch_size of them at once. Preprocessing of all jobs in a batch is started immediately so that the
+        GPU never has to wait for the next case while the previous one is being exported.
+
+        The GPU is only ever used by the scheduler thread.
+
+        max_pending_exports: the scheduler blocks while this many predictions (full logit tensors!) are waiting for or
+        being exported, default 2 x num_processes_segmentation_export. Without this limit, memory grows without bound
+        whenever the GPU is faster than the export.
+        If a worker dies (OOM killer) the jobs it was part of fail with an error and the pool is restarted, the server
+        keeps running. The same goes for any other error while processing a job. Should the scheduler thread itself
+        die, all queued jobs fail and submit raises
+        """
+        assert predictor.network is not None, 'predictor must be initialized (initialize_from_trained_model_folder)'
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_num_job_records = max_num_job_records
+        self.num_processes_preprocessing = num_processes_preprocessing
+        self.num_processes_segmentation_export = num_processes_segmentation_export
+        self.max_pending_exports = max_pending_exports if max_pending_exports is not None else \
+            2 * num_processes_segmentation_export
+
+        self.job_queue = queue.Queue()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.num_in_flight = 0
+        self.stage_timer = StageTimer()
+
+        self.preprocessing_pool = None
+        self.export_pool = None
+        self._export_slots = threading.BoundedSemaphore(self.max_pending_exports)
+        self.num_pending_exports = 0
+        self._scheduler_thread = None
+        self._scheduler_error = None
+        self._stop_event = threading.Event()
+
+    def _create_preprocessing_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            self.num_processes_preprocessing, mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_preprocessing_worker,
+            initargs=(self.predictor.plans_manager, self.predictor.configuration_manager,
+                      self.predictor.dataset_json, self.predictor.verbose_preprocessing))
+
+    def _create_export_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(self.num_processes_segmentation_export,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def _submit_preprocessing(self, *args) -> Future:
+        # unlike multiprocessing.Pool, ProcessPoolExecutor notices dead workers (the futures raise BrokenProcessPool
+        # instead of never finishing). A broken pool accepts no more work, so it is replaced
+        try:
+            return self.preprocessing_pool.submit(_preprocess_case_in_worker, *args)
+        except BrokenProcessPool:
+            self.preprocessing_pool.shutdown(wait=False)
+            self.preprocessing_pool = self._create_preprocessing_pool()
+            return self.preprocessing_pool.submit(_preprocess_case_in_worker, *args)
+
+    def _submit_export(self, *args) -> Future:
+        try:
+            return self.export_pool.submit(_export_in_worker, *args)
+        except BrokenProcessPool:
+            self.export_pool.shutdown(wait=False)
+            self.export_pool = self._create_export_pool()
+            return self.export_pool.submit(_export_in_worker, *args)
+
+    def start(self):
+        self.preprocessing_pool = self._create_preprocessing_pool()
+        self.export_pool = self._create_export_pool()
+        self._stop_event.clear()
+        self._scheduler_error = None
+        self._scheduler_thread = threading.Thread(target=self._scheduler_loop, daemon=True)
+        self._scheduler_thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._scheduler_thread is not None:
+            self._scheduler_thread.join()
+        for p in (self.preprocessing_pool, self.export_pool):
+            if p is not None:
+                p.shutdown(wait=True)
+        self.preprocessing_pool = self.export_pool = None
+        compute_gaussian.cache_clear()
+        empty_cache(self.predictor.device)
+
+    def submit(self, input_files: List[str], output_file_truncated: str, save_probabilities: bool = False,
+               seg_from_prev_stage_file: Optional[str] = None) -> PredictionJob:
+        if self.predictor.configuration_manager.previous_stage_name is not None:
+            assert seg_from_prev_stage_file is not None, \
+                f'The requested configuration is a cascaded network. It requires the segmentation of the previous ' \
+                f'stage ({self.predictor.configuration_manager.previous_stage_name}) as input'
+        if self._scheduler_error is not None:
+            raise RuntimeError('The scheduler of the prediction server died, restart the server') \
+                from self._scheduler_error
+        job = PredictionJob(input_files, output_file_truncated, save_probabilities, seg_from_prev_stage_file)
+        with self.jobs_lock:
+            # this is a long running process. Don't keep the records of finished jobs forever
+            if len(self.jobs) >= self.max_num_job_records:
+                finished = [k for k, j in self.jobs.items() if j.done_event.is_set()]
+                for k in finished[:len(finished) // 2 + 1]:
+                    del self.jobs[k]
+            self.jobs[job.job_id] = job
+        self.job_queue.put(job)
+        return job
+
+    def get_job(self, job_id: str) -> Union[PredictionJob, None]:
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.job_queue.qsize(),
+            'in_flight': self.num_in_flight,
+            'pending_exports': self.num_pending_exports,
+            'max_pending_exports': self.max_pending_exports,
+            'max_batch_size': self.max_batch_size,
+            'stage_timings': self.stage_timer.summary()
+        }
+
+    def _next_batch(self) -> List[PredictionJob]:
+        try:
+            batch = [self.job_queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.job_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _on_export_finished(self, job: PredictionJob, f: Future):
+        # runs in the management thread of the export pool
+        self._change_num_pending_exports(-1)
+        self._export_slots.release()
+        try:
+            duration = f.result()
+        except BaseException as e:
+            self._fail_job(job, e)
+            return
+        job.timings['export'] = duration
+        self.stage_timer.add('export', duration)
+        job.finish()
+        self.stage_timer.add('total', job.timings['finished'] - job.timings['submitted'])
+        self._change_num_in_flight(-1)
+
+    def _fail_job(self, job: PredictionJob, e: BaseException):
+        if isinstance(e, BrokenProcessPool):
+            job.finish(error=WORKER_DIED_MESSAGE)
+        else:
+            job.finish(error=''.join(traceback.format_exception(type(e), e, e.__traceback__)))
+        self._change_num_in_flight(-1)
+
+    def _change_num_in_flight(self, delta: int):
+        # export callbacks run in the management thread of the export pool
+        with self.jobs_lock:
+            self.num_in_flight += delta
+
+    def _change_num_pending_exports(self, delta: int):
+        with self.jobs_lock:
+            self.num_pending_exports += delta
+
+    def _scheduler_loop(self):
+        try:
+            while not self._stop_event.is_set():
+                batch = self._next_batch()
+                if len(batch) == 0:
+                    continue
+                self._change_num_in_flight(len(batch))
+                try:
+                    self._run_batch(batch)
+                except Exception as e:
+                    # every job must end up finished, otherwise its client waits forever. Jobs that made it to the
+                    # export pool are finished by _on_export_finished
+                    for job in batch:
+                        if job.status != 'exporting' and not job.done_event.is_set():
+                            self._fail_job(job, e)
+        except BaseException as e:
+            # nothing is going to pick up the queued jobs anymore
+            self._scheduler_error = e
+            while True:
+                try:
+                    job = self.job_queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._change_num_in_flight(1)
+                self._fail_job(job, e)
+            raise e
+
+    def _run_batch(self, batch: List[PredictionJob]):
+        now = time()
+        preprocessing_results = []
+        for job in batch:
+            job.status = 'preprocessing'
+            job.timings['queue'] = now - job.timings['submitted']
+            self.stage_timer.add('queue', job.timings['queue'])
+            try:
+                preprocessing_results.append(self._submit_preprocessing(job.input_files,
+                                                                        job.seg_from_prev_stage_file))
+            except Exception as e:
+                # for example the replacement of a broken pool breaking again, or arguments that can't be pickled
+                preprocessing_results.append(None)
+                self._fail_job(job, e)
+
+        for job, pr in zip(batch, preprocessing_results):
+            if pr is None:
+                continue
+            try:
+                data, properties, duration = pr.result()
+                job.timings['preprocessing'] = duration
+                self.stage_timer.add('preprocessing', duration)
+
+                job.status = 'predicting'
+                start = time()
+                prediction = self.predictor.predict_logits_from_preprocessed_data(torch.from_numpy(data)).cpu()
+                job.timings['prediction'] = time() - start
+                self.stage_timer.add('prediction', job.timings['prediction'])
+                del data
+
+                maybe_mkdir_p(os.path.dirname(job.output_file_truncated))
+                # backpressure: wait for a free export slot before handing over yet another logit tensor
+                self._export_slots.acquire()
+                self._change_num_pending_exports(1)
+                try:
+                    ef = self._submit_export(
+                        prediction, properties, self.predictor.configuration_manager,
+                        self.predictor.plans_manager, self.predictor.dataset_json, job.output_file_truncated,
+                        job.save_probabilities, self.predictor.export_num_classes_per_chunk,
+                        self.predictor.probabilities_format)
+                except BaseException:
+                    self._change_num_pending_exports(-1)
+                    self._export_slots.release()
+                    raise
+                del prediction
+                # from here on _on_export_finished is responsible for the job
+                job.status = 'exporting'
+                ef.add_done_callback(lambda f, j=job: self._on_export_finished(j, f))
+            except Exception as e:
+                self._fail_job(job, e)
+
+
+def _make_request_handler(server: nnUNetPredictionServer):
+    class nnUNetRequestHandler(BaseHTTPRequestHandler):
+        def _send_json(self, content: dict, code: int = 200):
+            body = json.dumps(content).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def address_string(self):
+            # unix sockets don't have a client address
+            return self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+
+        def log_message(self, format, *args):
+            if server.predictor.verbose:
+                super().log_message(format, *args)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._send_json(server.stats())
+            elif self.path.startswith('/jobs/'):
+                job = server.get_job(self.path[len('/jobs/'):])
+                if job is None:
+                    self._send_json({'error': 'unknown job id'}, 404)
+                else:
+                    self._send_json(job.to_dict())
+            else:
+                self._send_json({'error': f'unknown path {self.path}'}, 404)
+
+        def do_POST(self):
+            if self.path != '/predict':
+                self._send_json({'error': f'unknown path {self.path}'}, 404)
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                job = server.submit(request['input_files'], request['output_file_truncated'],
+                                    request.get('save_probabilities', False),
+                                    request.get('seg_from_prev_stage_file'))
+            except (KeyError, ValueError, AssertionError) as e:
+                self._send_json({'error': str(e)}, 400)
+                return
+            if request.get('wait', True):
+                job.done_event.wait()
+            self._send_json(job.to_dict())
+    return nnUNetRequestHandler
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(server: nnUNetPredictionServer, host: str = '127.0.0.1', port: int = 8765,
+          unix_socket: Optional[str] = None):
+    """
+    Blocks until interrupted. If unix_socket is given, host and port are ignored
+    """
+    handler = _make_request_handler(server)
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        httpd = ThreadingUnixHTTPServer(unix_socket, handler)
+        print(f'nnU-Net prediction server listening on unix socket {unix_socket}')
+    else:
+        httpd = ThreadingHTTPServer((host, port), handler)
+        print(f'nnU-Net prediction server listening on http://{host}:{port}')
+    server.start()
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        server.stop()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, unix_socket: str, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
+
+class nnUNetPredictionClient(object):
+    def __init__(self, host: str = '127.0.0.1', port: int = 8765, unix_socket: Optional[str] = None,
+                 timeout: Optional[float] = None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.timeout = timeout
+
+    def _request(self, method: str, path: str, content: dict = None) -> dict:
+        if self.unix_socket is not None:
+            conn = _UnixHTTPConnection(self.unix_socket, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            body = json.dumps(content).encode('utf-8') if content is not None else None
+            conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            ret = json.loads(response.read())
+            if response.status != 200:
+                raise RuntimeError(f'Request {method} {path} failed with status {response.status}: {ret}')
+            return ret
+        finally:
+            conn.close()
+
+    def predict(self, input_files: List[str], output_file_truncated: str, save_probabilities: bool = False,
+                seg_from_prev_stage_file: Optional[str] = None, wait: bool = True) -> dict:
+        """
+        Paths are interpreted by the server, so they must be valid on the machine the server runs on.
+        If wait=False this returns immediately. Use job_status to poll the returned job_id
+        """
+        return self._request('POST', '/predict', {
+            'input_files': input_files,
+            'output_file_truncated': output_file_truncated,
+            'save_probabilities': save_probabilities,
+            'seg_from_prev_stage_file': seg_from_prev_stage_file,
+            'wait': wait
+        })
+
+    def job_status(self, job_id: str) -> dict:
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def stats(self) -> dict:
+        return self._request('GET', '/stats')
+
+
+def predict_server_entry_point():
+    import argparse
+    from nnunetv2.utilities.file_path_utilities import get_output_folder
+    parser = argparse.ArgumentParser(description='Starts a persistent nnU-Net prediction server. The model is loaded '
+                                                 'once and kept on the device. Jobs are submitted via HTTP (or a '
+                                                 'unix socket), see nnunetv2.inference.predict_server.'
+                                                 'nnUNetPredictionClient')
+    parser.add_argument('-d', type=str, required=False, default=None,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
+    parser.add_argument('-p', type=str, required=False, default='nnUNetPlans',
+                        help='Plans identifier. Default: nnUNetPlans')
+    parser.add_argument('-tr', type=str, required=False, default='nnUNetTrainer',
+                        help='What nnU-Net trainer class was used for training? Default: nnUNetTrainer')
+    parser.add_argument('-c', type=str, required=False, default=None,
+                        help='nnU-Net configuration that should be used for prediction')
+    parser.add_argument('-m', type=str, required=False, default=None,
+                        help='Alternative to -d/-p/-tr/-c: folder in which the trained model is')
+    parser.add_argument('-f', nargs='+', type=str, required=False, default=(0, 1, 2, 3, 4),
+                        help='Specify the folds of the trained model that should be used for prediction. '
+                             'Default: (0, 1, 2, 3, 4)')
+    parser.add_argument('-step_size', type=float, required=False, default=0.5,
+                        help='Step size for sliding window prediction. Default: 0.5')
+    parser.add_argument('--disable_tta', action='store_true', required=False, default=False,
+                        help='Set this flag to disable test time data augmentation in the form of mirroring.')
+    parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
+                        help='Name of the checkpoint you want to use. Default: checkpoint_final.pth')
+    parser.add_argument('-npp', type=int, required=False, default=3,
+                        help='Number of processes used for preprocessing. Default: 3')
+    parser.add_argument('-nps', type=int, required=False, default=3,
+                        help='Number of processes used for segmentation export. Default: 3')
+    parser.add_argument('-max_batch_size', type=int, required=False, default=4,
+                        help='Maximum number of queued jobs the scheduler picks up at once. Default: 4')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1',
+                        help='Host to listen on. Default: 127.0.0.1')
+    parser.add_argument('-port', type=int, required=False, default=8765,
+                        help='Port to listen on. Default: 8765')
+    parser.add_argument('-unix_socket', type=str, required=False, default=None,
+                        help='Listen on this unix socket instead of host:port')
+    parser.add_argument('-device', type=str, default='cuda', required=False,
+                        help="Use this to set the device the inference should run with. Available options are 'cuda' "
+                             "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2).")
+    parser.add_argument('--verbose', action='store_true', help="Set this if you like being talked to.")
+    args = parser.parse_args()
+    args.f = [i if i == 'all' else int(i) for i in args.f]
+
+    if args.m is not None:
+        model_folder = args.m
+    else:
+        assert args.d is not None and args.c is not None, 'Either -m or -d and -c must be given'
+        model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
+
+    assert args.device in ['cpu', 'cuda', 'mps'], f'-device must be either cpu, mps or cuda. Got: {args.device}.'
+    if args.device == 'cpu':
+        torch.set_num_threads(multiprocessing.cpu_count())
+        device = torch.device('cpu')
+    elif args.device == 'cuda':
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+        device = torch.device('cuda')
+    else:
+        device = torch.device('mps')
+
+    predictor = nnUNetPredictor(tile_step_size=args.step_size,
+                                use_gaussian=True,
+                                use_mirroring=not args.disable_tta,
+                                perform_everything_on_device=True,
+                                device=device,
+                                verbose=args.verbose,
+                                verbose_preprocessing=args.verbose,
+                                allow_tqdm=False)
+    predictor.initialize_from_trained_model_folder(model_folder, args.f, checkpoint_name=args.chk)
+    server = nnUNetPredictionServer(predictor, args.npp, args.nps, args.max_batch_size)
+    serve(server, args.host, args.port, args.unix_socket)
+
+
+if __name__ == '__main__':
+    # python -m nnunetv2.inference.predict_server -d 3 -c 3d_lowres -f 0
+    # see nnunetv2.inference.predict_server_load_test for how to talk to the server
+    predict_server_entry_point()
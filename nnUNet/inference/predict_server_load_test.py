@@ -0,0 +1,77 @@
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import List
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, maybe_mkdir_p
+
+from nnunetv2.inference.predict_server import nnUNetPredictionClient
+from nnunetv2.utilities.utils import create_lists_from_splitted_dataset_folder
+
+
+def run_load_test(client: nnUNetPredictionClient, list_of_lists: List[List[str]], output_folder: str,
+                  num_requests: int, num_concurrent_clients: int = 4) -> dict:
+    """
+    Sends num_requests jobs (cycling through list_of_lists) from num_concurrent_clients threads and waits for all of
+    them. Reports latency percentiles as seen by the client as well as the server side stage timings
+    """
+    maybe_mkdir_p(output_folder)
+
+    def _one_request(i):
+        files = list_of_lists[i % len(list_of_lists)]
+        start = time()
+        ret = client.predict(files, join(output_folder, f'loadtest_{i:05d}'), wait=True)
+        return time() - start, ret['status']
+
+    start = time()
+    with ThreadPoolExecutor(num_concurrent_clients) as executor:
+        results = list(executor.map(_one_request, range(num_requests)))
+    wall_time = time() - start
+
+    latencies = np.array([r[0] for r in results])
+    num_failed = sum([r[1] != 'done' for r in results])
+    summary = {
+        'num_requests': num_requests,
+        'num_failed': num_failed,
+        'num_concurrent_clients': num_concurrent_clients,
+        'wall_time': wall_time,
+        'throughput_cases_per_s': num_requests / wall_time,
+        'latency_mean': float(np.mean(latencies)),
+        'latency_p50': float(np.percentile(latencies, 50)),
+        'latency_p90': float(np.percentile(latencies, 90)),
+        'latency_max': float(np.max(latencies)),
+        'server_stats': client.stats()
+    }
+    return summary
+
+
+def load_test_entry_point():
+    parser = argparse.ArgumentParser(description='Load test for a running nnU-Net prediction server '
+                                                 '(nnUNetv2_predict_server)')
+    parser.add_argument('-i', type=str, required=True,
+                        help='input folder with images (nnU-Net naming convention, _0000 etc)')
+    parser.add_argument('-o', type=str, required=True, help='output folder for the predictions')
+    parser.add_argument('-file_ending', type=str, required=False, default='.nii.gz',
+                        help='file ending of the images. Default: .nii.gz')
+    parser.add_argument('-n', type=int, required=False, default=20, help='number of requests. Default: 20')
+    parser.add_argument('-c', type=int, required=False, default=4, help='number of concurrent clients. Default: 4')
+    parser.add_argument('-host', type=str, required=False, default='127.0.0.1')
+    parser.add_argument('-port', type=int, required=False, default=8765)
+    parser.add_argument('-unix_socket', type=str, required=False, default=None)
+    args = parser.parse_args()
+
+    list_of_lists = create_lists_from_splitted_dataset_folder(os.path.abspath(args.i), args.file_ending)
+    client = nnUNetPredictionClient(args.host, args.port, args.unix_socket)
+    summary = run_load_test(client, list_of_lists, os.path.abspath(args.o), args.n, args.c)
+    server_stats = summary.pop('server_stats')
+    for k, v in summary.items():
+        print(f'{k}: {v}')
+    print('server side stage timings (s):')
+    for k, v in server_stats['stage_timings'].items():
+        print(f'  {k}: {v}')
+
+
+if __name__ == '__main__':
+    load_test_entry_point()
@@ -0,0 +1,195 @@
+import os
+from abc import ABC, abstractmethod
+from typing import List
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import subfiles
+
+
+class ProbabilityStore(ABC):
+    """
+    Writes and reads the class probabilities exported with --save_probabilities. Stores are selected by name (see
+    get_probability_store). Reading always dispatches on the file ending (load_probabilities), so folders written
+    with different stores (including old .npz exports) can be mixed freely, for example when ensembling.
+    """
+    file_ending = None
+    # whether load(mmap=True) is lazy, i.e. slicing a class reads only that class
+    supports_mmap = False
+
+    def __init__(self, use_fp16: bool = False):
+        self.use_fp16 = use_fp16
+
+    def _cast(self, probabilities: np.ndarray) -> np.ndarray:
+        return probabilities.astype(np.float16 if self.use_fp16 else np.float32, copy=False)
+
+    @abstractmethod
+    def save(self, probabilities: np.ndarray, output_file_truncated: str) -> str:
+        """
+        returns the name of the written file
+        """
+        pass
+
+    @staticmethod
+    @abstractmethod
+    def load(filename: str, mmap: bool = True):
+        """
+        returns something that behaves like a np.ndarray of shape (c, x, y, z). If mmap is True and the format
+        supports it, the content is not read into RAM until it is accessed (slicing along the first axis is cheap)
+        """
+        pass
+
+
+class NpzProbabilityStore(ProbabilityStore):
+    """
+    nnU-Net's original format. Compressed with single threaded zlib, cannot be memory mapped. Slow.
+    """
+    file_ending = '.npz'
+
+    def save(self, probabilities: np.ndarray, output_file_truncated: str) -> str:
+        np.savez_compressed(output_file_truncated + self.file_ending, probabilities=self._cast(probabilities))
+        return output_file_truncated + self.file_ending
+
+    @staticmethod
+    def load(filename: str, mmap: bool = True):
+        return np.load(filename)['probabilities']
+
+
+class NpyProbabilityStore(ProbabilityStore):
+    """
+    Uncompressed. Largest on disk but fastest to write and can be memory mapped when read
+    """
+    file_ending = '.npy'
+    supports_mmap = True
+
+    def save(self, probabilities: np.ndarray, output_file_truncated: str) -> str:
+        np.save(output_file_truncated + self.file_ending, self._cast(probabilities))
+        return output_file_truncated + self.file_ending
+
+    @staticmethod
+    def load(filename: str, mmap: bool = True):
+        return np.load(filename, mmap_mode='r' if mmap else None)
+
+
+class Blosc2ProbabilityStore(ProbabilityStore):
+    """
+    Multithreaded blosc2 (zstd) compression with one chunk per class. Reading a class only decompresses that class.
+    Requires the blosc2 package (pip install blosc2)
+    """
+    file_ending = '.b2nd'
+    supports_mmap = True
+
+    def __init__(self, use_fp16: bool = False, num_threads: int = 8, clevel: int = 3):
+        super().__init__(use_fp16)
+        self.num_threads = num_threads
+        self.clevel = clevel
+
+    @staticmethod
+    def _import_blosc2():
+        try:
+            import blosc2
+        except ImportError:
+            raise RuntimeError('The blosc2 probability store requires the blosc2 package. Install it with '
+                               '\'pip install blosc2\' or use another probability format (npz, npy)')
+        return blosc2
+
+    def save(self, probabilities: np.ndarray, output_file_truncated: str) -> str:
+        blosc2 = self._import_blosc2()
+        probabilities = np.ascontiguousarray(self._cast(probabilities))
+        fname = output_file_truncated + self.file_ending
+        blosc2.asarray(probabilities, urlpath=fname, mode='w', chunks=(1, *probabilities.shape[1:]),
+                       cparams={'codec': blosc2.Codec.ZSTD, 'clevel': self.clevel, 'nthreads': self.num_threads})
+        return fname
+
+    @staticmethod
+    def load(filename: str, mmap: bool = True):
+        blosc2 = Blosc2ProbabilityStore._import_blosc2()
+        arr = blosc2.open(filename, mode='r')
+        return arr if mmap else arr[:]
+
+
+probability_stores = {
+    'npz': NpzProbabilityStore,
+    'npy': NpyProbabilityStore,
+    'blosc2': Blosc2ProbabilityStore,
+}
+
+
+def get_probability_store(name: str = 'npz') -> ProbabilityStore:
+    """
+    name is one of the keys of probability_stores, optionally with a '_fp16' suffix to store half precision
+    probabilities (halves the file size, plenty of precision for argmax and ensembling). Example: 'npy_fp16'
+    """
+    use_fp16 = name.endswith('_fp16')
+    base_name = name[:-len('_fp16')] if use_fp16 else name
+    if base_name not in probability_stores.keys():
+        raise ValueError(f'Unknown probability format {name}. Available: '
+                         f'{list(probability_stores.keys())} (each optionally with _fp16 suffix)')
+    return probability_stores[base_name](use_fp16=use_fp16)
+
+
+def _store_from_filename(filename: str):
+    for s in probability_stores.values():
+        if filename.endswith(s.file_ending):
+            return s
+    raise ValueError(f'Unable to determine the probability format of {filename}')
+
+
+def load_probabilities(filename: str, mmap: bool = True):
+    return _store_from_filename(filename).load(filename, mmap)
+
+
+def strip_probability_file_ending(filename: str) -> str:
+    return filename[:-len(_store_from_filename(filename).file_ending)]
+
+
+def probability_file_exists(output_file_truncated: str) -> bool:
+    return any([os.path.isfile(output_file_truncated + s.file_ending) for s in probability_stores.values()])
+
+
+def find_probability_files(folder: str, join: bool = True) -> List[str]:
+    """
+    returns all probability files in folder, regardless of the format they were saved with
+    """
+    ret = []
+    for s in probability_stores.values():
+        ret += subfiles(folder, join=join, suffix=s.file_ending)
+    return ret
+
+
+def average_probabilities_lazy(list_of_files: List[str], dtype=np.float32) -> np.ndarray:
+    """
+    Averages the probabilities stored in list_of_files. Memory mappable files (npy, blosc2) are read one class at a
+    time. Files that cannot be memory mapped (npz) are decompressed entirely anyway, so they are loaded, added and
+    dropped one after the other. Peak RAM is the result plus one class per mappable file plus one npz file.
+    """
+    assert len(list_of_files), 'At least one file must be given in list_of_files'
+    mappable = [f for f in list_of_files if _store_from_filename(f).supports_mmap]
+    avg = None
+    shape = None
+    reference_file = None
+
+    def _check_shape(a_shape, f):
+        assert a_shape == shape, f'Shape mismatch between {reference_file} ({shape}) and {f} ({a_shape})'
+
+    for f in list_of_files:
+        if f in mappable:
+            continue
+        a = load_probabilities(f, mmap=False)
+        if avg is None:
+            shape, reference_file = a.shape, f
+            avg = np.zeros(shape, dtype=dtype)
+        _check_shape(a.shape, f)
+        avg += a
+        del a
+    # opening is cheap for these, nothing is read before a class is sliced
+    arrays = [load_probabilities(f, mmap=True) for f in mappable]
+    if avg is None:
+        shape, reference_file = arrays[0].shape, mappable[0]
+        avg = np.zeros(shape, dtype=dtype)
+    for a, f in zip(arrays, mappable):
+        _check_shape(a.shape, f)
+    for c in range(shape[0]):
+        for a in arrays:
+            avg[c] += a[c]
+    avg /= len(list_of_files)
+    return avg
@@ -1,3 +1,5 @@
+from typing import List
+
 import numpy as np
 from scipy.ndimage import binary_fill_holes
 
@@ -5,6 +7,47 @@ from scipy.ndimage import binary_fill_holes
 from acvl_utils.cropping_and_padding.bounding_boxes import get_bbox_from_mask, crop_to_bbox, bounding_box_to_slice
 
 
+def get_nonzero_bbox(data: np.ndarray) -> List[List[int]]:
+    """
+    Bounding box of all voxels that are nonzero in any channel, in the format of get_bbox_from_mask ([[lb, ub], ...]
+    per spatial axis, ub exclusive. The full image if nothing is nonzero).
+
+    Computed from per-axis projections. data is processed one slice (along the first spatial axis) at a time, so no
+    full-volume temporaries are created.
+    :param data: (C, X, Y, Z) or (C, X, Y)
+    """
+    assert data.ndim in (3, 4), "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
+    spatial_shape = data.shape[1:]
+    projections = [np.zeros(s, dtype=bool) for s in spatial_shape]
+    for x in range(spatial_shape[0]):
+        nonzero_here = data[0, x] != 0
+        for c in range(1, data.shape[0]):
+            nonzero_here |= data[c, x] != 0
+        if not nonzero_here.any():
+            continue
+        projections[0][x] = True
+        for d in range(1, len(spatial_shape)):
+            projections[d] |= np.any(nonzero_here, axis=tuple(i for i in range(nonzero_here.ndim) if i != d - 1))
+    bbox = []
+    for p in projections:
+        nonzero_idx = np.flatnonzero(p)
+        bbox.append([int(nonzero_idx[0]), int(nonzero_idx[-1]) + 1] if len(nonzero_idx) > 0 else [0, len(p)])
+    return bbox
+
+
+def _create_nonzero_mask_in_bbox(data: np.ndarray, slicer: tuple) -> np.ndarray:
+    """
+    create_nonzero_mask(data)[slicer] for the slicer of get_nonzero_bbox(data), without looking at anything outside of
+    it. Everything outside the bounding box is zero and face-connected to the box, so a background region touching
+    the border of the box is connected to the image border in the full image as well. Filling holes within the box
+    therefore gives exactly the same result as filling holes in the full image
+    """
+    nonzero_mask = data[0][slicer] != 0
+    for c in range(1, data.shape[0]):
+        nonzero_mask |= data[c][slicer] != 0
+    return binary_fill_holes(nonzero_mask)
+
+
 def create_nonzero_mask(data):
     """
 
@@ -12,32 +55,56 @@ def create_nonzero_mask(data):
     :return: the mask is True where the data is nonzero
     """
     assert data.ndim in (3, 4), "data must have shape (C, X, Y, Z) or shape (C, X, Y)"
-    nonzero_mask = data[0] != 0
-    for c in range(1, data.shape[0]):
-        nonzero_mask |= data[c] != 0
-    return binary_fill_holes(nonzero_mask)
+    slicer = bounding_box_to_slice(get_nonzero_bbox(data))
+    nonzero_mask = np.zeros(data.shape[1:], dtype=bool)
+    nonzero_mask[slicer] = _create_nonzero_mask_in_bbox(data, slicer)
+    return nonzero_mask
 
 
 def crop_to_nonzero(data, seg=None, nonzero_label=-1):
     """
+    Bounding box first: the box is computed from per-axis projections and holes are only filled within it (see
+    get_nonzero_bbox and _create_nonzero_mask_in_bbox). Same result as computing the hole-filled nonzero mask of the
+    whole image and cropping to its bounding box.
 
     :param data:
     :param seg:
     :param nonzero_label: this will be written into the segmentation map
     :return:
     """
-    nonzero_mask = create_nonzero_mask(data)
-    bbox = get_bbox_from_mask(nonzero_mask)
+    bbox = get_nonzero_bbox(data)
     slicer = bounding_box_to_slice(bbox)
-    nonzero_mask = nonzero_mask[slicer][None]
-    
+    nonzero_mask = _create_nonzero_mask_in_bbox(data, slicer)[None]
+
     slicer = (slice(None), ) + slicer
     data = data[slicer]
     if seg is not None:
         seg = seg[slicer]
-        seg[(seg == 0) & (~nonzero_mask)] = nonzero_label
+        # outside = (seg == 0) & ~nonzero_mask, built in place
+        outside = np.logical_not(nonzero_mask, out=nonzero_mask)
+        outside &= seg == 0
+        seg[outside] = nonzero_label
     else:
         seg = np.where(nonzero_mask, np.int8(0), np.int8(nonzero_label))
     return data, seg, bbox
 
 
+def crop_to_label_bbox(data: np.ndarray, seg: np.ndarray, margin: List[int], ignore_label: int = None):
+    """
+    Crops data and seg to the bounding box of the labelled foreground (seg > 0, ignore_label excluded) plus margin
+    voxels on each side (clipped to the image). Nothing is cropped if seg has no foreground.
+
+    :param data: (C, X, Y, Z) or (C, X, Y)
+    :param seg: (1, X, Y, Z) or (1, X, Y)
+    :param margin: one entry per spatial axis
+    :return: data, seg, bbox (relative to the input, format of get_bbox_from_mask)
+    """
+    foreground = seg[0] > 0
+    if ignore_label is not None:
+        foreground &= seg[0] != ignore_label
+    if not np.any(foreground):
+        return data, seg, [[0, s] for s in data.shape[1:]]
+    bbox = get_bbox_from_mask(foreground)
+    bbox = [[max(0, lb - m), min(s, ub + m)] for (lb, ub), m, s in zip(bbox, margin, data.shape[1:])]
+    slicer = (slice(None), ) + bounding_box_to_slice(bbox)
+    return data[slicer], seg[slicer], bbox
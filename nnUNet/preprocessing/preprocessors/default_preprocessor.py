@@ -11,35 +11,60 @@
 #    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
-import multiprocessing
+import os
 import shutil
-from time import sleep
-from typing import Tuple, Union
+from typing import Tuple, Union, List
 
 import numpy as np
 from batchgenerators.utilities.file_and_folder_operations import *
-from tqdm import tqdm
 
 import nnunetv2
+from nnunetv2.configuration import default_num_processes
 from nnunetv2.paths import nnUNet_preprocessed, nnUNet_raw
-from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero
+from nnunetv2.preprocessing.cropping.cropping import crop_to_nonzero, crop_to_label_bbox
 from nnunetv2.preprocessing.resampling.default_resampling import compute_new_shape
+from nnunetv2.training.dataloading.properties_index import consolidate_properties
+from nnunetv2.training.dataloading.unpack_manager import UNPACK_RECORD_SUFFIX
+from nnunetv2.utilities.blosc2_storage import get_preprocessed_format, compute_b2nd_chunks, save_b2nd, \
+    B2ND_FILE_ENDING
 from nnunetv2.utilities.dataset_name_id_conversion import maybe_convert_to_dataset_name
 from nnunetv2.utilities.find_class_by_name import recursive_find_python_class
+from nnunetv2.utilities.hashing import hash_json_serializable, hash_files_with_cache, file_stat_signature
+from nnunetv2.utilities.memory_budgeted_executor import MemoryBudgetedExecutor, estimate_case_memory
 from nnunetv2.utilities.plans_handling.plans_handler import PlansManager, ConfigurationManager
+from nnunetv2.utilities.task_executor import run_tasks
 from nnunetv2.utilities.utils import get_filenames_of_train_images_and_targets
 
+# written to the output directory of each configuration, see DefaultPreprocessor.run(incremental=True)
+PREPROCESSING_MANIFEST_FILE = 'preprocessing_manifest.json'
+
+
+def _hash_case(files: List[str], previous_files: Union[dict, None] = None) -> dict:
+    file_hashes = hash_files_with_cache(files, previous_files)
+    return {'hash': hash_json_serializable([file_hashes[f]['hash'] for f in files]), 'files': file_hashes}
+
 
 class DefaultPreprocessor(object):
     def __init__(self, verbose: bool = True):
         self.verbose = verbose
+        # 'npz' or 'blosc2' (chunked, see nnunetv2.utilities.blosc2_storage). Set with nnUNet_preprocessed_format
+        self.preprocessed_format = get_preprocessed_format()
+        # None or margin in voxels (target spacing) around the labelled foreground that training cases are cropped to,
+        # at least the patch size. Set with nnUNet_roi_crop_margin, see _crop_to_roi
+        self.roi_crop_margin = int(os.environ['nnUNet_roi_crop_margin']) \
+            if 'nnUNet_roi_crop_margin' in os.environ.keys() else None
         """
         Everything we need is in the plans. Those are given when run() is called
         """
 
     def run_case_npy(self, data: np.ndarray, seg: Union[np.ndarray, None], properties: dict,
                      plans_manager: PlansManager, configuration_manager: ConfigurationManager,
-                     dataset_json: Union[dict, str]):
+                     dataset_json: Union[dict, str], crop_to_roi: bool = False):
+        """
+        crop_to_roi: this is a training case, apply the ROI crop if nnUNet_roi_crop_margin is set (see _crop_to_roi).
+        Only run_case_save (i.e. run()) sets this. Never set it for inference: seg is the prediction of the previous
+        stage there and the prediction would be cut to its foreground
+        """
         # let's not mess up the inputs!
         data = data.astype(np.float32)  # this creates a copy
         if seg is not None:
@@ -78,6 +103,13 @@ class DefaultPreprocessor(object):
         data = self._normalize(data, seg, configuration_manager,
                                plans_manager.foreground_intensity_properties_per_channel)
 
+        # optional: crop training cases to their labelled foreground. After normalization so that the intensity
+        # statistics are the same as for (uncropped) test cases
+        if crop_to_roi and has_seg and self.roi_crop_margin is not None:
+            data, seg = self._crop_to_roi(data, seg, properties, plans_manager, configuration_manager, dataset_json,
+                                          original_spacing, target_spacing)
+            new_shape = compute_new_shape(data.shape[1:], original_spacing, target_spacing)
+
         # print('current shape', data.shape[1:], 'current_spacing', original_spacing,
         #       '\ntarget shape', new_shape, 'target_spacing', target_spacing)
         old_shape = data.shape[1:]
@@ -112,11 +144,42 @@ class DefaultPreprocessor(object):
             seg = seg.astype(np.int8)
         return data, seg
 
+    def _crop_to_roi(self, data: np.ndarray, seg: np.ndarray, properties: dict, plans_manager: PlansManager,
+                     configuration_manager: ConfigurationManager, dataset_json: dict,
+                     original_spacing: List[float], target_spacing: List[float]):
+        """
+        Crops a (nonzero cropped, not yet resampled) training case to the bounding box of its labelled foreground plus
+        a margin of max(self.roi_crop_margin, patch size) voxels at target spacing on each side. For large images
+        with a small structure of interest (CBCT: everything is nonzero, the teeth are a small part of it) this cuts
+        dataset size and data loading I/O. Patches are still sampled from everything that is stored, so the margin
+        is the background context the network sees in training.
+
+        The crop is folded into bbox_used_for_cropping and shape_after_cropping_and_before_resampling, so exporting
+        predictions of these cases (validation) works as before, everything outside the ROI is predicted as
+        background. roi_bbox_used_for_cropping is the ROI relative to the nonzero crop. class_locations are sampled
+        after this, so they are relative to the stored arrays. Do not use for the 3d_lowres stage of a cascade: its
+        predictions would only cover the ROI while the next stage expects the whole nonzero region
+        """
+        patch_size = list(configuration_manager.patch_size)
+        margin = [max(self.roi_crop_margin, p) for p in patch_size]
+        if len(margin) < len(data.shape[1:]):
+            # 2d: slices are independent samples, no patch size along the first axis
+            margin = [self.roi_crop_margin] + margin
+        # margin is in voxels at target spacing, we crop before resampling
+        margin = [int(np.ceil(m * t / o)) for m, t, o in zip(margin, target_spacing, original_spacing)]
+        label_manager = plans_manager.get_label_manager(dataset_json)
+        data, seg, roi_bbox = crop_to_label_bbox(data, seg, margin, label_manager.ignore_label)
+        properties['roi_bbox_used_for_cropping'] = roi_bbox
+        properties['bbox_used_for_cropping'] = [[b[0] + r[0], b[0] + r[1]] for b, r in
+                                                zip(properties['bbox_used_for_cropping'], roi_bbox)]
+        properties['shape_after_cropping_and_before_resampling'] = data.shape[1:]
+        return data, seg
+
     def run_case(self, image_files: List[str], seg_file: Union[str, None], plans_manager: PlansManager,
                  configuration_manager: ConfigurationManager,
-                 dataset_json: Union[dict, str]):
+                 dataset_json: Union[dict, str], crop_to_roi: bool = False):
         """
-        seg file can be none (test cases)
+        seg file can be none (test cases). crop_to_roi: see run_case_npy
 
         order of operations is: transpose -> crop -> resample
         so when we export we need to run the following order: resample -> crop -> transpose (we could also run
@@ -137,34 +200,63 @@ class DefaultPreprocessor(object):
             seg = None
 
         data, seg = self.run_case_npy(data, seg, data_properties, plans_manager, configuration_manager,
-                                      dataset_json)
+                                      dataset_json, crop_to_roi=crop_to_roi)
         return data, seg, data_properties
 
     def run_case_save(self, output_filename_truncated: str, image_files: List[str], seg_file: str,
                       plans_manager: PlansManager, configuration_manager: ConfigurationManager,
                       dataset_json: Union[dict, str]):
-        data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json)
+        data, seg, properties = self.run_case(image_files, seg_file, plans_manager, configuration_manager, dataset_json,
+                                              crop_to_roi=True)
         # print('dtypes', data.dtype, seg.dtype)
-        np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
+        if self.preprocessed_format == 'blosc2':
+            chunks = compute_b2nd_chunks(data.shape, configuration_manager.patch_size)
+            save_b2nd(data, output_filename_truncated + B2ND_FILE_ENDING, chunks)
+            save_b2nd(seg, output_filename_truncated + '_seg' + B2ND_FILE_ENDING, (seg.shape[0], *chunks[1:]))
+        else:
+            np.savez_compressed(output_filename_truncated + '.npz', data=data, seg=seg)
         write_pickle(properties, output_filename_truncated + '.pkl')
 
     @staticmethod
     def _sample_foreground_locations(seg: np.ndarray, classes_or_regions: Union[List[int], List[Tuple[int, ...]]],
                                      seed: int = 1234, verbose: bool = False):
+        """
+        Returns a dict mapping each class/region to an (n, seg.ndim) integer array of sampled voxel coordinates
+        (relative to seg, i.e. to the cropped and resampled case). Coordinates are stored as int16 where the case is
+        small enough, int32 otherwise.
+
+        All voxel indices are grouped by label in a single pass (one stable sort of the requested voxels) instead of
+        running np.argwhere once per class. Groups are in ascending index order, which is the order np.argwhere
+        returns, so together with the unchanged sequence of random draws the selected locations are identical to
+        what the one-argwhere-per-class implementation produced for the same seed.
+        """
         num_samples = 10000
         min_percent_coverage = 0.01  # at least 1% of the class voxels need to be selected, otherwise it may be too
         # sparse
         rndst = np.random.RandomState(seed)
         class_locs = {}
+
+        requested_labels = np.unique([j for i in classes_or_regions
+                                      for j in (i if isinstance(i, (tuple, list)) else [i])])
+        seg_flat = seg.ravel()
+        flat_indices = np.flatnonzero(np.isin(seg_flat, requested_labels))
+        labels_of_indices = seg_flat[flat_indices]
+        sort_order = np.argsort(labels_of_indices, kind='stable')
+        flat_indices = flat_indices[sort_order]
+        labels_of_indices = labels_of_indices[sort_order]
+        del sort_order
+
+        def _indices_of(label):
+            return flat_indices[np.searchsorted(labels_of_indices, label, side='left'):
+                                np.searchsorted(labels_of_indices, label, side='right')]
+
+        coordinate_dtype = np.int16 if max(seg.shape) <= np.iinfo(np.int16).max else np.int32
         for c in classes_or_regions:
             k = c if not isinstance(c, list) else tuple(c)
             if isinstance(c, (tuple, list)):
-                mask = seg == c[0]
-                for cc in c[1:]:
-                    mask = mask | (seg == cc)
-                all_locs = np.argwhere(mask)
+                all_locs = np.sort(np.concatenate([_indices_of(cc) for cc in np.unique(c)]))
             else:
-                all_locs = np.argwhere(seg == c)
+                all_locs = _indices_of(c)
             if len(all_locs) == 0:
                 class_locs[k] = []
                 continue
@@ -172,7 +264,7 @@ class DefaultPreprocessor(object):
             target_num_samples = max(target_num_samples, int(np.ceil(len(all_locs) * min_percent_coverage)))
 
             selected = all_locs[rndst.choice(len(all_locs), target_num_samples, replace=False)]
-            class_locs[k] = selected
+            class_locs[k] = np.stack(np.unravel_index(selected, seg.shape), axis=1).astype(coordinate_dtype)
             if verbose:
                 print(c, target_num_samples)
         return class_locs
@@ -192,9 +284,16 @@ class DefaultPreprocessor(object):
         return data
 
     def run(self, dataset_name_or_id: Union[int, str], configuration_name: str, plans_identifier: str,
-            num_processes: int):
+            num_processes: int, incremental: bool = False):
         """
         data identifier = configuration name in plans. EZ.
+
+        incremental: only (re)process cases that are new or whose input files changed since the last run and delete
+        the output of cases that are no longer in the dataset. The state of the last run (content hash per case plus a
+        hash of the preprocessing relevant plans/dataset.json entries) is kept in a manifest in the output directory.
+        If there is no manifest or the plans/dataset.json entries changed, everything is reprocessed. Only incremental
+        runs hash the raw data and write the manifest, so the first incremental run after a regular one processes
+        everything.
         """
         dataset_name = maybe_convert_to_dataset_name(dataset_name_or_id)
 
@@ -216,8 +315,11 @@ class DefaultPreprocessor(object):
         dataset_json = load_json(dataset_json_file)
 
         output_directory = join(nnUNet_preprocessed, dataset_name, configuration_manager.data_identifier)
+        manifest_file = join(output_directory, PREPROCESSING_MANIFEST_FILE)
+        config_hash = self._get_preprocessing_config_hash(plans_manager, configuration_manager, dataset_json)
 
-        if isdir(output_directory):
+        previous_cases = self._load_manifest(manifest_file, config_hash) if incremental else None
+        if previous_cases is None and isdir(output_directory):
             shutil.rmtree(output_directory)
 
         maybe_mkdir_p(output_directory)
@@ -227,39 +329,148 @@ class DefaultPreprocessor(object):
         # identifiers = [os.path.basename(i[:-len(dataset_json['file_ending'])]) for i in seg_fnames]
         # output_filenames_truncated = [join(output_directory, i) for i in identifiers]
 
-        # multiprocessing magic.
-        r = []
-        with multiprocessing.get_context("spawn").Pool(num_processes) as p:
-            remaining = list(range(len(dataset)))
-            # p is pretty nifti. If we kill workers they just respawn but don't do any work.
-            # So we need to store the original pool of workers.
-            workers = [j for j in p._pool]
-
-            for k in dataset.keys():
-                r.append(p.starmap_async(self.run_case_save,
-                                         ((join(output_directory, k), dataset[k]['images'], dataset[k]['label'],
-                                           plans_manager, configuration_manager,
-                                           dataset_json),)))
-
-            with tqdm(desc=None, total=len(dataset), disable=self.verbose) as pbar:
-                while len(remaining) > 0:
-                    all_alive = all([j.is_alive() for j in workers])
-                    if not all_alive:
-                        raise RuntimeError('Some background worker is 6 feet under. Yuck. \n'
-                                           'OK jokes aside.\n'
-                                           'One of your background processes is missing. This could be because of '
-                                           'an error (look for an error message) or because it was killed '
-                                           'by your OS due to running out of RAM. If you don\'t see '
-                                           'an error message, out of RAM is likely the problem. In that case '
-                                           'reducing the number of workers might help')
-                    done = [i for i in remaining if r[i].ready()]
-                    # get done so that errors can be raised
-                    _ = [r[i].get() for i in done]
-                    for _ in done:
-                        r[_].get()  # allows triggering errors
-                        pbar.update()
-                    remaining = [i for i in remaining if i not in done]
-                    sleep(0.1)
+        # hashing reads the entire raw dataset, only pay for that if incrementality was asked for
+        cases = self._hash_cases(dataset, previous_cases, num_processes) if incremental else None
+        if previous_cases is not None:
+            removed = [k for k in previous_cases.keys() if k not in cases.keys()]
+            to_process = [k for k in cases.keys() if k not in previous_cases.keys() or
+                          previous_cases[k]['hash'] != cases[k]['hash'] or
+                          not self._case_output_exists(output_directory, k)]
+            # unpacked npy files of changed cases would otherwise be picked up instead of the new npz
+            for k in removed + to_process:
+                self._remove_case_output(output_directory, k)
+            print(f'Incremental preprocessing: {len(to_process)} new or changed cases, {len(removed)} removed, '
+                  f'{len(cases) - len(to_process)} up to date')
+            # if we crash while processing, the cases we are about to process must not be marked as done
+            self._save_manifest(manifest_file, config_hash, {k: cases[k] for k in cases.keys() if k not in to_process})
+        else:
+            to_process = list(dataset.keys())
+
+        # cases are started as long as their estimated memory requirement fits into the RAM budget, see
+        # MemoryBudgetedExecutor
+        rw = plans_manager.image_reader_writer_class()
+        estimates = [self._estimate_case_memory(rw, dataset[k]['images'], plans_manager, configuration_manager)
+                     for k in to_process]
+        MemoryBudgetedExecutor(num_processes, verbose=self.verbose).run(
+            self.run_case_save,
+            [(join(output_directory, k), dataset[k]['images'], dataset[k]['label'], plans_manager,
+              configuration_manager, dataset_json) for k in to_process],
+            estimates)
+
+        # one memory mapped class_locations array + index instead of one pkl per case during training. 2d
+        # configurations also get an index of the slices each class is present in
+        consolidate_properties(output_directory, list(dataset.keys()),
+                               slice_index=len(configuration_manager.patch_size) == 2)
+        if incremental:
+            self._save_manifest(manifest_file, config_hash, cases)
+
+    @staticmethod
+    def _estimate_case_memory(rw, image_files: List[str], plans_manager: PlansManager,
+                              configuration_manager: ConfigurationManager) -> Union[int, None]:
+        """
+        estimated peak memory of run_case_save for this case, computed from the image header. None if the
+        reader/writer cannot read the header alone (MemoryBudgetedExecutor then falls back to a conservative default)
+        """
+        geometry = rw.read_images_geometry(image_files)
+        if geometry is None:
+            return None
+        shape, spacing = geometry
+        num_channels = shape[0]
+        shape = [shape[1:][i] for i in plans_manager.transpose_forward]
+        spacing = [spacing[i] for i in plans_manager.transpose_forward]
+        target_spacing = configuration_manager.spacing
+        if len(target_spacing) < len(shape):
+            target_spacing = [spacing[0]] + list(target_spacing)
+        return estimate_case_memory(shape, num_channels, compute_new_shape(shape, spacing, target_spacing))
+
+    def _get_preprocessing_config_hash(self, plans_manager: PlansManager, configuration_manager: ConfigurationManager,
+                                       dataset_json: dict) -> str:
+        """
+        Everything that influences the output of run_case_save except the input files. Entries that merely describe
+        the dataset (numTraining, median shapes, ...) are left out on purpose: they change whenever cases are added.
+        Note that foreground_intensity_properties_per_channel is included, so rerunning the fingerprint extraction
+        after adding cases invalidates everything (CT normalization depends on it). Overwrite this if your
+        preprocessor depends on anything else
+        """
+        config = {
+            'plans': {k: plans_manager.plans.get(k) for k in ('transpose_forward', 'image_reader_writer',
+                                                               'label_manager',
+                                                               'foreground_intensity_properties_per_channel')},
+            'configuration': configuration_manager.configuration,
+            'dataset_json': {k: dataset_json.get(k) for k in ('channel_names', 'labels', 'regions_class_order',
+                                                             'file_ending', 'overwrite_image_reader_writer')},
+            'preprocessor': self.__class__.__name__,
+            'preprocessed_format': self.preprocessed_format
+        }
+        if self.roi_crop_margin is not None:
+            # only if set, existing manifests stay valid
+            config['roi_crop_margin'] = self.roi_crop_margin
+        return hash_json_serializable(config)
+
+    @staticmethod
+    def _hash_cases(dataset: dict, previous_cases: Union[dict, None] = None,
+                    num_processes: int = default_num_processes) -> dict:
+        """
+        {identifier: {'hash': ..., 'files': ...}}. The case hash only depends on file contents (not on paths), files
+        whose size and mtime did not change since previous_cases was recorded are not read again. Cases with files
+        that need to be read are hashed in num_processes worker processes
+        """
+        previous_files = {}
+        if previous_cases is not None:
+            for v in previous_cases.values():
+                previous_files.update(v['files'])
+        cases = {}
+        to_hash = []
+        for k in dataset.keys():
+            files = list(dataset[k]['images']) + [dataset[k]['label']]
+            if all([f in previous_files.keys() and previous_files[f]['stat'] == file_stat_signature(f)
+                    for f in files]):
+                cases[k] = _hash_case(files, previous_files)
+            else:
+                to_hash.append((k, files))
+        if len(to_hash) > 0:
+            results = run_tasks(_hash_case, [(files, None) for _, files in to_hash], num_processes,
+                                desc='Hashing raw data')
+            cases.update({k: r for (k, _), r in zip(to_hash, results)})
+        # same order as dataset
+        return {k: cases[k] for k in dataset.keys()}
+
+    @staticmethod
+    def _load_manifest(manifest_file: str, config_hash: str) -> Union[dict, None]:
+        """
+        returns the recorded cases or None if there is no usable manifest (-> reprocess everything)
+        """
+        if not isfile(manifest_file):
+            print('Incremental preprocessing: no manifest found, preprocessing everything')
+            return None
+        manifest = load_json(manifest_file)
+        if manifest.get('config_hash') != config_hash:
+            print('Incremental preprocessing: plans or dataset.json changed, preprocessing everything')
+            return None
+        return manifest['cases']
+
+    @staticmethod
+    def _save_manifest(manifest_file: str, config_hash: str, cases: dict) -> None:
+        # write to a temporary file first so that we never leave a half written manifest behind
+        save_json({'config_hash': config_hash, 'cases': cases}, manifest_file + '.tmp', sort_keys=False)
+        os.replace(manifest_file + '.tmp', manifest_file)
+
+    def _case_output_files(self, output_directory: str, identifier: str) -> List[str]:
+        """
+        everything in the output directory that belongs to a case, including the npy files created by unpacking
+        """
+        return [join(output_directory, identifier + i) for i in ('.npz', '.pkl', '.npy', '_seg.npy', B2ND_FILE_ENDING,
+                                                                 '_seg' + B2ND_FILE_ENDING, UNPACK_RECORD_SUFFIX)]
+
+    def _case_output_exists(self, output_directory: str, identifier: str) -> bool:
+        expected = ('.npz', '.pkl') if self.preprocessed_format == 'npz' else \
+            (B2ND_FILE_ENDING, '_seg' + B2ND_FILE_ENDING, '.pkl')
+        return all([isfile(join(output_directory, identifier + i)) for i in expected])
+
+    def _remove_case_output(self, output_directory: str, identifier: str) -> None:
+        for f in self._case_output_files(output_directory, identifier):
+            if isfile(f):
+                os.remove(f)
 
     def modify_seg_fn(self, seg: np.ndarray, plans_manager: PlansManager, dataset_json: dict,
                       configuration_manager: ConfigurationManager) -> np.ndarray:
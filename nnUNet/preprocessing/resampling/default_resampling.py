@@ -7,7 +7,7 @@ import pandas as pd
 import sklearn
 import torch
 from batchgenerators.augmentations.utils import resize_segmentation
-from scipy.ndimage import map_coordinates
+from scipy.ndimage import zoom as ndi_zoom
 from skimage.transform import resize
 from nnunetv2.configuration import ANISO_THRESHOLD
 
@@ -112,6 +112,84 @@ def resample_data_or_seg_to_shape(data: Union[torch.Tensor, np.ndarray],
     return data_reshaped
 
 
+def _separate_z_interpolation_positions(orig_size: int, new_size: int):
+    """
+    Positions in the source array that the new_size output slices sample from. Same sampling grid as
+    skimage.transform.resize (align_corners=False). Returns the lower source index, the upper source index (both
+    clipped to the array, which is what mode='nearest' does) and the weight of the upper one
+    """
+    scale = orig_size / new_size
+    coords = scale * (np.arange(new_size) + 0.5) - 0.5
+    lower = np.floor(coords)
+    weights = coords - lower
+    lower = lower.astype(int)
+    upper = np.clip(lower + 1, 0, orig_size - 1)
+    lower = np.clip(lower, 0, orig_size - 1)
+    return coords, lower, upper, weights
+
+
+def resample_along_axis(data: np.ndarray, new_size: int, axis: int, order: int = 0, is_seg: bool = False,
+                        out: np.ndarray = None) -> np.ndarray:
+    """
+    Resamples a 3d array along a single axis (the out-of-plane axis in separate z resampling). Equivalent to
+    map_coordinates(data, coords, order=order, mode='nearest') with the align_corners=False grid along axis and the
+    identity along the other axes, but without building that coordinate grid: each output slice is computed from at
+    most two source slices.
+
+    order 0: nearest slice. order 1: linear interpolation between the two neighbouring slices.
+    Segmentations with order 1 are resampled as if every label was interpolated as one-hot mask and thresholded at
+    0.5 (which is what we used to do, one map_coordinates call per label): if both neighbouring slices agree that
+    label is kept, otherwise the closer slice wins and exact ties become 0. This needs no per-label passes.
+    Orders > 1 fall back to a spline zoom along axis (no coordinate grid either, but the whole array is filtered).
+    """
+    assert data.ndim == 3
+    new_shape = list(data.shape)
+    new_shape[axis] = new_size
+    if out is None:
+        out = np.zeros(new_shape, dtype=data.dtype)
+    assert list(out.shape) == new_shape
+
+    if order > 1:
+        zoom = [1.] * 3
+        zoom[axis] = new_size / data.shape[axis]
+        if not is_seg:
+            ndi_zoom(data, zoom, output=out, order=order, mode='nearest', grid_mode=True)
+        else:
+            unique_labels = np.sort(pd.unique(data.ravel()))
+            out[:] = 0
+            for cl in unique_labels:
+                out[np.round(ndi_zoom((data == cl).astype(float), zoom, order=order, mode='nearest',
+                                      grid_mode=True)) > 0.5] = cl
+        return out
+
+    coords, lower, upper, weights = _separate_z_interpolation_positions(data.shape[axis], new_size)
+    src = np.moveaxis(data, axis, 0)
+    dst = np.moveaxis(out, axis, 0)
+    if order == 0:
+        nearest = np.clip(np.floor(coords + 0.5).astype(int), 0, data.shape[axis] - 1)
+        for i in range(new_size):
+            dst[i] = src[nearest[i]]
+    elif not is_seg:
+        for i in range(new_size):
+            w = weights[i]
+            if w == 0 or lower[i] == upper[i]:
+                dst[i] = src[lower[i]]
+            else:
+                dst[i] = src[lower[i]] * (1 - w) + src[upper[i]] * w
+    else:
+        for i in range(new_size):
+            w = weights[i]
+            a, b = src[lower[i]], src[upper[i]]
+            if w < 0.5:
+                dst[i] = a
+            elif w > 0.5:
+                dst[i] = b
+            else:
+                # neither mask reaches more than 0.5 where the slices disagree
+                dst[i] = np.where(a == b, a, 0)
+    return out
+
+
 def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], List[float], np.ndarray],
                          is_seg: bool = False, axis: Union[None, int] = None, order: int = 3,
                          do_separate_z: bool = False, order_z: int = 0, dtype_out = None):
@@ -164,30 +242,8 @@ def resample_data_or_seg(data: np.ndarray, new_shape: Union[Tuple[float, ...], L
                     else:
                         reshaped_here[:, :, slice_id] = resize_fn(data[c, :, :, slice_id], new_shape_2d, order, **kwargs)
                 if shape[axis] != new_shape[axis]:
-
-                    # The following few lines are blatantly copied and modified from sklearn's resize()
-                    rows, cols, dim = new_shape[0], new_shape[1], new_shape[2]
-                    orig_rows, orig_cols, orig_dim = reshaped_here.shape
-
-                    # align_corners=False
-                    row_scale = float(orig_rows) / rows
-                    col_scale = float(orig_cols) / cols
-                    dim_scale = float(orig_dim) / dim
-
-                    map_rows, map_cols, map_dims = np.mgrid[:rows, :cols, :dim]
-                    map_rows = row_scale * (map_rows + 0.5) - 0.5
-                    map_cols = col_scale * (map_cols + 0.5) - 0.5
-                    map_dims = dim_scale * (map_dims + 0.5) - 0.5
-
-                    coord_map = np.array([map_rows, map_cols, map_dims])
-                    if not is_seg or order_z == 0:
-                        reshaped_final[c] = map_coordinates(reshaped_here, coord_map, order=order_z, mode='nearest')[None]
-                    else:
-                        unique_labels = np.sort(pd.unique(reshaped_here.ravel()))  # np.unique(reshaped_data)
-                        for i, cl in enumerate(unique_labels):
-                            reshaped_final[c][np.round(
-                                map_coordinates((reshaped_here == cl).astype(float), coord_map, order=order_z,
-                                                mode='nearest')) > 0.5] = cl
+                    resample_along_axis(reshaped_here, new_shape[axis], axis, order_z, is_seg,
+                                        out=reshaped_final[c])
                 else:
                     reshaped_final[c] = reshaped_here
         else:
@@ -0,0 +1,180 @@
+"""
+Segmentation resampling whose cost does not scale with (number of labels) x (image size).
+
+batchgenerators' resize_segmentation (used by default_resampling for is_seg=True) interpolates a one-hot mask of the
+entire image for every label. With 30-50 labels (dental, whole body) that is 30-50 full resamplings. Here every label
+is only interpolated within its bounding box (plus the support of the interpolation kernel) and the results are
+merged with a running argmax. Outside that box the interpolated mask of a label is exactly 0 for order 0 and 1, so
+nothing is lost. The background label typically still covers the whole image, everything else is cheap.
+
+Output semantics are those of resize_segmentation with argmax merging: every voxel gets the label with the highest
+interpolated score and exact ties are given to the nearest neighbour label (if it is one of the tied labels,
+otherwise the smallest tied label).
+- order 0 and 1: identical to resize_segmentation as shipped with batchgenerators versions that merge by argmax
+  (seg_tiebreak='nearest', the default). Older batchgenerators versions thresholded every mask at 0.5 and let the
+  largest label win. That differs from the argmax only at voxels where several labels reach 0.5 (ties at label
+  boundaries) or none does (3+ labels meeting)
+- order > 1: spline filtering is not local, so masks are filtered within their (padded) bounding box only. Differences
+  to resampling the full mask are limited to near-ties
+"""
+
+
+from typing import Union, Tuple, List
+
+import numpy as np
+import pandas as pd
+from scipy import ndimage as ndi
+
+
+def _spline_margin(order: int) -> int:
+    # number of input voxels around a bounding box that can influence the interpolated values inside it (order <= 1)
+    # or that we consider enough to make the truncation of the spline prefilter negligible (order > 1)
+    return 1 if order <= 1 else 4 * order
+
+
+def _sampling_positions(old_size: int, new_size: int) -> np.ndarray:
+    """
+    Source positions of all output voxels along one axis, computed exactly like scipy.ndimage.zoom(grid_mode=True)
+    does it (which is what skimage's resize uses). Bit-identical positions are what allows us to reproduce exact ties
+    """
+    zoom = np.divide(old_size, new_size)
+    cc = np.arange(new_size, dtype=np.float64)
+    cc += 0.5
+    cc *= zoom
+    cc -= 0.5
+    return cc
+
+
+def _interpolate_region(mask: np.ndarray, positions: List[np.ndarray], order: int,
+                        max_num_voxels_per_chunk: int = 2 ** 22) -> np.ndarray:
+    """
+    map_coordinates on the outer product of the per-axis positions. The coordinate grid is built in chunks along the
+    first axis so that it stays small even for labels that cover the whole image (background)
+    """
+    out_shape = tuple(len(p) for p in positions)
+    out = np.empty(out_shape, dtype=np.float64)
+    if order > 1:
+        # prefiltering is global, so don't split spline interpolation
+        rows_per_chunk = out_shape[0]
+    else:
+        rows_per_chunk = max(1, max_num_voxels_per_chunk // max(1, int(np.prod(out_shape[1:]))))
+    for start in range(0, out_shape[0], rows_per_chunk):
+        grid = np.stack(np.meshgrid(positions[0][start:start + rows_per_chunk], *positions[1:], indexing='ij'))
+        ndi.map_coordinates(mask, grid, output=out[start:start + rows_per_chunk], order=order, mode='nearest')
+    return out
+
+
+def resample_segmentation_by_bbox(segmentation: np.ndarray, new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                                  order: int = 1) -> np.ndarray:
+    """
+    Drop-in replacement for batchgenerators' resize_segmentation(segmentation, new_shape, order), see module docstring.
+    segmentation can be 2d or 3d
+    """
+    tpe = segmentation.dtype
+    new_shape = tuple(int(i) for i in new_shape)
+    assert segmentation.ndim == len(new_shape), "new shape must have same dimensionality as segmentation"
+    if segmentation.size == 0:
+        return np.zeros(new_shape, dtype=tpe)
+    zoom = [j / i for i, j in zip(segmentation.shape, new_shape)]
+
+    if order == 0:
+        out = np.empty(new_shape, dtype=tpe)
+        ndi.zoom(segmentation, zoom, output=out, order=0, mode='nearest', grid_mode=True)
+        return out
+
+    labels = np.sort(pd.unique(segmentation.ravel()))
+    if len(labels) == 1:
+        return np.full(new_shape, labels[0], dtype=tpe)
+
+    # work with label indices (0 .. n-1) from here on. Indices are what we store per voxel
+    idx_dtype = np.int8 if len(labels) < 127 else (np.int16 if len(labels) < 32767 else np.int32)
+    label_idx = np.searchsorted(labels, segmentation).astype(idx_dtype)
+    # +1 because find_objects ignores 0
+    bboxes = ndi.find_objects(label_idx.astype(np.int32) + 1, max_label=len(labels))
+
+    # nearest neighbour label, used to settle exact ties
+    nn_idx = np.empty(new_shape, dtype=idx_dtype)
+    ndi.zoom(label_idx, zoom, output=nn_idx, order=0, mode='nearest', grid_mode=True)
+
+    positions = [_sampling_positions(i, j) for i, j in zip(segmentation.shape, new_shape)]
+    best = np.zeros(new_shape, dtype=np.float64)
+    win = np.zeros(new_shape, dtype=idx_dtype)
+    nn_top = np.zeros(new_shape, dtype=bool)
+    margin = _spline_margin(order)
+
+    for i, bbox in enumerate(bboxes):
+        if bbox is None:
+            continue
+        out_slicer = []
+        in_slicer = []
+        positions_here = []
+        for d in range(segmentation.ndim):
+            # output voxels whose sampling position is close enough to the bounding box to get a nonzero score
+            inside = np.nonzero((positions[d] > bbox[d].start - 1 - margin) &
+                                (positions[d] < bbox[d].stop + margin))[0]
+            if len(inside) == 0:
+                break
+            lo, hi = inside[0], inside[-1] + 1
+            out_slicer.append(slice(lo, hi))
+            # input region needed to interpolate these output voxels. Where it is cut off by the image border,
+            # mode='nearest' clips exactly like it does for the full image
+            in_lo = max(int(np.floor(positions[d][lo])) - margin, 0)
+            in_hi = min(int(np.floor(positions[d][hi - 1])) + 2 + margin, segmentation.shape[d])
+            in_slicer.append(slice(in_lo, in_hi))
+            # subtracting an integer is exact, so the positions stay bit-identical to the full image ones
+            positions_here.append(positions[d][lo:hi] - in_lo)
+        if len(out_slicer) != segmentation.ndim:
+            continue
+        out_slicer = tuple(out_slicer)
+
+        mask = (label_idx[tuple(in_slicer)] == i).astype(np.float64)
+        score = _interpolate_region(mask, positions_here, order)
+        if order > 1:
+            # skimage clips to the input range (0, 1) with clip=True
+            np.clip(score, 0, 1, out=score)
+
+        best_here = best[out_slicer]
+        is_nn = nn_idx[out_slicer] == i
+        if i == 0:
+            # the first label is the initial winner (win is initialized with 0)
+            best_here[:] = score
+            nn_top[out_slicer] = is_nn & (score > 0)
+            continue
+        # exact tie with the current best and this label is the nearest neighbour: nearest neighbour stays on top
+        nn_top[out_slicer] |= (score == best_here) & (score > 0) & is_nn
+        better = score > best_here
+        nn_top_here = nn_top[out_slicer]
+        nn_top_here[better] = is_nn[better]
+        win[out_slicer][better] = i
+        np.maximum(best_here, score, out=best_here)
+
+    win[nn_top] = nn_idx[nn_top]
+    return labels.astype(tpe, copy=False)[win]
+
+
+if __name__ == '__main__':
+    # many-label phantom (think teeth): 40 small ellipsoids in a 3d volume, resampled from an anisotropic spacing
+    from time import time
+    from batchgenerators.augmentations.utils import resize_segmentation
+
+    rng = np.random.RandomState(1234)
+    shape = (96, 192, 192)
+    phantom = np.zeros(shape, dtype=np.uint8)
+    grid = np.stack(np.meshgrid(*[np.arange(i) for i in shape], indexing='ij'))
+    for label in range(1, 41):
+        center = [rng.randint(10, s - 10) for s in shape]
+        radii = rng.uniform(4, 12, size=3)
+        dist = sum([((grid[d] - center[d]) / radii[d]) ** 2 for d in range(3)])
+        phantom[dist <= 1] = label
+    del grid
+
+    target_shape = (160, 224, 224)
+    for order in (0, 1):
+        st = time()
+        ref = resize_segmentation(phantom, target_shape, order)
+        t_ref = time() - st
+        st = time()
+        new = resample_segmentation_by_bbox(phantom, target_shape, order)
+        t_new = time() - st
+        print(f'order {order}: resize_segmentation {t_ref:.2f}s, resample_segmentation_by_bbox {t_new:.2f}s, '
+              f'{len(np.unique(phantom))} labels, differing voxels: {np.sum(ref != new)}')
@@ -0,0 +1,198 @@
+"""
+Drop-in replacement for resample_data_or_seg_to_shape / resample_data_or_seg (default_resampling.py) that is
+faster and uses less memory:
+- images are resampled in float32 (default_resampling casts everything to float64 first)
+- channels (and in separate-z mode individual slices) are distributed over a thread pool. scipy.ndimage releases the
+  GIL while interpolating so this scales with the number of threads
+- results are written directly into preallocated output arrays instead of being copied there
+
+Same interpolation as skimage.transform.resize(mode='edge', anti_aliasing=False, clip=True), which is what
+default_resampling uses. Differences to default_resampling:
+- images (is_seg=False): float32 vs float64 arithmetic. The deviation is below 1e-6 relative to the intensity range
+  of the image (spline prefiltering is done in float64 by scipy either way). Without separate z, and for order 0,
+  the results are identical
+- segmentations (is_seg=True): resampled with resample_segmentation_by_bbox (segmentation_resampling.py) which only
+  interpolates each label within its bounding box. Identical to resize_segmentation with argmax merging, see
+  segmentation_resampling.py for details and for how it relates to older batchgenerators versions
+
+Select it in the plans via nnUNetPlanner_threadedres (experiment_planners/resampling/resample_threaded.py) or by
+setting resampling_fn_data/resampling_fn_seg/resampling_fn_probabilities to resample_data_or_seg_to_shape_threaded.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, Tuple, List
+
+import numpy as np
+import torch
+from scipy import ndimage as ndi
+
+from nnunetv2.configuration import ANISO_THRESHOLD
+from nnunetv2.preprocessing.resampling.default_resampling import determine_do_sep_z_and_axis, compute_new_shape, \
+    resample_along_axis
+from nnunetv2.preprocessing.resampling.segmentation_resampling import resample_segmentation_by_bbox
+
+
+def _default_num_threads() -> int:
+    # preprocessing already runs several worker processes, so don't go overboard here
+    return min(4, os.cpu_count())
+
+
+def _resize_image_into(image: np.ndarray, out: np.ndarray, order: int) -> None:
+    """
+    skimage.transform.resize(image, out.shape, order, mode='edge', anti_aliasing=False, clip=True) written into out
+    """
+    zoom = [o / i for o, i in zip(out.shape, image.shape)]
+    ndi.zoom(image, zoom, output=out, order=order, mode='nearest', grid_mode=True)
+    if order > 1:
+        # splines overshoot. skimage clips to the input range (clip=True)
+        np.clip(out, image.min(), image.max(), out=out)
+
+
+def resample_data_or_seg_threaded(data: np.ndarray, new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                                  is_seg: bool = False, axis: Union[None, int] = None, order: int = 3,
+                                  do_separate_z: bool = False, order_z: int = 0, dtype_out=None,
+                                  num_threads: int = None, compute_dtype=np.float32):
+    """
+    Same arguments as default_resampling.resample_data_or_seg plus
+    num_threads: size of the thread pool. None -> min(4, cpu_count)
+    compute_dtype: dtype images are interpolated in. Use np.float64 to reproduce default_resampling exactly
+    """
+    assert data.ndim == 4, "data must be (c, x, y, z)"
+    assert len(new_shape) == data.ndim - 1
+    shape = np.array(data[0].shape)
+    new_shape = np.array(new_shape)
+    if np.all(shape == new_shape):
+        return data
+
+    if dtype_out is None:
+        dtype_out = data.dtype
+    if num_threads is None:
+        num_threads = _default_num_threads()
+    if do_separate_z:
+        assert axis is not None, 'If do_separate_z, we need to know what axis is anisotropic'
+
+    reshaped_final = np.empty((data.shape[0], *new_shape), dtype=dtype_out)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        if is_seg:
+            if not do_separate_z:
+                def _seg_channel(c):
+                    reshaped_final[c] = resample_segmentation_by_bbox(data[c], new_shape, order)
+                list(executor.map(_seg_channel, range(data.shape[0])))
+            else:
+                inplane_shape = [new_shape[i] if i != axis else shape[axis] for i in range(3)]
+                new_shape_2d = [new_shape[i] for i in range(3) if i != axis]
+                for c in range(data.shape[0]):
+                    reshaped_here = np.empty(inplane_shape, dtype=dtype_out)
+                    src = np.moveaxis(data[c], axis, 0)
+                    dst = np.moveaxis(reshaped_here, axis, 0)
+
+                    def _seg_slice(s):
+                        dst[s] = resample_segmentation_by_bbox(src[s], new_shape_2d, order)
+                    list(executor.map(_seg_slice, range(shape[axis])))
+                    if shape[axis] != new_shape[axis]:
+                        resample_along_axis(reshaped_here, new_shape[axis], axis, order_z, True,
+                                            out=reshaped_final[c])
+                    else:
+                        reshaped_final[c] = reshaped_here
+        else:
+            if np.dtype(dtype_out) == np.dtype(compute_dtype):
+                target = reshaped_final
+            else:
+                target = np.empty((data.shape[0], *new_shape), dtype=compute_dtype)
+
+            if not do_separate_z:
+                def _data_channel(c):
+                    _resize_image_into(data[c].astype(compute_dtype, copy=False), target[c], order)
+                list(executor.map(_data_channel, range(data.shape[0])))
+            else:
+                inplane_shape = [new_shape[i] if i != axis else shape[axis] for i in range(3)]
+                needs_z = shape[axis] != new_shape[axis]
+                # reuse one intermediate buffer for all channels if we need to resample along z afterwards
+                reshaped_here = np.empty(inplane_shape, dtype=compute_dtype) if needs_z else None
+                for c in range(data.shape[0]):
+                    inplane = reshaped_here if needs_z else target[c]
+                    src = np.moveaxis(data[c], axis, 0)
+                    dst = np.moveaxis(inplane, axis, 0)
+
+                    def _data_slice(s):
+                        _resize_image_into(src[s].astype(compute_dtype, copy=False), dst[s], order)
+                    list(executor.map(_data_slice, range(shape[axis])))
+                    if needs_z:
+                        resample_along_axis(inplane, new_shape[axis], axis, order_z, False, out=target[c])
+
+            if target is not reshaped_final:
+                reshaped_final[:] = target
+    return reshaped_final
+
+
+def resample_data_or_seg_to_shape_threaded(data: Union[torch.Tensor, np.ndarray],
+                                           new_shape: Union[Tuple[int, ...], List[int], np.ndarray],
+                                           current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                           new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                           is_seg: bool = False,
+                                           order: int = 3, order_z: int = 0,
+                                           force_separate_z: Union[bool, None] = False,
+                                           separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                           num_threads: int = None):
+    """
+    Drop-in replacement for default_resampling.resample_data_or_seg_to_shape
+    """
+    if isinstance(data, torch.Tensor):
+        data = data.numpy()
+
+    do_separate_z, axis = determine_do_sep_z_and_axis(force_separate_z, current_spacing, new_spacing,
+                                                      separate_z_anisotropy_threshold)
+
+    if data is not None:
+        assert data.ndim == 4, "data must be c x y z"
+
+    return resample_data_or_seg_threaded(data, new_shape, is_seg, axis, order, do_separate_z, order_z=order_z,
+                                         num_threads=num_threads)
+
+
+def resample_data_or_seg_to_spacing_threaded(data: np.ndarray,
+                                             current_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                             new_spacing: Union[Tuple[float, ...], List[float], np.ndarray],
+                                             is_seg: bool = False,
+                                             order: int = 3, order_z: int = 0,
+                                             force_separate_z: Union[bool, None] = False,
+                                             separate_z_anisotropy_threshold: float = ANISO_THRESHOLD,
+                                             num_threads: int = None):
+    new_shape = compute_new_shape(data.shape[1:], current_spacing, new_spacing)
+    return resample_data_or_seg_to_shape_threaded(data, new_shape, current_spacing, new_spacing, is_seg, order,
+                                                  order_z, force_separate_z, separate_z_anisotropy_threshold,
+                                                  num_threads)
+
+
+if __name__ == '__main__':
+    from time import time
+    from nnunetv2.preprocessing.resampling.default_resampling import resample_data_or_seg
+
+    # compare against default_resampling. Anisotropic image -> separate z
+    input_array = np.random.random((2, 42, 231, 142)).astype(np.float32)
+    output_shape = (52, 256, 256)
+    for sep_z in (True, False):
+        st = time()
+        ref = resample_data_or_seg(input_array, output_shape, is_seg=False, axis=0, order=3, order_z=0,
+                                   do_separate_z=sep_z)
+        t_ref = time() - st
+        st = time()
+        out = resample_data_or_seg_threaded(input_array, output_shape, is_seg=False, axis=0, order=3, order_z=0,
+                                            do_separate_z=sep_z)
+        t_new = time() - st
+        print(f'image, separate_z={sep_z}: default {t_ref:.2f}s, threaded {t_new:.2f}s, '
+              f'max abs diff {np.abs(ref.astype(np.float64) - out).max():.2e}')
+
+    seg = np.random.randint(0, 4, (1, 42, 231, 142)).astype(np.int16)
+    for sep_z in (True, False):
+        st = time()
+        ref = resample_data_or_seg(seg, output_shape, is_seg=True, axis=0, order=1, order_z=0, do_separate_z=sep_z)
+        t_ref = time() - st
+        st = time()
+        out = resample_data_or_seg_threaded(seg, output_shape, is_seg=True, axis=0, order=1, order_z=0,
+                                            do_separate_z=sep_z)
+        t_new = time() - st
+        print(f'seg, separate_z={sep_z}: default {t_ref:.2f}s, threaded {t_new:.2f}s, '
+              f'identical: {np.all(ref == out)}')
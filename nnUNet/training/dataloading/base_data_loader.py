@@ -18,7 +18,18 @@ class nnUNetDataLoaderBase(DataLoader):
                  sampling_probabilities: Union[List[int], Tuple[int, ...], np.ndarray] = None,
                  pad_sides: Union[List[int], Tuple[int, ...], np.ndarray] = None,
                  probabilistic_oversampling: bool = False,
-                 transforms=None):
+                 transforms=None,
+                 num_batch_buffers: int = None,
+                 pin_memory: bool = False):
+        """
+        num_batch_buffers: data_all/seg_all are written into preallocated buffers instead of being allocated for each
+        batch. None: a single pair of buffers is reused if transforms are used (the transforms output new tensors, so
+        the buffers never leave the data loader), without transforms the buffers are returned to the caller and fresh
+        arrays are allocated for each batch. An integer n > 0: ring of n buffer pairs, used in turn, also without
+        transforms. The caller must be done with a returned batch before n more batches are generated!
+        pin_memory: allocate the buffers in page locked memory (requires torch with CUDA). Only useful without
+        transforms, in that case returned batches can be copied to the GPU asynchronously
+        """
         super().__init__(data, batch_size, 1, None, True, False, True, sampling_probabilities)
         self.indices = list(data.keys())
 
@@ -42,6 +53,10 @@ class nnUNetDataLoaderBase(DataLoader):
         self.get_do_oversample = self._oversample_last_XX_percent if not probabilistic_oversampling \
             else self._probabilistic_oversampling
         self.transforms = transforms
+        self.num_batch_buffers = num_batch_buffers
+        self.pin_memory = pin_memory
+        self._batch_buffers = None
+        self._next_batch_buffer = 0
 
     def _oversample_last_XX_percent(self, sample_idx: int) -> bool:
         """
@@ -62,6 +77,53 @@ class nnUNetDataLoaderBase(DataLoader):
         seg_shape = (self.batch_size, seg.shape[0], *self.patch_size)
         return data_shape, seg_shape
 
+    def get_batch_buffers(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        data_all and seg_all for the next batch, see num_batch_buffers. Content is undefined, every sample must be
+        written entirely (place_patch does that)
+        """
+        num_buffers = self.num_batch_buffers if self.num_batch_buffers is not None else \
+            (1 if self.transforms is not None else 0)
+        if num_buffers == 0:
+            return np.empty(self.data_shape, dtype=np.float32), np.empty(self.seg_shape, dtype=np.int16)
+        if self._batch_buffers is None:
+            # allocated on first use so that they are not pickled into the background workers
+            self._batch_buffers = [self._allocate_buffer_pair() for _ in range(num_buffers)]
+        buffers = self._batch_buffers[self._next_batch_buffer]
+        self._next_batch_buffer = (self._next_batch_buffer + 1) % num_buffers
+        return buffers
+
+    def _allocate_buffer_pair(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.pin_memory:
+            import torch
+            return torch.empty(self.data_shape, dtype=torch.float32, pin_memory=True).numpy(), \
+                torch.empty(self.seg_shape, dtype=torch.int16, pin_memory=True).numpy()
+        return np.empty(self.data_shape, dtype=np.float32), np.empty(self.seg_shape, dtype=np.int16)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_batch_buffers'] = None
+        return state
+
+    @staticmethod
+    def place_patch(dst: np.ndarray, src: np.ndarray, padding: List[Tuple[int, int]], pad_value) -> None:
+        """
+        Writes src (c, *valid region) into dst (c, *patch_size) without temporary arrays: the interior is copied
+        directly (if src is a memory map or a view into one, this is the only copy), the padding slabs
+        (padding[d] = (before, after) along spatial axis d) are filled with pad_value in place. Replaces
+        dst[:] = np.pad(src, ...)
+        """
+        interior = [slice(None)]
+        for d, (before, after) in enumerate(padding):
+            n = dst.shape[d + 1]
+            leading = (slice(None), ) * (d + 1)
+            if before > 0:
+                dst[leading + (slice(0, before), )] = pad_value
+            if after > 0:
+                dst[leading + (slice(n - after, n), )] = pad_value
+            interior.append(slice(before, n - after))
+        dst[tuple(interior)] = src
+
     def get_bbox(self, data_shape: np.ndarray, force_fg: bool, class_locations: Union[dict, None],
                  overwrite_class: Union[int, Tuple[int, ...]] = None, verbose: bool = False):
         # in dataloader 2d we need to select the slice prior to this and also modify the class_locations to only have
@@ -126,7 +188,8 @@ class nnUNetDataLoaderBase(DataLoader):
             voxels_of_that_class = class_locations[selected_class] if selected_class is not None else None
 
             if voxels_of_that_class is not None and len(voxels_of_that_class) > 0:
-                selected_voxel = voxels_of_that_class[np.random.choice(len(voxels_of_that_class))]
+                # class locations may be stored as int16. Python ints so that the arithmetic below cannot overflow
+                selected_voxel = [int(i) for i in voxels_of_that_class[np.random.choice(len(voxels_of_that_class))]]
                 # selected voxel is center voxel. Subtract half the patch size to get lower bbox voxel.
                 # Make sure it is within the bounds of lb and ub
                 # i + 1 because we have first dimension 0!
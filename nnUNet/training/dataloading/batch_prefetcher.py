@@ -0,0 +1,126 @@
+"""
+Reading the patches of a batch from disk (page faults on memory mapped .npy, decoding .b2nd chunks) happens on the
+critical path of the data loader: augmentation of the batch can only start once all its patches are there. With a cold
+page cache (first epoch, network file systems, datasets larger than RAM) that is what keeps the GPU waiting.
+
+BatchPrefetcher runs the first part of batch generation (choosing keys and bounding boxes, reading the patches) for the
+next batches in a background thread while the current batch is being augmented. Before the patches of a batch are read,
+kernel readahead is requested for all of them (readahead_memmap_region), so the reads of the individual patches are
+in flight at the same time instead of one after the other.
+
+Reading from memory maps and decoding blosc2 chunks don't need the GIL for the most part, so the thread does not slow
+down augmentation much.
+"""
+
+import os
+import queue
+import threading
+from time import time
+from typing import Callable, Tuple
+
+import numpy as np
+
+
+def readahead_memmap_region(arr: np.ndarray, slicer: Tuple[slice, ...]) -> bool:
+    """
+    Asks the kernel to start reading the parts of the file behind the memory mapped, C contiguous array arr that are
+    needed for arr[slicer] (posix_fadvise WILLNEED, returns immediately). One request per run of contiguous bytes along
+    the last two axes, the last axis is read entirely (it is contiguous and usually short). Returns False if arr is not
+    a memory map of a file or the platform does not support it, nothing happens in that case
+    """
+    if not isinstance(arr, np.memmap) or getattr(arr, 'filename', None) is None or \
+            not hasattr(os, 'posix_fadvise') or not arr.flags['C_CONTIGUOUS'] or arr.ndim < 2:
+        return False
+    slicer = tuple(slicer) + tuple([slice(None)] * (arr.ndim - len(slicer)))
+    ranges = [range(*s.indices(n)) for s, n in zip(slicer, arr.shape)]
+    row_bytes = arr.strides[-2]
+    # [start, end) of each run along axis -2 for all index combinations of the leading axes
+    leading = np.stack(np.meshgrid(*[np.array(r, dtype=np.int64) for r in ranges[:-2]], indexing='ij'), -1).reshape(
+        -1, arr.ndim - 2) if arr.ndim > 2 else np.zeros((1, 0), dtype=np.int64)
+    starts = arr.offset + leading @ np.array(arr.strides[:-2], dtype=np.int64) + ranges[-2].start * row_bytes
+    length = len(ranges[-2]) * row_bytes
+    if length == 0:
+        return True
+    fd = os.open(arr.filename, os.O_RDONLY)
+    try:
+        for s in starts:
+            os.posix_fadvise(fd, int(s), length, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+class BatchPrefetcher(object):
+    def __init__(self, produce_fn: Callable, depth: int):
+        """
+        produce_fn() is called in a background thread and its return values are handed out by get() in the same order.
+        depth: how many results are produced ahead of time. Exceptions raised by produce_fn (including StopIteration)
+        are re-raised by get().
+
+        The thread is started on the first call to get() and belongs to the process that called it (data loaders are
+        copied into the background workers of the augmenter, threads are not). Pickling drops it.
+
+        Instrumentation (see stats()): a stall is a call to get() that had to wait because nothing was prefetched yet.
+        The stall time is the time the caller waited, i.e. what prefetching did not manage to hide
+        """
+        assert depth > 0
+        self.produce_fn = produce_fn
+        self.depth = depth
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.num_batches = 0
+        self.num_stalls = 0
+        self.stall_time = 0.
+        self.produce_time = 0.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_queue'] = None
+        state['_thread'] = None
+        state['_pid'] = None
+        return state
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            start = time()
+            try:
+                item = (self.produce_fn(), None)
+            except Exception as e:
+                item = (None, e)
+            self.produce_time += time() - start
+            q.put(item)
+            if item[1] is not None:
+                return
+
+    def _start(self) -> None:
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._thread = threading.Thread(target=self._run, args=(self._queue, ), daemon=True)
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def get(self):
+        if self._pid != os.getpid():
+            self._start()
+        if self._queue.empty():
+            self.num_stalls += 1
+            start = time()
+            result, exception = self._queue.get()
+            self.stall_time += time() - start
+        else:
+            result, exception = self._queue.get()
+        if exception is not None:
+            # start over on the next call (for example after StopIteration at the end of an epoch)
+            self._pid = None
+            raise exception
+        self.num_batches += 1
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.num_batches,
+            'stalls': self.num_stalls,
+            'stall_time': self.stall_time,
+            'mean_stall_time': self.stall_time / max(1, self.num_stalls),
+            'mean_produce_time': self.produce_time / max(1, self.num_batches),
+        }
@@ -9,9 +9,7 @@ from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
 class nnUNetDataLoader2D(nnUNetDataLoaderBase):
     def generate_train_batch(self):
         selected_keys = self.get_indices()
-        # preallocate memory for data and seg
-        data_all = np.zeros(self.data_shape, dtype=np.float32)
-        seg_all = np.zeros(self.seg_shape, dtype=np.int16)
+        data_all, seg_all = self.get_batch_buffers()
         case_properties = []
 
         for j, current_key in enumerate(selected_keys):
@@ -44,12 +42,21 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
                     len(eligible_classes_or_regions) > 0 else None
 
             if selected_class_or_region is not None:
-                selected_slice = np.random.choice(properties['class_locations'][selected_class_or_region][:, 1])
+                locations = properties['class_locations'][selected_class_or_region]
+                if 'class_slice_index' in properties.keys():
+                    # consolidated properties of 2d folders (see properties_index.py): locations are sorted by slice
+                    # and we know where each slice starts. Drawing a location and taking its slice (same
+                    # distribution as below) then only needs a binary search and the locations of the selected slice
+                    # are a contiguous block. No pass over all locations of the case
+                    rows = properties['class_slice_index'][selected_class_or_region]
+                    row = rows[np.searchsorted(rows[:, 2], np.random.randint(0, len(locations)), side='right')]
+                    selected_slice = row[0]
+                    locations_in_slice = locations[row[1]:row[2]]
+                else:
+                    selected_slice = np.random.choice(locations[:, 1])
+                    locations_in_slice = locations[locations[:, 1] == selected_slice]
             else:
-                selected_slice = np.random.choice(len(data[0]))
-
-            data = data[:, selected_slice]
-            seg = seg[:, selected_slice]
+                selected_slice = np.random.choice(data.shape[1])
 
             # the line of death lol
             # this needs to be a separate variable because we could otherwise permanently overwrite
@@ -59,11 +66,11 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             # - A tuple of all (non-ignore) labels if there is an ignore label and force_fg is False
             # - a class or region if force_fg is True
             class_locations = {
-                selected_class_or_region: properties['class_locations'][selected_class_or_region][properties['class_locations'][selected_class_or_region][:, 1] == selected_slice][:, (0, 2, 3)]
+                selected_class_or_region: locations_in_slice[:, (0, 2, 3)]
             } if (selected_class_or_region is not None) else None
 
             # print(properties)
-            shape = data.shape[1:]
+            shape = data.shape[2:]
             dim = len(shape)
             bbox_lbs, bbox_ubs = self.get_bbox(shape, force_fg if selected_class_or_region is not None else False,
                                                class_locations, overwrite_class=selected_class_or_region)
@@ -80,15 +87,22 @@ class nnUNetDataLoader2D(nnUNetDataLoaderBase):
             # Why not just concatenate them here and forget about the if statements? Well that's because segneeds to
             # be padded with -1 constant whereas seg_from_previous_stage needs to be padded with 0s (we could also
             # remove label -1 in the data augmentation but this way it is less error prone)
-            this_slice = tuple([slice(0, data.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+            # slice and bbox are applied in one go, so memory maps and chunked (blosc2) cases only read the patch
+            this_slice = tuple([slice(0, data.shape[0]), selected_slice] +
+                               [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
             data = data[this_slice]
 
-            this_slice = tuple([slice(0, seg.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+            this_slice = tuple([slice(0, seg.shape[0]), selected_slice] +
+                               [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
             seg = seg[this_slice]
 
+            # the valid region goes straight into the batch, padding is filled in place
             padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
-            data_all[j] = np.pad(data, ((0, 0), *padding), 'constant', constant_values=0)
-            seg_all[j] = np.pad(seg, ((0, 0), *padding), 'constant', constant_values=-1)
+            self.place_patch(data_all[j], data, padding, 0)
+            self.place_patch(seg_all[j], seg, padding, -1)
+        # incomplete last batch (infinite=False)
+        data_all[len(selected_keys):] = 0
+        seg_all[len(selected_keys):] = 0
 
         if self.transforms is not None:
             with torch.no_grad():
@@ -1,18 +1,35 @@
+import os
+
 import numpy as np
 import torch
 from threadpoolctl import threadpool_limits
 
 from nnunetv2.training.dataloading.base_data_loader import nnUNetDataLoaderBase
+from nnunetv2.training.dataloading.batch_prefetcher import BatchPrefetcher, readahead_memmap_region
 from nnunetv2.training.dataloading.nnunet_dataset import nnUNetDataset
 
 
 class nnUNetDataLoader3D(nnUNetDataLoaderBase):
-    def generate_train_batch(self):
+    def __init__(self, *args, prefetch_depth: int = None, **kwargs):
+        """
+        Same arguments as nnUNetDataLoaderBase plus prefetch_depth: number of batches whose patches are read ahead of
+        time in a background thread (see BatchPrefetcher). None = nnUNet_prefetch_depth if set, else 0 (disabled).
+        Prefetching draws the random numbers for key and bbox selection in that thread, so with prefetching the
+        sequence of patches is not reproducible for a given seed anymore
+        """
+        super().__init__(*args, **kwargs)
+        if prefetch_depth is None:
+            prefetch_depth = int(os.environ['nnUNet_prefetch_depth']) if 'nnUNet_prefetch_depth' in os.environ.keys() \
+                else 0
+        self.prefetcher = BatchPrefetcher(self.read_batch_patches, prefetch_depth) if prefetch_depth > 0 else None
+
+    def read_batch_patches(self):
+        """
+        selects the keys and bboxes of a batch and reads the part of each bbox that lies within the case. Returns the
+        keys and for each sample (data, seg, padding)
+        """
         selected_keys = self.get_indices()
-        # preallocate memory for data and seg
-        data_all = np.zeros(self.data_shape, dtype=np.float32)
-        seg_all = np.zeros(self.seg_shape, dtype=np.int16)
-        case_properties = []
+        samples = []
 
         for j, i in enumerate(selected_keys):
             # oversampling foreground will improve stability of model training, especially if many patches are empty
@@ -20,7 +37,6 @@ class nnUNetDataLoader3D(nnUNetDataLoaderBase):
             force_fg = self.get_do_oversample(j)
 
             data, seg, properties = self._data.load_case(i)
-            case_properties.append(properties)
 
             # If we are doing the cascade then the segmentation from the previous stage will already have been loaded by
             # self._data.load_case(i) (see nnUNetDataset.load_case)
@@ -34,21 +50,46 @@ class nnUNetDataLoader3D(nnUNetDataLoaderBase):
             # later
             valid_bbox_lbs = np.clip(bbox_lbs, a_min=0, a_max=None)
             valid_bbox_ubs = np.minimum(shape, bbox_ubs)
+            padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
+            samples.append((data, seg, tuple([slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)]), padding))
+
+        if self.prefetcher is not None:
+            # get the reads of all patches going at once, the loop below then mostly finds them in the page cache
+            for data, seg, spatial_slice, _ in samples:
+                readahead_memmap_region(data, (slice(None), *spatial_slice))
+                readahead_memmap_region(seg, (slice(None), *spatial_slice))
 
+        patches = []
+        for data, seg, spatial_slice, padding in samples:
             # At this point you might ask yourself why we would treat seg differently from seg_from_previous_stage.
             # Why not just concatenate them here and forget about the if statements? Well that's because segneeds to
             # be padded with -1 constant whereas seg_from_previous_stage needs to be padded with 0s (we could also
             # remove label -1 in the data augmentation but this way it is less error prone)
-            this_slice = tuple([slice(0, data.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+            this_slice = tuple([slice(0, data.shape[0])] + list(spatial_slice))
             data = data[this_slice]
 
-            this_slice = tuple([slice(0, seg.shape[0])] + [slice(i, j) for i, j in zip(valid_bbox_lbs, valid_bbox_ubs)])
+            this_slice = tuple([slice(0, seg.shape[0])] + list(spatial_slice))
             seg = seg[this_slice]
+            if self.prefetcher is not None:
+                # memory maps are lazy, make sure the data is actually read here and not in the main thread
+                data, seg = np.array(data), np.array(seg)
+            patches.append((data, seg, padding))
+        return selected_keys, patches
 
-            padding = [(-min(0, bbox_lbs[i]), max(bbox_ubs[i] - shape[i], 0)) for i in range(dim)]
-            padding = ((0, 0), *padding)
-            data_all[j] = np.pad(data, padding, 'constant', constant_values=0)
-            seg_all[j] = np.pad(seg, padding, 'constant', constant_values=-1)
+    def generate_train_batch(self):
+        if self.prefetcher is not None:
+            selected_keys, patches = self.prefetcher.get()
+        else:
+            selected_keys, patches = self.read_batch_patches()
+        data_all, seg_all = self.get_batch_buffers()
+
+        for j, (data, seg, padding) in enumerate(patches):
+            # the valid region goes straight into the batch, padding is filled in place
+            self.place_patch(data_all[j], data, padding, 0)
+            self.place_patch(seg_all[j], seg, padding, -1)
+        # incomplete last batch (infinite=False)
+        data_all[len(patches):] = 0
+        seg_all[len(patches):] = 0
 
         if self.transforms is not None:
             with torch.no_grad():
@@ -78,3 +119,8 @@ if __name__ == '__main__':
     ds = nnUNetDataset(folder, 0)  # this should not load the properties!
     dl = nnUNetDataLoader3D(ds, 5, (16, 16, 16), (16, 16, 16), 0.33, None, None)
     a = next(dl)
+
+    dl = nnUNetDataLoader3D(ds, 5, (16, 16, 16), (16, 16, 16), 0.33, None, None, prefetch_depth=2)
+    for _ in range(10):
+        a = next(dl)
+    print(dl.prefetcher.stats())
@@ -1,23 +1,87 @@
 import os
-from typing import List
+from typing import List, TYPE_CHECKING
 
 import numpy as np
 import shutil
 
 from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, isfile
+from nnunetv2.training.dataloading.properties_index import PropertiesIndex
 from nnunetv2.training.dataloading.utils import get_case_identifiers
+from nnunetv2.utilities.blosc2_storage import B2ND_FILE_ENDING, open_b2nd
+
+if TYPE_CHECKING:
+    # imported when a cache is actually used, it needs fcntl (not available on Windows)
+    from nnunetv2.training.dataloading.shared_case_cache import SharedCaseCache
+
+
+def _nbytes(arr) -> int:
+    # works for numpy and blosc2 arrays (without reading them)
+    return int(np.prod(arr.shape)) * np.dtype(arr.dtype).itemsize
+
+
+class LazyStackedArray(object):
+    def __init__(self, arrays: list):
+        """
+        Behaves like np.vstack(arrays) (for .shape, .dtype and slicing) without creating it. Indexing slices each array
+        on its own (memory maps and blosc2 arrays only read what is needed) and concatenates the results. Index with a
+        tuple of slices/ints, the first entry selects channels (slices with step 1 or ints). np.asarray() gives the
+        full stack
+        """
+        self.arrays = arrays
+        self.num_channels = [a.shape[0] for a in arrays]
+        self.shape = (sum(self.num_channels), *arrays[0].shape[1:])
+        assert all([a.shape[1:] == self.shape[1:] for a in arrays]), 'all arrays must have the same spatial shape'
+        self.dtype = np.result_type(*[a.dtype for a in arrays])
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        ret = np.vstack([a[:] for a in self.arrays]).astype(self.dtype, copy=False)
+        return ret if dtype is None else ret.astype(dtype, copy=False)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item, )
+        channels, rest = item[0], item[1:]
+        if isinstance(channels, (int, np.integer)):
+            channels = int(channels) + self.shape[0] if channels < 0 else int(channels)
+            for a, c in zip(self.arrays, self.num_channels):
+                if channels < c:
+                    return np.asarray(a[(channels, *rest)]).astype(self.dtype, copy=False)
+                channels -= c
+            raise IndexError(f'index {item[0]} is out of bounds for axis 0 with size {self.shape[0]}')
+        if not isinstance(channels, slice) or any([i is Ellipsis or i is None for i in rest]):
+            return np.asarray(self)[item]
+        start, stop, step = channels.indices(self.shape[0])
+        if step != 1:
+            return np.asarray(self)[item]
+        parts = []
+        offset = 0
+        for a, c in zip(self.arrays, self.num_channels):
+            lo, hi = max(start, offset), min(stop, offset + c)
+            if lo < hi:
+                parts.append(np.asarray(a[(slice(lo - offset, hi - offset), *rest)]))
+            offset += c
+        if len(parts) == 0:
+            # empty channel selection, let numpy figure out the shape of the result
+            return np.asarray(self.arrays[0][(slice(0, 0), *rest)]).astype(self.dtype)
+        return np.concatenate(parts).astype(self.dtype, copy=False)
 
 
 class nnUNetDataset(object):
     def __init__(self, folder: str, case_identifiers: List[str] = None,
                  num_images_properties_loading_threshold: int = 0,
-                 folder_with_segs_from_previous_stage: str = None):
+                 folder_with_segs_from_previous_stage: str = None,
+                 case_cache: 'SharedCaseCache' = None):
         """
         This does not actually load the dataset. It merely creates a dictionary where the keys are training case names and
         the values are dictionaries containing the relevant information for that case.
         dataset[training_case] -> info
         Info has the following key:value pairs:
         - dataset[case_identifier]['properties']['data_file'] -> the full path to the npz file associated with the training case
+          (or the b2nd file if the case was preprocessed with nnUNet_preprocessed_format=blosc2)
         - dataset[case_identifier]['properties']['properties_file'] -> the pkl file containing the case properties
 
         In addition, if the total number of cases is < num_images_properties_loading_threshold we load all the pickle files
@@ -29,6 +93,14 @@ class nnUNetDataset(object):
         If properties are loaded into the RAM, the info dicts each will have an additional entry:
         - dataset[case_identifier]['properties'] -> pkl file content
 
+        If the folder contains consolidated properties (see properties_index.py, written by the preprocessor) the
+        properties are taken from there instead of the pkl files. class_locations are then read from a shared memory
+        map, so there is nothing to load into RAM upfront and num_images_properties_loading_threshold does not matter
+        for these cases.
+
+        case_cache: optional SharedCaseCache (RAM budgeted, shared by all data loader workers). If None and
+        nnUNet_case_cache_gb is set, a cache with that budget is created for this folder.
+
         IMPORTANT! THIS CLASS ITSELF IS READ-ONLY. YOU CANNOT ADD KEY:VALUE PAIRS WITH nnUNetDataset[key] = value
         USE THIS INSTEAD:
         nnUNetDataset.dataset[key] = value
@@ -43,23 +115,36 @@ class nnUNetDataset(object):
         self.dataset = {}
         for c in case_identifiers:
             self.dataset[c] = {}
-            self.dataset[c]['data_file'] = join(folder, f"{c}.npz")
+            self.dataset[c]['data_file'] = join(folder, f"{c}{B2ND_FILE_ENDING}") if \
+                isfile(join(folder, f"{c}{B2ND_FILE_ENDING}")) else join(folder, f"{c}.npz")
             self.dataset[c]['properties_file'] = join(folder, f"{c}.pkl")
             if folder_with_segs_from_previous_stage is not None:
                 self.dataset[c]['seg_from_prev_stage_file'] = join(folder_with_segs_from_previous_stage, f"{c}.npz")
 
+        self.properties_index = PropertiesIndex(folder) if PropertiesIndex.exists(folder) else None
+
         if len(case_identifiers) <= num_images_properties_loading_threshold:
             for i in self.dataset.keys():
-                self.dataset[i]['properties'] = load_pickle(self.dataset[i]['properties_file'])
+                if self.properties_index is None or i not in self.properties_index:
+                    self.dataset[i]['properties'] = load_pickle(self.dataset[i]['properties_file'])
 
         self.keep_files_open = ('nnUNet_keep_files_open' in os.environ.keys()) and \
                                (os.environ['nnUNet_keep_files_open'].lower() in ('true', '1', 't'))
         # print(f'nnUNetDataset.keep_files_open: {self.keep_files_open}')
 
+        if case_cache is None and 'nnUNet_case_cache_gb' in os.environ.keys():
+            from nnunetv2.training.dataloading.shared_case_cache import SharedCaseCache
+            case_cache = SharedCaseCache.for_preprocessed_folder(
+                int(float(os.environ['nnUNet_case_cache_gb']) * 1024 ** 3), folder)
+        self.case_cache = case_cache
+
     def __getitem__(self, key):
         ret = {**self.dataset[key]}
         if 'properties' not in ret.keys():
-            ret['properties'] = load_pickle(ret['properties_file'])
+            if self.properties_index is not None and key in self.properties_index:
+                ret['properties'] = self.properties_index.get_properties(key)
+            else:
+                ret['properties'] = load_pickle(ret['properties_file'])
         return ret
 
     def __setitem__(self, key, value):
@@ -79,6 +164,38 @@ class nnUNetDataset(object):
 
     def load_case(self, key):
         entry = self[key]
+        cached = self.case_cache.get(key, entry['data_file']) if self.case_cache is not None else None
+        if cached is not None:
+            data, seg = cached
+        else:
+            data, seg = self._load_data_and_seg(key, entry)
+            # the cache holds the decoded case, so storing it means reading it entirely. Only do that if it is stored,
+            # otherwise the data loader reads just the patch
+            if self.case_cache is not None and self.case_cache.admit(_nbytes(data) + _nbytes(seg)):
+                data, seg = data[:], seg[:]
+                self.case_cache.put(key, entry['data_file'], data, seg)
+
+        if 'seg_from_prev_stage_file' in entry.keys():
+            if isfile(entry['seg_from_prev_stage_file'][:-4] + ".npy"):
+                seg_prev = np.load(entry['seg_from_prev_stage_file'][:-4] + ".npy", 'r')
+            else:
+                seg_prev = np.load(entry['seg_from_prev_stage_file'])['seg']
+            # no np.vstack: that would copy both segmentations entirely for every patch. The data loaders only
+            # slice seg, so both parts are sliced independently and only the patches are concatenated
+            seg = LazyStackedArray([seg, seg_prev[None]])
+
+        return data, seg, entry['properties']
+
+    def _load_data_and_seg(self, key, entry):
+        if entry['data_file'].endswith(B2ND_FILE_ENDING):
+            # lazy arrays, slicing them only decodes the chunks that are needed. Opening is cheap and the handles are
+            # not picklable, so they are not kept open
+            data = open_b2nd(entry['data_file'])
+            seg = open_b2nd(entry['data_file'][:-len(B2ND_FILE_ENDING)] + '_seg' + B2ND_FILE_ENDING)
+            return data, seg
+        return self._load_npy_or_npz(key, entry)
+
+    def _load_npy_or_npz(self, key, entry):
         if 'open_data_file' in entry.keys():
             data = entry['open_data_file']
             # print('using open data file')
@@ -100,15 +217,7 @@ class nnUNetDataset(object):
                 # print('saving open seg file')
         else:
             seg = np.load(entry['data_file'])['seg']
-
-        if 'seg_from_prev_stage_file' in entry.keys():
-            if isfile(entry['seg_from_prev_stage_file'][:-4] + ".npy"):
-                seg_prev = np.load(entry['seg_from_prev_stage_file'][:-4] + ".npy", 'r')
-            else:
-                seg_prev = np.load(entry['seg_from_prev_stage_file'])['seg']
-            seg = np.vstack((seg, seg_prev[None]))
-
-        return data, seg, entry['properties']
+        return data, seg
 
 
 if __name__ == '__main__':
@@ -0,0 +1,200 @@
+"""
+Consolidated properties of all cases of a preprocessed folder. Written once after preprocessing, replaces reading one
+pkl file per case during training:
+- class_locations.npy: the class_locations of all cases concatenated into one (n, ndim) int32 array. Opened as memory
+  map, so all data loader workers share the same pages (page cache) instead of each holding its own copy
+- class_locations_offsets.npy: (num_cases, num_classes_or_regions, 2) [start, end) rows into class_locations.npy.
+  start = -1 if the case has no entry for that class/region
+- properties_index.pkl: case order, class/region keys, the properties of each case without class_locations (small) and
+  the size/mtime of each case's pkl file at the time of consolidation
+
+For 2d configurations (slice_index=True) the locations of each case and class are (stably) sorted by slice and a slice
+index is written in addition:
+- class_locations_slice_index.npy: (m, 3) rows [slice, start, end), start/end relative to the class_locations array of
+  the case and class, one row per slice that contains the class
+- class_locations_slice_offsets.npy: (num_cases, num_classes_or_regions, 2) [start, end) rows into the slice index
+The 2d data loader uses it to pick a foreground slice and its locations without touching the other slices.
+
+If a pkl file changed after consolidation (preprocessing interrupted, cases preprocessed with another tool, ...) that
+case is not served from the index and nnUNetDataset falls back to reading the pkl.
+"""
+
+import os
+from typing import Dict, List, Union
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, load_pickle, write_pickle, isfile
+
+from nnunetv2.utilities.hashing import file_stat_signature
+
+
+PROPERTIES_INDEX_FILE = 'properties_index.pkl'
+CLASS_LOCATIONS_FILE = 'class_locations.npy'
+CLASS_LOCATIONS_OFFSETS_FILE = 'class_locations_offsets.npy'
+SLICE_INDEX_FILE = 'class_locations_slice_index.npy'
+SLICE_INDEX_OFFSETS_FILE = 'class_locations_slice_offsets.npy'
+
+
+def _save_npy_atomic(array: np.ndarray, filename: str) -> None:
+    # np.save appends .npy to file names that don't end with it
+    tmp_file = filename[:-4] + '_tmp.npy'
+    np.save(tmp_file, array)
+    os.replace(tmp_file, filename)
+
+
+def consolidate_properties(folder: str, case_identifiers: List[str], slice_index: bool = False) -> None:
+    """
+    Reads the pkl files of all case_identifiers in folder and writes the consolidated properties (see module docstring)
+    into the same folder. Run this again whenever cases were (re)preprocessed. slice_index: sort by slice and write the
+    slice index (2d configurations)
+    """
+    class_keys = []
+    properties_without_locations = {}
+    pkl_stats = {}
+    locations = {}
+    ndim = None
+    for c in case_identifiers:
+        properties_file = join(folder, c + '.pkl')
+        pkl_stats[c] = file_stat_signature(properties_file)
+        properties = load_pickle(properties_file)
+        if 'class_locations' in properties.keys():
+            locations[c] = properties.pop('class_locations')
+        properties_without_locations[c] = properties
+        for k, v in locations.get(c, {}).items():
+            if k not in class_keys:
+                class_keys.append(k)
+            if len(v) > 0:
+                ndim = np.asarray(v).shape[1]
+
+    offsets = np.full((len(case_identifiers), len(class_keys), 2), -1, dtype=np.int64)
+    slice_offsets = np.full((len(case_identifiers), len(class_keys), 2), -1, dtype=np.int64)
+    arrays = []
+    slice_rows = []
+    current = 0
+    current_slice_row = 0
+    for i, c in enumerate(case_identifiers):
+        for j, k in enumerate(class_keys):
+            if c not in locations.keys() or k not in locations[c].keys():
+                continue
+            v = locations[c][k]
+            n = len(v)
+            offsets[i, j] = current, current + n
+            if n > 0:
+                v = np.asarray(v, dtype=np.int32)
+                if slice_index:
+                    v = v[np.argsort(v[:, 1], kind='stable')]
+                    slices, starts = np.unique(v[:, 1], return_index=True)
+                    rows = np.stack((slices, starts, np.append(starts[1:], n)), 1)
+                    slice_offsets[i, j] = current_slice_row, current_slice_row + len(rows)
+                    slice_rows.append(rows.astype(np.int32))
+                    current_slice_row += len(rows)
+                arrays.append(v)
+                current += n
+            elif slice_index:
+                slice_offsets[i, j] = current_slice_row, current_slice_row
+    all_locations = np.concatenate(arrays) if len(arrays) > 0 else \
+        np.zeros((0, ndim if ndim is not None else 4), dtype=np.int32)
+
+    _save_npy_atomic(all_locations, join(folder, CLASS_LOCATIONS_FILE))
+    _save_npy_atomic(offsets, join(folder, CLASS_LOCATIONS_OFFSETS_FILE))
+    if slice_index:
+        _save_npy_atomic(np.concatenate(slice_rows) if len(slice_rows) > 0 else np.zeros((0, 3), dtype=np.int32),
+                         join(folder, SLICE_INDEX_FILE))
+        _save_npy_atomic(slice_offsets, join(folder, SLICE_INDEX_OFFSETS_FILE))
+    else:
+        for f in (SLICE_INDEX_FILE, SLICE_INDEX_OFFSETS_FILE):
+            if isfile(join(folder, f)):
+                os.remove(join(folder, f))
+    # the index is written last. It references the arrays, so it must never be newer than them
+    write_pickle({'case_identifiers': list(case_identifiers),
+                  'class_keys': class_keys,
+                  'properties': properties_without_locations,
+                  'cases_with_class_locations': list(locations.keys()),
+                  'pkl_stats': pkl_stats}, join(folder, PROPERTIES_INDEX_FILE + '.tmp'))
+    os.replace(join(folder, PROPERTIES_INDEX_FILE + '.tmp'), join(folder, PROPERTIES_INDEX_FILE))
+
+
+class PropertiesIndex(object):
+    def __init__(self, folder: str, validate: bool = True):
+        """
+        Read only view on the consolidated properties of folder. validate: only serve cases whose pkl file did not
+        change since consolidation (one os.stat per case)
+
+        The class_locations memory map is opened on first use and not pickled, so data loader worker processes open
+        their own map of the same file instead of receiving a copy of it
+        """
+        self.folder = folder
+        index = load_pickle(join(folder, PROPERTIES_INDEX_FILE))
+        self.class_keys = index['class_keys']
+        self._properties = index['properties']
+        self._cases_with_class_locations = set(index['cases_with_class_locations'])
+        self._offsets = np.load(join(folder, CLASS_LOCATIONS_OFFSETS_FILE))
+        self._row_of_case = {c: i for i, c in enumerate(index['case_identifiers'])}
+        if validate:
+            for c in index['case_identifiers']:
+                properties_file = join(folder, c + '.pkl')
+                if not isfile(properties_file) or file_stat_signature(properties_file) != index['pkl_stats'][c]:
+                    del self._row_of_case[c]
+        self._class_locations = None
+        self.has_slice_index = isfile(join(folder, SLICE_INDEX_OFFSETS_FILE))
+        self._slice_offsets = np.load(join(folder, SLICE_INDEX_OFFSETS_FILE)) if self.has_slice_index else None
+        self._slice_index = None
+
+    @staticmethod
+    def exists(folder: str) -> bool:
+        return all([isfile(join(folder, i)) for i in (PROPERTIES_INDEX_FILE, CLASS_LOCATIONS_FILE,
+                                                      CLASS_LOCATIONS_OFFSETS_FILE)])
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_class_locations'] = None
+        state['_slice_index'] = None
+        return state
+
+    def __contains__(self, case_identifier: str) -> bool:
+        return case_identifier in self._row_of_case.keys()
+
+    def keys(self):
+        return self._row_of_case.keys()
+
+    def _get_class_locations_array(self) -> np.ndarray:
+        if self._class_locations is None:
+            self._class_locations = np.load(join(self.folder, CLASS_LOCATIONS_FILE), mmap_mode='r')
+        return self._class_locations
+
+    def get_class_locations(self, case_identifier: str) -> Dict[Union[int, tuple], np.ndarray]:
+        """
+        same as properties['class_locations'] but the arrays are views into the memory map (nothing is read before
+        they are indexed)
+        """
+        all_locations = self._get_class_locations_array()
+        row = self._offsets[self._row_of_case[case_identifier]]
+        return {k: all_locations[row[j, 0]:row[j, 1]] for j, k in enumerate(self.class_keys) if row[j, 0] != -1}
+
+    def get_class_slice_index(self, case_identifier: str) -> Dict[Union[int, tuple], np.ndarray]:
+        """
+        {class/region: (m, 3) [slice, start, end)} for the (slice sorted) arrays of get_class_locations
+        """
+        if self._slice_index is None:
+            self._slice_index = np.load(join(self.folder, SLICE_INDEX_FILE), mmap_mode='r')
+        row = self._slice_offsets[self._row_of_case[case_identifier]]
+        return {k: self._slice_index[row[j, 0]:row[j, 1]] for j, k in enumerate(self.class_keys) if row[j, 0] != -1}
+
+    def get_properties(self, case_identifier: str) -> dict:
+        """
+        drop-in replacement for load_pickle(<case>.pkl)
+        """
+        properties = {**self._properties[case_identifier]}
+        if case_identifier in self._cases_with_class_locations:
+            properties['class_locations'] = self.get_class_locations(case_identifier)
+            if self.has_slice_index:
+                properties['class_slice_index'] = self.get_class_slice_index(case_identifier)
+        return properties
+
+
+if __name__ == '__main__':
+    from nnunetv2.training.dataloading.utils import get_case_identifiers
+    folder = '/media/fabian/data/nnUNet_preprocessed/Dataset002_Heart/3d_fullres'
+    consolidate_properties(folder, get_case_identifiers(folder))
+    idx = PropertiesIndex(folder)
+    print(idx.get_properties(list(idx.keys())[0]))
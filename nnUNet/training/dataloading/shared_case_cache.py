@@ -0,0 +1,228 @@
+"""
+RAM-budgeted LRU cache of preprocessed cases that is shared by all data loader worker processes (and by all trainings
+that use the same preprocessed folder, for example the 5 folds).
+
+Cached cases are stored as uncompressed .npy files in a folder on a RAM backed file system (/dev/shm by default) and
+read as memory maps. All processes map the same pages, so a case occupies RAM only once no matter how many workers
+use it. The least recently used cases are evicted once the budget would be exceeded. Readers that still have an
+evicted case mapped keep working (the pages are freed once the last map is closed).
+
+Admission: a case is only worth decoding and writing on a miss if it gets stored. By default (evict=False) cases are
+added until the budget is used up and then the cached set stays as it is. Training samples cases uniformly at random,
+so any fixed subset that fills the budget has the same hit rate as LRU. Evicting on every miss would only add a full
+decode plus a full write to each load of an uncached case. Use evict=True for LRU behaviour (skewed access).
+
+Entries are keyed by case identifier plus size and mtime of the preprocessed file, so re-preprocessing invalidates
+them. Enable with nnUNet_case_cache_gb=<budget in GB> or pass a SharedCaseCache to nnUNetDataset. The cache folder is
+not removed automatically, call clear() (or delete it) if you want the RAM back before the next reboot.
+"""
+
+import hashlib
+import os
+import tempfile
+from time import time
+from typing import Tuple, Union
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import join, isdir, isfile, maybe_mkdir_p, subfiles
+
+
+def get_default_case_cache_root() -> str:
+    return '/dev/shm' if isdir('/dev/shm') else tempfile.gettempdir()
+
+
+class SharedCaseCache(object):
+    COUNTERS = ('hits', 'misses', 'evictions')
+
+    # while the cache is full, admit() checks at most this often (seconds) whether there is room again
+    FULL_RECHECK_INTERVAL = 60
+
+    def __init__(self, budget_bytes: int, cache_folder: str, evict: bool = False):
+        """
+        Only stores paths, so it can be pickled and handed to worker processes. See
+        SharedCaseCache.for_preprocessed_folder for the cache folder used by nnUNetDataset.
+        evict: make room for new cases by evicting the least recently used ones. False: only add cases while there is
+        room (see module docstring)
+        """
+        self.budget_bytes = budget_bytes
+        self.cache_folder = cache_folder
+        self.evict = evict
+        self._full_since = None
+        maybe_mkdir_p(cache_folder)
+        self._lock_file = join(cache_folder, 'lock')
+        self._counters_file = join(cache_folder, 'counters.npy')
+        with self._locked():
+            if not isfile(self._counters_file):
+                np.save(self._counters_file, np.zeros(len(self.COUNTERS), dtype=np.int64))
+
+    @staticmethod
+    def for_preprocessed_folder(budget_bytes: int, folder: str, cache_root: str = None,
+                                evict: bool = False) -> 'SharedCaseCache':
+        """
+        one cache folder per preprocessed folder, in cache_root (default /dev/shm)
+        """
+        cache_root = get_default_case_cache_root() if cache_root is None else cache_root
+        folder_hash = hashlib.sha1(os.path.abspath(folder).encode('utf-8')).hexdigest()[:12]
+        return SharedCaseCache(budget_bytes, join(cache_root, f'nnUNet_case_cache_{folder_hash}'), evict)
+
+    def _locked(self):
+        return _FileLock(self._lock_file)
+
+    def _increment(self, counter: str, lock: bool = True) -> None:
+        """
+        lock=False if the caller already holds the lock (flock is not reentrant across file handles)
+        """
+        if lock:
+            with self._locked():
+                self._increment(counter, lock=False)
+            return
+        counters = np.load(self._counters_file, mmap_mode='r+')
+        counters[self.COUNTERS.index(counter)] += 1
+        counters.flush()
+        del counters
+
+    @staticmethod
+    def _entry_name(key: str, source_file: str) -> str:
+        st = os.stat(source_file)
+        return f'{key}__{st.st_size}_{st.st_mtime_ns}'
+
+    def get(self, key: str, source_file: str) -> Union[Tuple[np.ndarray, np.ndarray], None]:
+        """
+        (data, seg) as read only memory maps or None if the case is not cached. source_file is the preprocessed file
+        the case was read from (used to detect stale entries)
+        """
+        entry = join(self.cache_folder, self._entry_name(key, source_file))
+        try:
+            data = np.load(entry + '_data.npy', mmap_mode='r')
+            seg = np.load(entry + '_seg.npy', mmap_mode='r')
+            # the mtime of the data file is the time of last use
+            os.utime(entry + '_data.npy')
+        except FileNotFoundError:
+            # not cached or evicted in the meantime
+            self._increment('misses')
+            return None
+        self._increment('hits')
+        return data, seg
+
+    def admit(self, num_bytes: int) -> bool:
+        """
+        Whether put() would store a case of num_bytes. Check this before reading a case entirely for put(): cases
+        larger than the budget and (evict=False) cases that don't fit anymore are not stored. Cheap, the cache folder
+        is looked at at most every FULL_RECHECK_INTERVAL seconds while the cache is full
+        """
+        if num_bytes > self.budget_bytes:
+            return False
+        if self.evict:
+            return True
+        if self._full_since is not None and time() - self._full_since < self.FULL_RECHECK_INTERVAL:
+            return False
+        with self._locked():
+            cached_bytes = sum([e[1] for e in self._entries()])
+        if cached_bytes + num_bytes > self.budget_bytes:
+            self._full_since = time()
+            return False
+        self._full_since = None
+        return True
+
+    def put(self, key: str, source_file: str, data: np.ndarray, seg: np.ndarray) -> bool:
+        """
+        Adds a case, evicting least recently used cases if needed (evict=True). Cases larger than the budget are not
+        cached, neither are cases that don't fit into the remaining budget if evict=False. Returns whether the case
+        was added
+        """
+        num_bytes = data.nbytes + seg.nbytes
+        if num_bytes > self.budget_bytes:
+            return False
+        entry = join(self.cache_folder, self._entry_name(key, source_file))
+        with self._locked():
+            if isfile(entry + '_data.npy') and isfile(entry + '_seg.npy'):
+                return True
+            if self.evict:
+                self._evict(self.budget_bytes - num_bytes, key)
+            else:
+                # stale versions of this case are always removed, nothing else
+                self._evict(None, key)
+                if sum([e[1] for e in self._entries()]) + num_bytes > self.budget_bytes:
+                    self._full_since = time()
+                    return False
+            # write under a temporary name so that readers never see a partial file
+            for suffix, arr in (('_seg.npy', seg), ('_data.npy', data)):
+                np.save(entry + suffix[:-4] + '_tmp.npy', np.asarray(arr))
+                os.replace(entry + suffix[:-4] + '_tmp.npy', entry + suffix)
+        return True
+
+    def _entries(self):
+        """
+        [(last use, bytes, entry)] of all complete entries. Call with lock held
+        """
+        entries = []
+        for f in subfiles(self.cache_folder, join=True, suffix='_data.npy'):
+            entry = f[:-len('_data.npy')]
+            try:
+                entries.append((os.stat(f).st_mtime_ns, os.stat(f).st_size + os.stat(entry + '_seg.npy').st_size,
+                                entry))
+            except FileNotFoundError:
+                pass
+        return entries
+
+    def _evict(self, max_bytes: Union[int, None], key: str) -> None:
+        """
+        removes least recently used entries until at most max_bytes are cached (None: no limit). Stale entries of key
+        (older versions of the same case) are always removed. Call with lock held
+        """
+        entries = sorted(self._entries())
+        total = sum([e[1] for e in entries])
+        for last_use, num_bytes, entry in entries:
+            # entry names are key__version (see _entry_name). Don't match other keys that start with key + '__'
+            is_stale = os.path.basename(entry).rsplit('__', 1)[0] == key
+            if (max_bytes is None or total <= max_bytes) and not is_stale:
+                continue
+            for suffix in ('_data.npy', '_seg.npy'):
+                if isfile(entry + suffix):
+                    os.remove(entry + suffix)
+            total -= num_bytes
+            self._increment('evictions', lock=False)
+
+    def stats(self) -> dict:
+        """
+        hits, misses and evictions (summed over all processes using this cache folder), number of cached cases and
+        cached bytes
+        """
+        with self._locked():
+            counters = np.load(self._counters_file)
+            entries = self._entries()
+        ret = {k: int(v) for k, v in zip(self.COUNTERS, counters)}
+        ret['cached_cases'] = len(entries)
+        ret['cached_bytes'] = int(sum([e[1] for e in entries]))
+        ret['budget_bytes'] = self.budget_bytes
+        return ret
+
+    def clear(self) -> None:
+        with self._locked():
+            for f in subfiles(self.cache_folder, join=True, suffix='.npy'):
+                os.remove(f)
+            np.save(self._counters_file, np.zeros(len(self.COUNTERS), dtype=np.int64))
+        self._full_since = None
+
+
+class _FileLock(object):
+    """
+    exclusive lock on a file, across processes (fcntl, so Linux/macOS only)
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._f = None
+
+    def __enter__(self):
+        # imported here, not at module level: fcntl does not exist on Windows and nnUNetDataset must stay importable
+        # there as long as no cache is used
+        import fcntl
+        self._f = open(self.filename, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        import fcntl
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
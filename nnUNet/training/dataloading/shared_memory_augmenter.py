@@ -0,0 +1,357 @@
+"""
+Batch transport from the data augmentation workers to the training process through shared memory.
+
+batchgenerators' (NonDet)MultiThreadedAugmenter sends every batch through a multiprocessing queue, i.e. the float32
+data and the (deep supervision) targets are pickled in the worker, pushed through a pipe and unpickled in the trainer.
+At high iteration rates that alone can saturate a CPU core of the main process. SharedMemoryAugmenter instead
+preallocates a ring of batch slots in shared memory. Workers write their batches into a free slot in place and only
+send the slot index plus a few bytes of metadata (shapes, dtypes, keys). The trainer gets numpy arrays/torch tensors
+that are views into the slot, nothing is copied.
+
+A slot is handed back to the workers once the batch was consumed, which is when the next batch is requested. So a
+batch returned by __next__ is valid until the following call to __next__ (its content, that is: the memory stays
+mapped as long as the arrays exist, even after the augmenter was shut down). With pin_memory=True, batches are copied
+into page locked staging buffers right away (and the slot released immediately), which is what you want if the
+batches are copied to the GPU with non_blocking=True.
+
+Batches are returned in the order they are finished, not in a fixed round robin order over the workers (same as
+NonDetMultiThreadedAugmenter). Run this file for a throughput comparison with MultiThreadedAugmenter.
+"""
+
+import atexit
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+from queue import Empty
+from time import time
+from typing import List
+
+import numpy as np
+from batchgenerators.dataloading.data_loader import DataLoader
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class _Slot(shared_memory.SharedMemory):
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            # batches from this slot are still alive (interpreter shutdown). The mapping goes away with the process
+            pass
+
+
+# slots that could not be unmapped yet because batches returned from them are still alive, see _close_slots
+_slots_pending_close = []
+
+
+def _close_slots(slots: List[shared_memory.SharedMemory]) -> None:
+    """
+    Unmaps slots, except those that still have arrays pointing into them (close() raises BufferError for these,
+    unmapping would turn every access to these arrays into a segfault). They are kept and retried on the next call
+    """
+    still_exported = []
+    for s in list(_slots_pending_close) + list(slots):
+        try:
+            s.close()
+        except BufferError:
+            still_exported.append(s)
+    _slots_pending_close[:] = still_exported
+
+
+atexit.register(_close_slots, [])
+
+
+def _is_array(x) -> bool:
+    return isinstance(x, np.ndarray) or (torch is not None and isinstance(x, torch.Tensor))
+
+
+def _as_numpy(x) -> np.ndarray:
+    return x.numpy() if not isinstance(x, np.ndarray) else x
+
+
+def _flatten_batch(batch: dict):
+    """
+    -> list of (key, index in list or None, array), dict of everything that is not an array (sent through the queue)
+    """
+    arrays = []
+    other = {}
+    for k, v in batch.items():
+        if _is_array(v):
+            arrays.append((k, None, v))
+        elif isinstance(v, (list, tuple)) and len(v) > 0 and all([_is_array(i) for i in v]):
+            arrays.extend([(k, i, a) for i, a in enumerate(v)])
+        else:
+            other[k] = v
+    return arrays, other
+
+
+def get_batch_size_bytes(batch: dict, alignment: int = 64) -> int:
+    arrays, _ = _flatten_batch(batch)
+    return int(sum([int(np.ceil(_as_numpy(a).nbytes / alignment)) * alignment for _, _, a in arrays]))
+
+
+def _write_batch(batch: dict, buffer: memoryview, alignment: int = 64) -> dict:
+    arrays, other = _flatten_batch(batch)
+    layout = []
+    offset = 0
+    for k, i, a in arrays:
+        is_torch = not isinstance(a, np.ndarray)
+        a = _as_numpy(a)
+        if offset + a.nbytes > len(buffer):
+            raise RuntimeError(f'Batch does not fit into the shared memory slot ({len(buffer)} bytes). Batch shapes '
+                               f'must not change during training')
+        np.copyto(np.ndarray(a.shape, a.dtype, buffer=buffer, offset=offset), a)
+        layout.append((k, i, a.shape, a.dtype.str, offset, is_torch))
+        offset += int(np.ceil(a.nbytes / alignment)) * alignment
+    return {'layout': layout, 'other': other}
+
+
+def _read_batch(meta: dict, buffer: memoryview, as_torch: bool = False) -> dict:
+    batch = {**meta['other']}
+    for k, i, shape, dtype, offset, is_torch in meta['layout']:
+        # np.frombuffer, not np.ndarray(buffer=...): only frombuffer holds on to the buffer export, which is what
+        # makes SharedMemory.close() refuse to unmap a slot that is still in use (see _close_slots)
+        a = np.frombuffer(buffer, np.dtype(dtype), int(np.prod(shape)), offset).reshape(shape)
+        if is_torch or as_torch:
+            a = torch.from_numpy(a)
+        if i is None:
+            batch[k] = a
+        else:
+            if k not in batch.keys():
+                batch[k] = []
+            batch[k].append(a)
+    return batch
+
+
+def _shared_memory_producer(data_loader, transform, thread_id: int, seed: int, slot_names: List[str], free_slots,
+                            ready, abort_event, wait_time: float):
+    np.random.seed(seed)
+    data_loader.set_thread_id(thread_id)
+    # workers started by the main process share its resource tracker, so the blocks are unlinked exactly once (by the
+    # main process, see _finish)
+    slots = [_Slot(name=n) for n in slot_names]
+    try:
+        while not abort_event.is_set():
+            try:
+                item = next(data_loader)
+                if transform is not None:
+                    item = transform(**item)
+            except StopIteration:
+                ready.put(('end', thread_id, None))
+                return
+            slot = None
+            while slot is None and not abort_event.is_set():
+                try:
+                    slot = free_slots.get(timeout=wait_time)
+                except Empty:
+                    pass
+            if slot is None:
+                return
+            meta = _write_batch(item, slots[slot].buf)
+            del item
+            ready.put(('batch', slot, meta))
+    except KeyboardInterrupt:
+        abort_event.set()
+    except Exception:
+        ready.put(('error', thread_id, traceback.format_exc()))
+    finally:
+        for s in slots:
+            s.close()
+
+
+class SharedMemoryAugmenter(object):
+    def __init__(self, data_loader: DataLoader, transform, num_processes: int, num_slots: int = None,
+                 seeds: List[int] = None, pin_memory: bool = False, slot_size_bytes: int = None,
+                 timeout: float = 10, wait_time: float = 0.02):
+        """
+        Drop-in for (NonDet)MultiThreadedAugmenter (same first arguments, iterate over it). num_slots: number of
+        batches in flight (being written + ready + the one the trainer holds), default 2 x num_processes.
+        slot_size_bytes: None = generate one batch in this process to measure it.
+        timeout: if no batch arrives for that long (seconds), check whether the workers are still alive
+        """
+        self.data_loader = data_loader
+        self.transform = transform
+        self.num_processes = num_processes
+        self.num_slots = num_slots if num_slots is not None else 2 * num_processes
+        assert self.num_slots > 1, 'need at least two slots (one held by the trainer, one being written)'
+        self.seeds = seeds if seeds is not None else [None] * num_processes
+        self.pin_memory = pin_memory
+        self.slot_size_bytes = slot_size_bytes
+        self.timeout = timeout
+        self.wait_time = wait_time
+
+        self._slots = None
+        self._processes = []
+        self._held_slot = None
+        self._num_ended = 0
+        self._pinned = None
+        self._next_pinned = 0
+        self.wait_time_total = 0.
+        self.num_batches = 0
+
+    def __iter__(self):
+        return self
+
+    def _start(self):
+        if self.slot_size_bytes is None:
+            item = next(self.data_loader)
+            if self.transform is not None:
+                item = self.transform(**item)
+            # some headroom for loaders that return slightly different shapes
+            self.slot_size_bytes = int(get_batch_size_bytes(item) * 1.05) + 4096
+        ctx = multiprocessing.get_context()
+        self._slots = [_Slot(create=True, size=self.slot_size_bytes)
+                       for _ in range(self.num_slots)]
+        self._free_slots = ctx.Queue()
+        for i in range(self.num_slots):
+            self._free_slots.put(i)
+        self._ready = ctx.Queue()
+        self._abort_event = ctx.Event()
+        for i in range(self.num_processes):
+            p = ctx.Process(target=_shared_memory_producer,
+                            args=(self.data_loader, self.transform, i, self.seeds[i], [s.name for s in self._slots],
+                                  self._free_slots, self._ready, self._abort_event, self.wait_time))
+            p.daemon = True
+            p.start()
+            self._processes.append(p)
+
+    def release(self):
+        """
+        hands the slot of the last returned batch back to the workers. Called by __next__, only call this yourself if
+        you are done with a batch long before requesting the next one
+        """
+        if self._held_slot is not None:
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+
+    def _stage_pinned(self, batch: dict) -> dict:
+        # two sets of buffers so that the previous batch can still be in flight to the GPU
+        if self._pinned is None:
+            self._pinned = [None, None]
+        if self._pinned[self._next_pinned] is None:
+            self._pinned[self._next_pinned] = {
+                k: ([torch.empty(i.shape, dtype=i.dtype, pin_memory=True) for i in v] if isinstance(v, list) else
+                    torch.empty(v.shape, dtype=v.dtype, pin_memory=True))
+                for k, v in batch.items() if isinstance(v, torch.Tensor) or
+                (isinstance(v, list) and len(v) > 0 and isinstance(v[0], torch.Tensor))}
+        staged = self._pinned[self._next_pinned]
+        self._next_pinned = (self._next_pinned + 1) % 2
+        ret = {**batch}
+        for k, buffers in staged.items():
+            if isinstance(buffers, list):
+                for b, v in zip(buffers, batch[k]):
+                    b.copy_(v)
+            else:
+                buffers.copy_(batch[k])
+            ret[k] = buffers
+        return ret
+
+    def __next__(self):
+        if self._slots is None:
+            self._start()
+        self.release()
+        start = time()
+        while True:
+            try:
+                kind, idx, payload = self._ready.get(timeout=self.timeout)
+            except Empty:
+                if not all([p.is_alive() for p in self._processes]):
+                    self._finish()
+                    raise RuntimeError('One or more background workers are no longer alive. Exiting. Please check '
+                                       'the print statements above for the actual error message')
+                continue
+            if kind == 'error':
+                self._finish()
+                raise RuntimeError(f'Exception in background worker {idx}:\n{payload}')
+            if kind == 'end':
+                self._num_ended += 1
+                if self._num_ended == self.num_processes:
+                    self._finish()
+                    raise StopIteration
+                continue
+            break
+        self.wait_time_total += time() - start
+        self.num_batches += 1
+        pin_memory = self.pin_memory and torch is not None
+        batch = _read_batch(payload, self._slots[idx].buf, as_torch=pin_memory)
+        if pin_memory:
+            batch = self._stage_pinned(batch)
+            self._free_slots.put(idx)
+        else:
+            self._held_slot = idx
+        return batch
+
+    def next(self):
+        return self.__next__()
+
+    def _finish(self):
+        if self._slots is None:
+            return
+        self._abort_event.set()
+        for p in self._processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._processes = []
+        for s in self._slots:
+            # removes the name only, mappings stay valid
+            s.unlink()
+        _close_slots(self._slots)
+        self._slots = None
+        self._held_slot = None
+
+    def __del__(self):
+        self._finish()
+
+
+class _RandomBatchLoader(DataLoader):
+    """
+    synthetic batches for benchmark_batch_transport
+    """
+    def __init__(self, data_shape, seg_shape, num_deep_supervision_levels: int = 1):
+        super().__init__(None, data_shape[0], 1, None, True, False, True)
+        self.data_shape = data_shape
+        self.seg_shape = seg_shape
+        self.num_deep_supervision_levels = num_deep_supervision_levels
+
+    def generate_train_batch(self):
+        # always the same batch, we don't want to measure np.random
+        if self._data is None:
+            data = np.random.random(self.data_shape).astype(np.float32)
+            target = [np.random.randint(0, 3, [*self.seg_shape[:2], *[s // 2 ** i for s in self.seg_shape[2:]]],
+                                        dtype=np.int16) for i in range(self.num_deep_supervision_levels)]
+            self._data = {'data': data, 'target': target if len(target) > 1 else target[0],
+                          'keys': [str(i) for i in range(self.data_shape[0])]}
+        return self._data
+
+
+def benchmark_batch_transport(data_shape=(2, 1, 128, 128, 128), seg_shape=(2, 1, 128, 128, 128),
+                              num_processes: int = 4, num_batches: int = 200, num_deep_supervision_levels: int = 5):
+    """
+    batches per second received by the main process with MultiThreadedAugmenter and SharedMemoryAugmenter. The
+    synthetic loader is cheap, so what is measured is mostly the transport (pickling + pipe vs. shared memory)
+    """
+    from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAugmenter
+    results = {}
+    for name, augmenter_class in (('MultiThreadedAugmenter', MultiThreadedAugmenter),
+                                  ('SharedMemoryAugmenter', SharedMemoryAugmenter)):
+        loader = _RandomBatchLoader(data_shape, seg_shape, num_deep_supervision_levels)
+        augmenter = augmenter_class(loader, None, num_processes, seeds=list(range(num_processes)))
+        # warm up, workers need to start
+        for _ in range(num_processes * 2):
+            next(augmenter)
+        start = time()
+        for _ in range(num_batches):
+            next(augmenter)
+        results[name] = num_batches / (time() - start)
+        augmenter._finish()
+        print(f'{name}: {results[name]:.1f} batches/s')
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_batch_transport()
@@ -0,0 +1,187 @@
+"""
+Unpacking of preprocessed .npz files into .npy (which can be memory mapped by nnUNetDataset).
+
+Every unpacked case gets a sidecar record (<case>.unpack.json) with the size/mtime of the npz it was created from and
+size, shape, dtype and sha256 of each npy file. A case is skipped if its record matches the npz and the npy files on
+disk, so restarting a training does not unpack anything again. npy files are written to a temporary file and moved
+into place, so a npy file that exists is always complete (nnUNetDataset relies on that: it uses the npz as long as the
+npy is not there). That is also what makes background unpacking possible: training starts right away, reading the
+npz files, and picks up the npy files as they appear.
+"""
+
+import hashlib
+import os
+import threading
+from time import time
+from typing import List, Union
+
+import numpy as np
+from batchgenerators.utilities.file_and_folder_operations import isfile, subfiles, load_json, save_json
+
+from nnunetv2.utilities.hashing import file_stat_signature
+from nnunetv2.utilities.task_executor import run_tasks
+
+
+UNPACK_RECORD_SUFFIX = '.unpack.json'
+
+
+def _npy_files(npz_file: str, unpack_segmentation: bool) -> dict:
+    ret = {'data': npz_file[:-4] + '.npy'}
+    if unpack_segmentation:
+        ret['seg'] = npz_file[:-4] + '_seg.npy'
+    return ret
+
+
+def _array_checksum(arr: np.ndarray) -> str:
+    return hashlib.sha256(memoryview(np.ascontiguousarray(arr)).cast('B')).hexdigest()
+
+
+def is_unpacked(npz_file: str, unpack_segmentation: bool = True, verify_checksums: bool = False) -> bool:
+    """
+    True if the unpack record of npz_file matches the npz and the npy files. The cheap check (sizes, npy headers) is
+    always done, verify_checksums additionally reads the npy files and compares their checksums
+    """
+    record_file = npz_file[:-4] + UNPACK_RECORD_SUFFIX
+    if not isfile(record_file):
+        return False
+    try:
+        record = load_json(record_file)
+        if record['npz'] != file_stat_signature(npz_file):
+            return False
+        for key, npy_file in _npy_files(npz_file, unpack_segmentation).items():
+            expected = record['files'].get(key)
+            if expected is None or not isfile(npy_file) or os.path.getsize(npy_file) != expected['size']:
+                return False
+            arr = np.load(npy_file, mmap_mode='r')
+            if list(arr.shape) != expected['shape'] or arr.dtype.str != expected['dtype']:
+                return False
+            if verify_checksums and _array_checksum(arr) != expected['sha256']:
+                return False
+    except (ValueError, KeyError, OSError):
+        # broken record or npy file
+        return False
+    return True
+
+
+def unpack_case(npz_file: str, unpack_segmentation: bool = True, overwrite_existing: bool = False,
+                verify_checksums: bool = False) -> int:
+    """
+    Unpacks npz_file unless it already is (see is_unpacked). Returns the number of bytes written
+    """
+    if not overwrite_existing and is_unpacked(npz_file, unpack_segmentation, verify_checksums):
+        return 0
+    record_file = npz_file[:-4] + UNPACK_RECORD_SUFFIX
+    # the npz might change while we are reading it. Take its signature first, a changed npz then fails the next check
+    record = {'npz': file_stat_signature(npz_file), 'files': {}}
+    try:
+        npz_content = np.load(npz_file)
+    except Exception as e:
+        print(f"Unable to open preprocessed file {npz_file}. Rerun nnUNetv2_preprocess!")
+        raise e
+    num_bytes = 0
+    tmp_files = []
+    try:
+        for key, npy_file in _npy_files(npz_file, unpack_segmentation).items():
+            arr = npz_content[key]
+            tmp_file = npy_file[:-4] + '_tmp.npy'
+            tmp_files.append(tmp_file)
+            np.save(tmp_file, arr)
+            os.replace(tmp_file, npy_file)
+            record['files'][key] = {'size': os.path.getsize(npy_file), 'shape': list(arr.shape),
+                                    'dtype': arr.dtype.str, 'sha256': _array_checksum(arr)}
+            num_bytes += record['files'][key]['size']
+        save_json(record, record_file + '.tmp')
+        os.replace(record_file + '.tmp', record_file)
+    except BaseException:
+        for f in tmp_files + [record_file + '.tmp']:
+            if isfile(f):
+                os.remove(f)
+        raise
+    return num_bytes
+
+
+class UnpackManager(object):
+    def __init__(self, folder: str, unpack_segmentation: bool = True, overwrite_existing: bool = False,
+                 num_processes: int = 8, verify_checksums: bool = False, verbose: bool = True):
+        """
+        Unpacks all npz files in folder that are not unpacked yet. run() blocks, start() unpacks in a background thread
+        (+ worker processes) and returns immediately, wait() blocks until that is done.
+        verify_checksums: rehash existing npy files instead of only checking sizes and headers (slow)
+        """
+        self.folder = folder
+        self.unpack_segmentation = unpack_segmentation
+        self.overwrite_existing = overwrite_existing
+        self.num_processes = num_processes
+        self.verify_checksums = verify_checksums
+        self.verbose = verbose
+        self._thread = None
+        self._exception = None
+        self.stats = {}
+
+    def get_pending(self, npz_files: List[str]) -> List[str]:
+        if self.overwrite_existing:
+            return npz_files
+        # the cheap check runs here. The checksum verification reads everything, that is left to the workers
+        if self.verify_checksums:
+            return npz_files
+        return [i for i in npz_files if not is_unpacked(i, self.unpack_segmentation)]
+
+    def run(self, disable_progress_bar: bool = False) -> dict:
+        """
+        returns statistics: number of cases, how many were unpacked, bytes written, time, throughput
+        """
+        start = time()
+        npz_files = subfiles(self.folder, True, None, ".npz", True)
+        pending = self.get_pending(npz_files)
+        num_bytes = run_tasks(unpack_case, [(i, self.unpack_segmentation, self.overwrite_existing,
+                                             self.verify_checksums) for i in pending],
+                              self.num_processes, desc='Unpacking dataset',
+                              disable_progress_bar=disable_progress_bar) if len(pending) > 0 else []
+        duration = time() - start
+        self.stats = {
+            'cases': len(npz_files),
+            'unpacked': int(sum([i > 0 for i in num_bytes])),
+            'bytes_written': int(sum(num_bytes)),
+            'time': duration,
+            'MB_per_s': sum(num_bytes) / 1024 ** 2 / max(duration, 1e-6),
+            'cases_per_s': len(pending) / max(duration, 1e-6),
+        }
+        if self.verbose:
+            print(f"Unpacking {self.folder}: {self.stats['unpacked']} of {self.stats['cases']} cases needed "
+                  f"unpacking, {self.stats['bytes_written'] / 1024 ** 3:.2f} GB in {duration:.1f}s "
+                  f"({self.stats['MB_per_s']:.0f} MB/s, {self.stats['cases_per_s']:.1f} cases/s)")
+        return self.stats
+
+    def start(self) -> 'UnpackManager':
+        """
+        unpack in the background. Until a case is unpacked, nnUNetDataset reads its npz
+        """
+        def _run():
+            try:
+                self.run(disable_progress_bar=True)
+            except BaseException as e:
+                self._exception = e
+
+        self._thread = threading.Thread(target=_run, daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def done(self) -> bool:
+        return self._thread is None or not self._thread.is_alive()
+
+    def wait(self, timeout: Union[float, None] = None) -> dict:
+        """
+        blocks until background unpacking is done, re-raises its error (if any)
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self.stats
+
+
+if __name__ == '__main__':
+    m = UnpackManager('/media/fabian/data/nnUNet_preprocessed/Dataset002_Heart/2d', num_processes=8).start()
+    # training would start here
+    print(m.wait())
@@ -0,0 +1,74 @@
+"""
+Preprocessed cases stored as blosc2 NDArrays (<case>.b2nd, <case>_seg.b2nd). The arrays are split into chunks of about
+half the patch size, each chunk is compressed on its own. Opening such a file reads nothing but the header; slicing
+it reads and decompresses only the chunks that overlap the slice. So the data loaders read a few chunks per patch
+instead of the entire case (.npz) and the files are much smaller than unpacked .npy. There is nothing to unpack.
+
+Select with nnUNet_preprocessed_format=blosc2 when running nnUNetv2_preprocess (default: npz). The training data
+loaders detect the format automatically.
+"""
+
+import os
+from typing import List, Tuple, Union
+
+import numpy as np
+
+
+B2ND_FILE_ENDING = '.b2nd'
+PREPROCESSED_FORMATS = ('npz', 'blosc2')
+
+
+def get_preprocessed_format() -> str:
+    """
+    value of nnUNet_preprocessed_format, 'npz' if not set
+    """
+    preprocessed_format = os.environ['nnUNet_preprocessed_format'].lower() if \
+        'nnUNet_preprocessed_format' in os.environ.keys() else 'npz'
+    if preprocessed_format not in PREPROCESSED_FORMATS:
+        raise RuntimeError(f'Unknown nnUNet_preprocessed_format {preprocessed_format}. Supported: '
+                           f'{PREPROCESSED_FORMATS}')
+    return preprocessed_format
+
+
+def import_blosc2():
+    try:
+        import blosc2
+    except ImportError:
+        raise RuntimeError('The blosc2 preprocessed format requires the blosc2 package. Install it with '
+                           '\'pip install blosc2\' or use nnUNet_preprocessed_format=npz')
+    return blosc2
+
+
+def compute_b2nd_chunks(shape: Union[Tuple[int, ...], List[int]],
+                        patch_size: Union[Tuple[int, ...], List[int]]) -> Tuple[int, ...]:
+    """
+    shape is (c, x, y(, z)). All channels go into the same chunk because every patch needs all of them. Spatially the
+    chunks are half the patch size, so a patch overlaps at most 3 chunks per axis and decodes at most 1.5x its own
+    size along each axis (with chunks of patch size it would be 2x). 2d configurations have fewer patch axes than the
+    data has spatial axes: the leading axes get chunk size 1 so that a 2d patch only touches one slice
+    """
+    spatial_shape = shape[1:]
+    patch_size = [1] * (len(spatial_shape) - len(patch_size)) + list(patch_size)
+    return (shape[0], *[max(1, min(s, int(np.ceil(p / 2)))) for s, p in zip(spatial_shape, patch_size)])
+
+
+def save_b2nd(array: np.ndarray, filename: str, chunks: Tuple[int, ...], clevel: int = 5, num_threads: int = 1):
+    """
+    Written to a temporary file first which is then moved into place, so an interrupted preprocessing never leaves a
+    truncated file behind. num_threads is 1 because the preprocessor already runs one case per worker
+    """
+    blosc2 = import_blosc2()
+    tmp_file = filename + '.tmp'
+    blosc2.asarray(np.ascontiguousarray(array), urlpath=tmp_file, mode='w', chunks=chunks,
+                   cparams={'codec': blosc2.Codec.ZSTD, 'clevel': clevel, 'nthreads': num_threads})
+    os.replace(tmp_file, filename)
+
+
+def open_b2nd(filename: str, num_threads: int = 1):
+    """
+    Lazy, read only blosc2.NDArray. Indexing it returns a numpy array and decodes only the chunks that are needed.
+    Memory mapped, so repeated reads are served from the page cache. Not picklable, open it in the process that uses
+    it. num_threads is 1 because data loading already runs in many background workers
+    """
+    blosc2 = import_blosc2()
+    return blosc2.open(filename, mode='r', mmap_mode='r', dparams={'nthreads': num_threads})
@@ -0,0 +1,47 @@
+import hashlib
+import json
+import os
+from typing import List, Union
+
+
+def hash_file(filename: str, algorithm: str = 'sha256', chunk_size: int = 2 ** 24) -> str:
+    """
+    hex digest of the content of filename. Read in chunks so that large images don't need to fit into RAM
+    """
+    h = hashlib.new(algorithm)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_json_serializable(obj, algorithm: str = 'sha256') -> str:
+    """
+    hex digest of a json serializable object (plans, dataset.json, ...). Keys are sorted so that the hash does not
+    depend on the order of dict entries
+    """
+    return hashlib.new(algorithm, json.dumps(obj, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def file_stat_signature(filename: str) -> List[int]:
+    """
+    [size, mtime_ns]. If this did not change we assume the content did not change either (that's what git does, too)
+    and can skip rehashing
+    """
+    st = os.stat(filename)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def hash_files_with_cache(filenames: List[str], previous: Union[dict, None] = None) -> dict:
+    """
+    Returns {filename: {'stat': file_stat_signature, 'hash': hash_file}}. Entries in previous (a return value of an
+    earlier call) whose stat signature still matches are reused without reading the file again.
+    """
+    ret = {}
+    for f in filenames:
+        stat = file_stat_signature(f)
+        if previous is not None and f in previous.keys() and previous[f]['stat'] == stat:
+            ret[f] = previous[f]
+        else:
+            ret[f] = {'stat': stat, 'hash': hash_file(f)}
+    return ret
@@ -0,0 +1,154 @@
+"""
+Runs independent per-case tasks (preprocessing, fingerprint extraction) in worker processes such that the sum of their
+expected peak memory stays below a RAM budget. Small cases run wide, large cases run narrow.
+
+Each task comes with an estimate (in bytes) of its memory requirement, typically computed from the image header with
+estimate_case_memory. The worker measures the actual increase of its peak RSS while running the task
+(/proc/self/status VmHWM, reset through /proc/self/clear_refs) and the executor scales all further estimates by a high
+quantile of the ratios between measurement and estimate of the most recent tasks. The correction can grow and shrink,
+and a single outlier does not throttle the rest of the run. Tasks with a tiny estimate are not used for this, their
+peak is dominated by constant overhead (lazy imports, allocator growth). Tasks without an estimate (None, for example
+because the reader/writer cannot read the image geometry from the header) are assumed to need as much as the largest
+peak measured so far, and run alone until the first task has been measured. The budget does not include the constant
+footprint of the worker processes themselves (python + imports, a few hundred MB each).
+
+The budget is taken from the nnUNet_ram_budget_gb environment variable if set, otherwise 80% of the currently
+available memory is used.
+"""
+
+import os
+from collections import deque
+from typing import Callable, List, Tuple, Union
+
+import numpy as np
+
+from nnunetv2.utilities.task_executor import TaskExecutor
+
+# tasks with smaller estimates don't contribute to the correction factor
+MIN_ESTIMATE_FOR_CORRECTION = 64 * 1024 ** 2
+# the correction factor is this percentile of the ratios (peak / estimate) of the last NUM_RATIOS_FOR_CORRECTION
+# measured tasks
+CORRECTION_PERCENTILE = 90
+NUM_RATIOS_FOR_CORRECTION = 20
+
+
+def get_available_memory_bytes() -> Union[int, None]:
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_default_memory_budget_bytes() -> Union[int, None]:
+    """
+    nnUNet_ram_budget_gb if set, otherwise 80% of the available memory. None (= no budget) if neither is known
+    """
+    if 'nnUNet_ram_budget_gb' in os.environ.keys():
+        return int(float(os.environ['nnUNet_ram_budget_gb']) * 1024 ** 3)
+    available = get_available_memory_bytes()
+    return int(0.8 * available) if available is not None else None
+
+
+def estimate_case_memory(shape: Union[Tuple[int, ...], List[int]], num_channels: int,
+                         target_shape: Union[Tuple[int, ...], List[int], None] = None,
+                         has_seg: bool = True) -> int:
+    """
+    Rough peak memory (bytes) of reading, cropping and (optionally) resampling a case. shape is the spatial shape as
+    stored on disk, target_shape the spatial shape after resampling (None if the task does not resample, for example
+    fingerprint extraction). Accounts for the float32 copies made while reading and preprocessing and for the float64
+    buffers used by the resampling. Errors in this estimate are corrected by the executor once the first cases have
+    been measured
+    """
+    num_voxels = int(np.prod(shape, dtype=np.int64))
+    # read_images stacks float32 channels (list + vstack), run_case_npy copies, cropping creates masks
+    num_bytes = num_voxels * (3 * 4 * num_channels + 2)
+    if has_seg:
+        # segmentations are read as float32 and copied
+        num_bytes += num_voxels * 2 * 4
+    if target_shape is not None:
+        num_voxels_target = int(np.prod(target_shape, dtype=np.int64))
+        # float64 resampling buffers for each channel, float32 result, segmentation resampling
+        num_bytes += num_voxels_target * (num_channels * (8 + 4) + (3 * 8 if has_seg else 0))
+    return num_bytes
+
+
+class MemoryBudgetedExecutor(object):
+    def __init__(self, num_processes: int, memory_budget_bytes: Union[int, None] = None, verbose: bool = False):
+        """
+        num_processes is the maximum number of tasks that run at the same time. memory_budget_bytes=None uses
+        get_default_memory_budget_bytes()
+        """
+        self.num_processes = num_processes
+        self.memory_budget_bytes = memory_budget_bytes if memory_budget_bytes is not None else \
+            get_default_memory_budget_bytes()
+        self.verbose = verbose
+        # high quantile of recent (observed peak / estimate). 1 (trust the estimate) until the first task finished
+        self.correction_factor = 1.
+        self._observed_ratios = deque(maxlen=NUM_RATIOS_FOR_CORRECTION)
+        self._max_observed_peak = None
+        self.max_observed_parallelism = 0
+
+    def _expected(self, estimate: Union[int, None]) -> int:
+        if estimate is None:
+            # conservative: as large as the largest case seen so far. Nothing measured yet -> the whole budget
+            if self._max_observed_peak is not None:
+                return self._max_observed_peak
+            return self.memory_budget_bytes if self.memory_budget_bytes is not None else 0
+        return int(estimate * self.correction_factor)
+
+    def run(self, fn: Callable, args_per_task: List[tuple], estimates: List[Union[int, None]],
+            desc: str = None) -> List:
+        """
+        Runs fn(*args) for all args in args_per_task and returns the results in the same order. fn and args must be
+        picklable (spawn). A task is started if fewer than num_processes tasks are running and its expected memory
+        (estimate x correction factor) fits into what is left of the budget. If nothing is running, the next task is
+        always started, even if it exceeds the budget on its own. Tasks that don't fit are skipped in favor of later,
+        smaller tasks. An estimate of None means unknown, see module docstring.
+        """
+        assert len(args_per_task) == len(estimates)
+        pending = deque(range(len(args_per_task)))
+        running = {}  # task index in executor -> task index here
+        results = [None] * len(args_per_task)
+        budget = self.memory_budget_bytes
+        worker_died_message = 'A background worker died while processing a case. No error message usually means ' \
+                              'that it was killed by your OS for running out of RAM. Reduce the RAM budget ' \
+                              '(nnUNet_ram_budget_gb, currently %s GB) so that fewer large cases are processed at ' \
+                              'the same time.' % (None if budget is None else round(budget / 1024 ** 3, 1))
+
+        with TaskExecutor(self.num_processes, desc=desc, total=len(args_per_task),
+                          disable_progress_bar=self.verbose, worker_died_message=worker_died_message) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                in_use = sum([self._expected(estimates[i]) for i in running.values()])
+                # tasks that don't fit are put back in front, in their original order
+                skipped = []
+                while len(pending) > 0 and len(running) < self.num_processes:
+                    i = pending.popleft()
+                    if budget is None or len(running) == 0 or in_use + self._expected(estimates[i]) <= budget:
+                        running[executor.submit(fn, *args_per_task[i])] = i
+                        in_use += self._expected(estimates[i])
+                    else:
+                        skipped.append(i)
+                pending.extendleft(reversed(skipped))
+                self.max_observed_parallelism = max(self.max_observed_parallelism, len(running))
+
+                for j in executor.wait_any():
+                    i = running.pop(j)
+                    results[i] = executor.get_result(j)
+                    peak = executor.task_stats[j]['peak_rss_increase']
+                    if peak > 0:
+                        self._max_observed_peak = max(peak, self._max_observed_peak or 0)
+                    if estimates[i] is not None and estimates[i] >= MIN_ESTIMATE_FOR_CORRECTION and peak > 0:
+                        self._observed_ratios.append(peak / estimates[i])
+                        self.correction_factor = float(np.percentile(self._observed_ratios, CORRECTION_PERCENTILE))
+                    if self.verbose:
+                        estimate = 'no estimate' if estimates[i] is None else \
+                            f'estimated {estimates[i] / 1024 ** 2:.0f} MB'
+                        print(f'task {i}: {estimate}, peak {peak / 1024 ** 2:.0f} MB, correction factor now '
+                              f'{self.correction_factor:.2f}, {len(running)} running')
+            if self.verbose:
+                print(executor.timing_summary())
+        return results
@@ -0,0 +1,191 @@
+"""
+Process pool for the per-case work of the pipeline (fingerprint extraction, preprocessing, export of predictions).
+
+Replaces the pattern of submitting everything with starmap_async and then polling all results every 0.1s (quadratic
+in the number of cases, reaches into the private Pool._pool to see whether workers are still alive). Here:
+- completion is event driven (concurrent.futures.wait), bookkeeping is proportional to the number of running tasks
+- a worker that dies (OOM killer!) is detected by the pool itself and reported as a RuntimeError, for all call sites
+  in the same way. Errors raised inside a task are re-raised in the main process
+- backpressure: submit blocks while max_pending tasks are unfinished, so a fast producer (GPU) can't queue up more
+  work than the workers can handle
+- per task timing and peak memory are measured inside the worker and available in task_stats
+"""
+
+import multiprocessing
+import resource
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED, Future
+from concurrent.futures.process import BrokenProcessPool
+from time import time
+from typing import Callable, List, Union
+
+import numpy as np
+from tqdm import tqdm
+
+
+WORKER_DIED_MESSAGE = 'A background worker died while processing a case. This could be because of an error (look ' \
+                      'for an error message) or because it was killed by your OS due to running out of RAM. If you ' \
+                      'don\'t see an error message, out of RAM is likely the problem. In that case reducing the ' \
+                      'number of workers might help'
+
+
+def _read_proc_status_kb(key: str) -> Union[int, None]:
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def get_current_rss_bytes() -> int:
+    rss = _read_proc_status_kb('VmRSS')
+    return rss * 1024 if rss is not None else get_peak_rss_bytes()
+
+
+def get_peak_rss_bytes() -> int:
+    peak = _read_proc_status_kb('VmHWM')
+    if peak is not None:
+        return peak * 1024
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets VmHWM to the current RSS (Linux >= 4.0). Returns False if that is not possible, in which case the peak
+    reported afterwards is the peak of the entire lifetime of the process (overestimates, which is the safe side)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _run_task(fn: Callable, args: tuple):
+    reset_peak_rss()
+    rss_before = get_current_rss_bytes()
+    start = time()
+    result = fn(*args)
+    stats = {'start': start, 'run_time': time() - start,
+             'peak_rss_increase': max(0, get_peak_rss_bytes() - rss_before)}
+    return result, stats
+
+
+class TaskExecutor(object):
+    def __init__(self, num_processes: int, max_pending: Union[int, None] = None, desc: str = None,
+                 total: Union[int, None] = None, disable_progress_bar: bool = False,
+                 worker_died_message: str = WORKER_DIED_MESSAGE):
+        """
+        Use as context manager. max_pending: submit blocks while this many tasks are unfinished. None = no limit.
+        total: expected number of tasks for the progress bar (None = number of submitted tasks is not known upfront)
+        """
+        self.num_processes = num_processes
+        self.max_pending = max_pending
+        self.worker_died_message = worker_died_message
+        self._executor = ProcessPoolExecutor(num_processes, mp_context=multiprocessing.get_context("spawn"))
+        self._pbar = tqdm(desc=desc, total=total, disable=disable_progress_bar)
+        self._running = {}  # future -> task index
+        self._results = []
+        # one dict per submitted task: submitted, start, run_time, queue_time, peak_rss_increase
+        self.task_stats = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # on error don't wait for the remaining tasks
+        self._executor.shutdown(wait=exc_type is None, cancel_futures=exc_type is not None)
+        self._pbar.close()
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._running)
+
+    def submit(self, fn: Callable, *args) -> int:
+        """
+        Runs fn(*args) in a worker. fn and args must be picklable (spawn). Returns the index of the task (= position in
+        get_results()). Blocks while max_pending tasks are unfinished
+        """
+        self.wait_for_capacity()
+        idx = len(self._results)
+        self._results.append(None)
+        self.task_stats.append({'submitted': time()})
+        try:
+            self._running[self._executor.submit(_run_task, fn, args)] = idx
+        except BrokenProcessPool:
+            raise RuntimeError(self.worker_died_message)
+        return idx
+
+    def wait_for_capacity(self, max_pending: Union[int, None] = None) -> None:
+        """
+        Blocks until fewer than max_pending (default: self.max_pending) tasks are unfinished
+        """
+        max_pending = self.max_pending if max_pending is None else max_pending
+        if max_pending is None:
+            return
+        while len(self._running) >= max_pending:
+            self.wait_any()
+
+    def wait_any(self) -> List[int]:
+        """
+        Blocks until at least one running task finished, returns the indices of all finished tasks. Raises the error of
+        a failed task
+        """
+        if len(self._running) == 0:
+            return []
+        done, _ = wait(list(self._running.keys()), return_when=FIRST_COMPLETED)
+        finished = []
+        for f in done:
+            idx = self._running.pop(f)
+            self._collect(f, idx)
+            finished.append(idx)
+        return finished
+
+    def _collect(self, f: Future, idx: int) -> None:
+        try:
+            result, stats = f.result()
+        except BrokenProcessPool:
+            raise RuntimeError(self.worker_died_message)
+        self._results[idx] = result
+        stats['queue_time'] = stats['start'] - self.task_stats[idx]['submitted']
+        self.task_stats[idx].update(stats)
+        self._pbar.update()
+
+    def get_result(self, idx: int):
+        """
+        result of a finished task
+        """
+        return self._results[idx]
+
+    def get_results(self) -> List:
+        """
+        Waits for all tasks and returns their results in the order they were submitted
+        """
+        while len(self._running) > 0:
+            self.wait_any()
+        return self._results
+
+    def timing_summary(self) -> str:
+        run_times = [s['run_time'] for s in self.task_stats if 'run_time' in s.keys()]
+        if len(run_times) == 0:
+            return 'no tasks finished'
+        queue_times = [s['queue_time'] for s in self.task_stats if 'queue_time' in s.keys()]
+        return f'{len(run_times)} tasks, run time per task: median {np.median(run_times):.2f}s, ' \
+               f'max {np.max(run_times):.2f}s, total {np.sum(run_times):.1f}s. Time spent queued: median ' \
+               f'{np.median(queue_times):.2f}s, max {np.max(queue_times):.2f}s'
+
+
+def run_tasks(fn: Callable, args_per_task: List[tuple], num_processes: int, desc: str = None,
+              disable_progress_bar: bool = False) -> List:
+    """
+    fn(*args) for all args in args_per_task, results in the same order
+    """
+    with TaskExecutor(num_processes, desc=desc, total=len(args_per_task),
+                      disable_progress_bar=disable_progress_bar) as executor:
+        for args in args_per_task:
+            executor.submit(fn, *args)
+        return executor.get_results()